@@ -97,6 +97,11 @@ if __name__ == '__main__':
     test = state.get_symbol('test', Test)
     value = state.get_symbol('value', c_int)
 
+    # zero-copy view of the original C string
+    # (usable for file writes, sockets, numpy etc.)
+    original = state.get_buffer(test._bytes, c_char, test.length, readonly=True)
+    print('original "test.bytes":', original.tobytes())
+
     # alter test.bytes
     test.bytes = bytearray(b'Python was here...')
 
@@ -5,6 +5,8 @@
 # callable from Python.
 # Use `callable_function` to import a Python function into the
 # C namespace.
+# Use `translated_function` to write a C function in a numeric
+# subset of Python.
 #
 # NOTE: For trivial tasks the overhead of the ctype conversions
 #       will let the C code run slower than a CPython equivalent.
@@ -69,6 +71,20 @@ def l_fib_c(a):
     """
 
 
+@gen.translated_function(c_int, c_int)
+def l_fib_tr(a):
+    # same as l_fib_py, translated to C
+    result = 0
+    if a <= 2:
+        return 1
+    last = next_to_last = 1
+    for i in range(2, a):
+        result = last + next_to_last
+        next_to_last = last
+        last = result
+    return result
+
+
 @gen.c_function(c_int, c_int)
 def c_runner_r(n):
     """
@@ -156,6 +172,7 @@ if __name__ == '__main__':
 
     assert(r_fib_py(20) == r_fib_c(20))
     assert(l_fib_py(20) == l_fib_c(20))
+    assert(l_fib_c(20) == l_fib_tr(20))
     assert (r_fib_c(20) == l_fib_c(20))
 
     from timeit import timeit
@@ -167,6 +184,9 @@ if __name__ == '__main__':
     c = timeit('l_fib_c(20)', setup='from __main__ import l_fib_c', number=100)
     print('looped Python/C:', py, c, float(py) / c)
 
+    tr = timeit('l_fib_tr(20)', setup='from __main__ import l_fib_tr', number=100)
+    print('looped Python/translated:', py, tr, float(py) / tr)
+
     # some call tests Python <--> C
     print('workload - sum(100x fib(20)):')
     assert(c_runner_l(100) == py_runner_l(100))
@@ -0,0 +1,603 @@
+"""
+Behavior tests of tinycc, they need a working libtcc.
+"""
+import ctypes
+import os
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+from ctypes import (POINTER, c_char, c_double, c_int, c_size_t, c_uint,
+                    sizeof)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tinycc import InlineGenerator, InlineGeneratorException, TccException, TinyCC  # noqa: E402
+
+
+def build(gen):
+    state = TinyCC().create_state()
+    gen.prepare_state(state)
+    state.compile(gen.code)
+    state.relocate()
+    gen.bind_state(state)
+    return state
+
+
+class TestLayout(unittest.TestCase):
+    def test_embedded_aligned_struct(self):
+        gen = InlineGenerator()
+
+        class Al(gen.ScopedStructure):
+            _fields_ = [('v', c_int)]
+            _layout_ = {'align': 32}
+
+        class Outer(gen.ScopedStructure):
+            _fields_ = [('x', c_char), ('al', Al)]
+
+        @gen.c_function(c_size_t)
+        def outer_offset():
+            "return (size_t) &((struct Outer *) 0)->al + 1000 * sizeof(struct Outer);"
+        gen.add_topdeclaration('#include <stddef.h>')
+        self.assertIn('Outer__layout', Outer._c_code)
+        build(gen)
+        self.assertEqual(outer_offset(), Outer.al.offset + 1000 * sizeof(Outer))
+
+    def test_isolated_fields(self):
+        gen = InlineGenerator()
+
+        class Counters(gen.ScopedStructure):
+            _fields_ = [('a', c_int), ('b', c_int)]
+            _layout_ = {'isolate': ['a', 'b']}
+
+        build(gen)
+        self.assertEqual(Counters.b.offset, 64)
+        self.assertEqual(sizeof(Counters), 128)
+
+    def test_bitfields_rejected(self):
+        gen = InlineGenerator()
+        with self.assertRaises(InlineGeneratorException):
+            class Flags(gen.ScopedStructure):
+                _fields_ = [('a', c_uint, 3), ('b', c_int)]
+                _layout_ = {'order': 'size'}
+
+
+
+class TestDeadCode(unittest.TestCase):
+    def generator(self):
+        gen = InlineGenerator()
+
+        @gen.c_function(c_int, c_int)
+        def twice(x):
+            "return 2 * x;"
+
+        @gen.c_function(c_int, c_int)
+        def quad(x):
+            "return twice(twice(x));"
+
+        @gen.c_function(c_int, c_int)
+        def unused(x):
+            "return -x;"
+        return gen, quad, unused
+
+    def test_bind_with_roots(self):
+        gen, quad, unused = self.generator()
+        code = gen.generate([quad])
+        self.assertNotIn('unused', code)
+        state = TinyCC().create_state()
+        gen.prepare_state(state)
+        state.compile(code)
+        state.relocate()
+        # the full code of an unrelated consumer must not leak in
+        self.assertIn('unused', gen.code)
+        gen.bind_state(state, [quad])
+        self.assertEqual(quad(3), 12)
+
+    def test_build_with_roots(self):
+        gen, quad, unused = self.generator()
+        gen.build(roots=[quad])
+        self.assertEqual(quad(2), 8)
+
+    def test_lazy_roots(self):
+        gen, quad, unused = self.generator()
+        gen.lazy = True
+        gen.roots = [quad]
+        self.assertEqual(quad(1), 4)
+
+    def test_missing_symbol_without_roots(self):
+        gen, quad, unused = self.generator()
+        state = TinyCC().create_state()
+        gen.prepare_state(state)
+        state.compile(gen.generate([quad]))
+        state.relocate()
+        gen.bind_state(state)
+        self.assertEqual(quad(1), 4)
+        self.assertRaises(TccException, unused, 1)
+
+
+
+class TestContainers(unittest.TestCase):
+    def test_vector_sort_search(self):
+        gen = InlineGenerator()
+        Vector = gen.vector(c_int)
+        build(gen)
+        v = Vector()
+        v.extend([5, 3, 9, 1] * 10)
+        v.append(7)
+        v.sort()
+        self.assertEqual(list(v), sorted([5, 3, 9, 1] * 10 + [7]))
+        self.assertEqual(v[v.search(7)], 7)
+        self.assertEqual(v.search(4), -1)
+        self.assertEqual(v.pop(), 9)
+        v.free()
+
+    def test_less_with_colliding_field_names(self):
+        gen = InlineGenerator()
+
+        class Pair(gen.ScopedStructure):
+            _fields_ = [('a', c_int), ('b', c_int)]
+        Pairs = gen.vector(Pair, less='a.a < b.a')
+        Queue = gen.priority_queue(Pair, less='a.b < b.b')
+        build(gen)
+        v = Pairs()
+        v.extend([Pair(i * 7 % 40, -i) for i in range(40)])
+        v.sort()
+        self.assertEqual([p.a for p in v], list(range(40)))
+        q = Queue()
+        q.extend([Pair(i, i * 7 % 40) for i in range(40)])
+        self.assertEqual([q.pop().b for _ in range(40)], list(range(40)))
+
+    def test_struct_keys_ignore_padding(self):
+        gen = InlineGenerator()
+
+        class Key(gen.ScopedStructure):
+            _fields_ = [('tag', c_char), ('id', c_int), ('xy', c_int * 2)]
+        Map = gen.hash_map(Key, c_double)
+        build(gen)
+        self.assertEqual(Key.id.offset, 4)
+        m = Map()
+        dirty = Key(b'k', 1, (2, 3))
+        ctypes.memset(ctypes.addressof(dirty) + 1, 0xff, 3)
+        m[dirty] = 1.5
+        self.assertEqual(m[Key(b'k', 1, (2, 3))], 1.5)
+        self.assertNotIn(Key(b'k', 1, (2, 4)), m)
+        for i in range(100):
+            m[Key(b'x', i, (i, i))] = i
+        del m[Key(b'k', 1, (2, 3))]
+        self.assertEqual(len(m), 100)
+        self.assertEqual(m.get(Key(b'x', 42, (42, 42))), 42)
+        m.free()
+
+
+
+class TestStores(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'records.store')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rmdir(self.tmp)
+
+    def test_roundtrip(self):
+        gen = InlineGenerator()
+
+        class Rec(gen.ScopedStructure):
+            _fields_ = [('a', c_int), ('b', c_double)]
+
+        with Rec.create_store(self.path, 3) as store:
+            store[1].a = 42
+            store[2].b = 0.5
+        store = Rec.open_store(self.path)
+        self.assertEqual(len(store), 3)
+        self.assertEqual((store[1].a, store[2].b), (42, 0.5))
+        store.close()
+
+    def test_bitfields(self):
+        gen = InlineGenerator()
+
+        class Flags(gen.ScopedStructure):
+            _fields_ = [('kind', c_uint, 3), ('level', c_uint, 5), ('n', c_int)]
+
+        class Wider(gen.ScopedStructure):
+            _fields_ = [('kind', c_uint, 4), ('level', c_uint, 4), ('n', c_int)]
+
+        with Flags.create_store(self.path, 2) as store:
+            store[0].kind = 5
+            store[0].level = 17
+        store = Flags.open_store(self.path)
+        self.assertEqual((store[0].kind, store[0].level), (5, 17))
+        store.close()
+        self.assertNotEqual(Flags._fingerprint(), Wider._fingerprint())
+        self.assertRaises(InlineGeneratorException, Wider.open_store, self.path)
+
+
+
+def pipeline_generator(name):
+    gen = InlineGenerator()
+    gen.add_topdeclaration('#include <string.h>')
+
+    @gen.c_function(c_size_t, POINTER(c_char), c_size_t, POINTER(c_char), c_size_t)
+    def scale(data, length, out, size):
+        """
+        long long v;
+        if (!data)
+            return 0;
+        memcpy(&v, data, sizeof v);
+        v *= 2;
+        memcpy(out, &v, sizeof v);
+        return sizeof v;
+        """
+
+    @gen.c_function(c_size_t, POINTER(c_char), c_size_t, POINTER(c_char), c_size_t)
+    def total(data, length, out, size):
+        """
+        static long long sum;
+        long long v;
+        if (!data) {
+            memcpy(out, &sum, sizeof sum);
+            sum = 0;
+            return sizeof sum;
+        }
+        memcpy(&v, data, sizeof v);
+        sum += v;
+        return 0;
+        """
+    return gen, gen.pipeline([scale, total], name, capacity=4, buffer_size=16)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run(self):
+        gen, Pipeline = pipeline_generator('RunPipeline')
+        build(gen)
+        p = Pipeline()
+        results = p.run([ctypes.c_longlong(i) for i in range(100)])
+        self.assertEqual([ctypes.c_longlong.from_buffer_copy(r).value for r in results],
+                         [2 * sum(range(100))])
+        stats = p.stats
+        self.assertEqual([stage['items'] for stage in stats['stages']], [100, 100])
+        self.assertEqual(stats['queues'][0]['capacity'], 4)
+
+    def test_start_failure(self):
+        gen, Pipeline = pipeline_generator('FailingPipeline')
+        real = ctypes.CDLL(None).pthread_create
+        real.argtypes = [ctypes.c_void_p] * 4
+        calls = []
+
+        @ctypes.CFUNCTYPE(c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                          ctypes.c_void_p)
+        def failing_create(thread, attr, start, arg):
+            calls.append(None)
+            if len(calls) == 2:
+                return 11  # EAGAIN
+            return real(thread, attr, start, arg)
+
+        state = TinyCC().create_state()
+        gen.prepare_state(state)
+        state.define('pthread_create', 'failing_create')
+        state._add_symbol('failing_create', ctypes.cast(failing_create, ctypes.c_void_p))
+        state.compile(gen.code)
+        state.relocate()
+        gen.bind_state(state)
+        p = Pipeline()
+        self.assertRaises(InlineGeneratorException, p.start)
+        # the started stage was joined and the runtime freed
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(p.runtime)
+        calls.append(None)
+        p.start()
+        p.close()
+        p.join()
+
+
+
+@unittest.skipIf(sys.platform == 'win32', 'perf maps are written on POSIX')
+class TestPerfMap(unittest.TestCase):
+    def test_functions_only(self):
+        gen = InlineGenerator()
+        gen.add_data('table', (c_int * 4)(1, 2, 3, 4))
+        gen.add_definition('int counter;', 'extern int counter;')
+
+        @gen.c_function(c_int, c_int)
+        def lookup(i):
+            "return table[i] + counter;"
+
+        tcc = TinyCC()
+        tcc.perf_map = True
+        try:
+            build(gen)
+            with open('/tmp/perf-%d.map' % os.getpid()) as f:
+                names = [line.split()[2] for line in f]
+            self.assertEqual(lookup(2), 3)
+        finally:
+            tcc.perf_map = False
+        self.assertIn('lookup', names)
+        self.assertNotIn('table', names)
+        self.assertNotIn('counter', names)
+
+
+
+class TestTranslator(unittest.TestCase):
+    def test_translated_functions(self):
+        gen = InlineGenerator()
+
+        @gen.translated_function(c_int, c_int)
+        def fib(a):
+            if a <= 2:
+                return 1
+            last, next_to_last = 1, 1
+            for i in range(2, a):
+                last, next_to_last = last + next_to_last, last
+            return last
+
+        @gen.translated_function(c_int, c_int)
+        def fact(n):
+            return 1 if n <= 1 else n * fact(n - 1)
+
+        @gen.translated_function(c_int, c_int, c_int)
+        def floor_div(a, b):
+            return a // b
+
+        @gen.translated_function(c_int, c_int, c_int)
+        def floor_mod(a, b):
+            return a % b
+
+        @gen.translated_function(c_int, c_uint)
+        def countdown(n):
+            total = 0
+            for i in range(n, -1, -1):
+                total += i
+            return total
+
+        build(gen)
+        self.assertEqual([fib(i) for i in range(1, 10)], [1, 1, 2, 3, 5, 8, 13, 21, 34])
+        self.assertEqual(fact(6), 720)
+        for a, b in [(-7, 2), (7, -2), (-7, -2), (7, 2)]:
+            self.assertEqual(floor_div(a, b), a // b)
+            self.assertEqual(floor_mod(a, b), a % b)
+        self.assertEqual(countdown(4), 10)
+
+    def test_failed_translation_is_not_registered(self):
+        gen = InlineGenerator()
+
+        def broken(a):
+            return [a]
+        self.assertRaises(InlineGeneratorException,
+                          gen.translated_function(c_int, c_int), broken)
+        self.assertNotIn('broken', gen.signatures)
+
+        @gen.translated_function(c_int, c_int)
+        def works(a):
+            return a + 1
+        build(gen)
+        self.assertEqual(works(1), 2)
+
+
+
+class TestWire(unittest.TestCase):
+    def test_varint_and_prefixed(self):
+        gen = InlineGenerator()
+
+        class Msg(gen.ScopedStructure):
+            _fields_ = [('id', ctypes.c_uint32), ('delta', ctypes.c_int64),
+                        ('value', c_double), ('nlen', ctypes.c_uint8),
+                        ('name', c_char * 16), ('vals', ctypes.c_int16 * 3)]
+            _wire_ = {'endian': 'big',
+                      'fields': {'id': 'varint', 'delta': 'varint',
+                                 'name': ('prefixed16', 'nlen')}}
+        build(gen)
+        msgs = [Msg(300, -5, 1.5, 3, b'abc', (1, -2, 3)), Msg(1, 70000, -2.0, 0, b'', (0, 0, 7))]
+        data = Msg.wire_pack(msgs)
+        expected = (b'\xac\x02' + b'\x09' + struct.pack('>d', 1.5) + b'\x03' +
+                    struct.pack('>H', 3) + b'abc' + struct.pack('>3h', 1, -2, 3))
+        self.assertEqual(bytes(data[:len(expected)]), expected)
+        # a trailing partial record is left for the next call
+        out, used = Msg.wire_unpack(bytes(data) + b'\x05')
+        self.assertEqual(used, len(data))
+        self.assertEqual([(m.id, m.delta, m.value, m.name, list(m.vals)) for m in out],
+                         [(300, -5, 1.5, b'abc', [1, -2, 3]), (1, 70000, -2.0, b'', [0, 0, 7])])
+
+    def test_native_layout(self):
+        gen = InlineGenerator()
+
+        class Fixed(gen.ScopedStructure):
+            _fields_ = [('a', ctypes.c_uint8), ('b', ctypes.c_uint32), ('c', c_double)]
+            _wire_ = {'endian': sys.byteorder, 'packed': False}
+        build(gen)
+        records = (Fixed * 2)(Fixed(1, 2, 3.0), Fixed(4, 5, 6.0))
+        data = Fixed.wire_pack(records)
+        self.assertEqual(bytes(data), bytes(records))
+        out, used = Fixed.wire_unpack(bytearray(data))
+        self.assertEqual([(f.a, f.b, f.c) for f in out], [(1, 2, 3.0), (4, 5, 6.0)])
+
+    def test_oversized_string(self):
+        gen = InlineGenerator()
+
+        class Short(gen.ScopedStructure):
+            _fields_ = [('s', c_char * 8), ('x', ctypes.c_int16)]
+            _wire_ = {'endian': 'big', 'fields': {'s': 'prefixed'}}
+        build(gen)
+        out, used = Short.wire_unpack(Short.wire_pack([Short(b'hello', 5)]))
+        self.assertEqual((out[0].s, out[0].x), (b'hello', 5))
+        self.assertRaises(InlineGeneratorException, Short.wire_unpack, b'\x09' + b'x' * 20)
+
+
+
+class TestHotSwap(unittest.TestCase):
+    def test_swap(self):
+        gen = InlineGenerator(hotswap=True)
+
+        @gen.c_function(c_int, c_int)
+        def kernel(x):
+            "return x + 1;"
+
+        @gen.c_function(c_int, c_int)
+        def runner(x):
+            "return kernel(x) * 10;"
+
+        class Item(gen.ScopedStructure):
+            _fields_ = [('a', c_int)]
+
+            @gen.c_method(c_int)
+            def get(self):
+                "return self->a + kernel(0);"
+
+        @gen.callable_function(c_int, c_int)
+        def from_python(x):
+            return kernel(x) + 1000
+
+        @gen.c_function(c_int, c_int)
+        def via_python(x):
+            "return from_python(x);"
+
+        old = build(gen)
+        self.assertEqual((kernel(1), runner(1), Item(5).get(), via_python(1)), (2, 20, 6, 1002))
+
+        def kernel(x):
+            "return x + 100;"
+        kernel = gen.c_function(c_int, c_int)(kernel)
+        state = TinyCC().create_state()
+        gen.prepare_state(state)
+        state.compile(gen.code)
+        state.relocate()
+        self.assertEqual(runner(1), 20)
+        gen.hot_swap(state)
+        self.assertEqual((kernel(1), runner(1), Item(5).get(), via_python(1)),
+                         (101, 1010, 105, 1101))
+        # the old state is freed once no call is in flight
+        self.assertIsNone(old.ctx)
+
+    def test_swap_during_calls(self):
+        gen = InlineGenerator(hotswap=True)
+
+        @gen.c_function(c_int, c_int)
+        def square(x):
+            "return x * x;"
+        build(gen)
+        errors, stop = [], threading.Event()
+
+        def call():
+            while not stop.is_set():
+                if square(7) != 49:
+                    errors.append(square(7))
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in range(20):
+                state = TinyCC().create_state()
+                gen.prepare_state(state)
+                state.compile(gen.code)
+                state.relocate()
+                gen.hot_swap(state)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(square(3), 9)
+
+    def test_not_hot_swappable(self):
+        gen = InlineGenerator()
+        state = build(gen)
+        self.assertRaises(InlineGeneratorException, gen.hot_swap, state)
+
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+class TestPrefork(unittest.TestCase):
+    def in_child(self, check):
+        """
+        Exit status of `check` run in a forked child, 0 if it returned true.
+        """
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os._exit(0 if check() else 1)
+            except BaseException:
+                os._exit(2)
+        return os.waitpid(pid, 0)[1]
+
+    def test_workers_share_code(self):
+        gen = InlineGenerator(lazy=True)
+
+        @gen.c_function(c_int, c_int, c_int)
+        def add(a, b):
+            "return a + b;"
+        TinyCC().prefork(gen, freeze=False)
+        state = gen.state
+        self.assertIsNotNone(state)
+        self.assertEqual(add(1, 2), 3)
+        # a lock held by another thread of the parent at fork time
+        gen._lazy_lock.acquire()
+        try:
+            def check():
+                return (gen._lazy_lock.acquire(False) and gen.state is state and
+                        add(40, 2) == 42)
+            self.assertEqual(self.in_child(check), 0)
+        finally:
+            gen._lazy_lock.release()
+
+    def test_pipeline_in_child(self):
+        gen, Pipeline = pipeline_generator('ForkedPipeline')
+        TinyCC().prefork(gen, freeze=False)
+        p = Pipeline()
+        p.start()
+        try:
+            def check():
+                # the stage threads of the parent do not exist in the child
+                results = Pipeline().run([ctypes.c_longlong(21)])
+                return (not p.runtime and
+                        ctypes.c_longlong.from_buffer_copy(results[0]).value == 42)
+            self.assertEqual(self.in_child(check), 0)
+        finally:
+            p.close()
+            p.join()
+
+
+
+class TestScans(unittest.TestCase):
+    def setUp(self):
+        gen = InlineGenerator()
+
+        class Row(gen.ScopedStructure):
+            _fields_ = [('a', c_int), ('flag', c_char), ('b', c_double),
+                        ('n', c_uint), ('v', ctypes.c_float * 3)]
+        self.Row = Row
+        # more records than a scan chunk
+        self.count = Row.SCAN_CHUNK * 2 + 5
+        self.rows = (Row * self.count)()
+        for i in range(self.count):
+            row = self.rows[i]
+            row.a, row.b, row.n, row.v[1] = i % 100, (i * 7) % 53, i % 5, i % 3
+
+    def test_scan(self):
+        rows = self.rows
+        indices = self.Row.scan(rows, 'a > 10 and b < a and v[1] == 2')
+        self.assertEqual(list(indices), [i for i, row in enumerate(rows)
+                                         if row.a > 10 and row.b < row.a and row.v[1] == 2])
+        # Python semantics for mixed signedness and floor division
+        indices = self.Row.scan(rows, 'n > a - 50 and a // 7 == -1 - n // -3')
+        self.assertEqual(list(indices), [i for i, row in enumerate(rows)
+                                         if row.n > row.a - 50 and row.a // 7 == -1 - row.n // -3])
+
+    def test_select_project(self):
+        selected = self.Row.select(self.rows, 'a == 5')
+        self.assertEqual(len(selected), (self.count + 94) // 100)
+        self.assertTrue(all(row.a == 5 for row in selected))
+        values = self.Row.project(self.rows, 'a * b', 'a == 7')
+        self.assertIs(values._type_, c_double)
+        self.assertEqual(list(values), [7.0 * row.b for row in self.rows if row.a == 7])
+        values = self.Row.project(memoryview(self.rows), 'c_int(b) + a')
+        self.assertIs(values._type_, c_int)
+        self.assertEqual(values[9], int(self.rows[9].b) + 9)
+
+    def test_invalid_predicates(self):
+        self.assertRaises(InlineGeneratorException, self.Row.scan, self.rows, 'missing > 1')
+        self.assertRaises(InlineGeneratorException, self.Row.scan, self.rows, 'a >')
+
+
+if __name__ == '__main__':
+    unittest.main()
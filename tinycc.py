@@ -26,13 +26,25 @@ __version__ = '0.1.0'
 
 import os
 import sys
+import ast
+import bisect
+import collections
 import ctypes
+import hashlib
+import inspect
+import mmap
+import re
+import textwrap
+import threading
+import time
 import types
+import weakref
 
 PY3 = False
 if sys.version_info >= (3, 0):
     PY3 = True
     unicode = str
+    long = int
 
 # basic type mapping (array types are not supported)
 TYPE_MAPPER = {
@@ -96,69 +108,3405 @@ if sys.platform == 'win32':
 
 # tcc error function type
 ERROR_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_char_p)
+# tcc symbol list callback type
+SYMBOL_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p)
+
+# clock for throughput measurements
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def _buffer_pointer(data):
+    """
+    Returns an object usable as `void *` argument for the memory
+    of the buffer object `data` and its size in bytes.
+    Read-only or non contiguous buffers other than bytes get copied.
+    """
+    if isinstance(data, bytes):
+        return data, len(data)
+    if isinstance(data, (ctypes.Array, ctypes.Structure, ctypes.Union)):
+        return data, ctypes.sizeof(data)
+    view = memoryview(data)
+    if view.readonly or not view.c_contiguous:
+        data = view.tobytes()
+        return data, len(data)
+    return (ctypes.c_char * view.nbytes).from_buffer(view), view.nbytes
+
+
+# ctypes supports `_align_` from Python 3.13 on
+_CTYPES_ALIGN = sys.version_info >= (3, 13)
+
+_NATIVE_ORDER = '<' if sys.byteorder == 'little' else '>'
+_FORMAT_CTYPES = dict((ctype._type_, ctype) for ctype in (
+    ctypes.c_char, ctypes.c_byte, ctypes.c_ubyte, ctypes.c_short,
+    ctypes.c_ushort, ctypes.c_int, ctypes.c_uint, ctypes.c_long,
+    ctypes.c_ulong, ctypes.c_longlong, ctypes.c_ulonglong,
+    ctypes.c_float, ctypes.c_double, ctypes.c_bool))
+# on LP64 the _type_ of c_longlong is 'l', buffers of 64 bit integers use 'q'
+_FORMAT_CTYPES.setdefault('q', ctypes.c_longlong)
+_FORMAT_CTYPES.setdefault('Q', ctypes.c_ulonglong)
+
+
+class _CtypesBackend(object):
+    """
+    FFI backend for calls between Python and compiled code with ctypes.
+    """
+    name = 'ctypes'
+
+    def function(self, address, restype, argtypes, functype=None):
+        """
+        Returns a callable for the C function at `address`.
+        `functype` is an optional ctypes function type to be used.
+        """
+        return (functype or ctypes.CFUNCTYPE(restype, *argtypes))(address)
+
+    def callback(self, func, restype, argtypes):
+        """
+        Returns a C function pointer object calling `func`.
+        """
+        return ctypes.CFUNCTYPE(restype, *argtypes)(func)
+
+    def store(self, address, value):
+        """
+        Write `value` to `address`.
+        """
+        ctypes.pointer(type(value).from_address(address))[0] = value
+
+
+class _CffiBackend(_CtypesBackend):
+    """
+    FFI backend with cffi in ABI mode (much faster calls in PyPy).
+
+    The signatures are still declared with ctypes, arguments
+    and results are converted to get the same semantics as with ctypes.
+    ScopedStructure types get declared to cffi from their C code.
+    """
+    name = 'cffi'
+
+    def __init__(self):
+        try:
+            import cffi
+        except ImportError:
+            raise TccException('cffi backend needs the cffi package')
+        self.ffi = cffi.FFI()
+        self.declared = set()
+
+    def _declare(self, ctype):
+        """
+        Declare struct types to cffi, returns the C type string.
+        """
+        base = ctype
+        while isinstance(base, type) and issubclass(base, (ctypes._Pointer, ctypes.Array)):
+            base = base._type_
+        if (isinstance(base, type) and issubclass(base, ctypes.Structure) and
+                base not in self.declared):
+            self.declared.add(base)
+            for _, field in base._fields_:
+                self._declare(field)
+            # without the pragmas and layout checks of the C code
+            pack = base.__dict__.get('_pack_')
+            self.ffi.cdef(getattr(base, '_c_struct', base._c_code),
+                          **({'pack': pack} if pack else {}))
+        if isinstance(ctype, type) and issubclass(ctype, ctypes.Array):
+            # only declared as struct member
+            return None
+        return TYPE_MAPPER[ctype]
+
+    @staticmethod
+    def _is_pointer(ctype):
+        return (ctype in (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_wchar_p) or
+                issubclass(ctype, ctypes._Pointer))
+
+    @staticmethod
+    def _is_struct(ctype):
+        return issubclass(ctype, (ctypes.Structure, ctypes.Union))
+
+    def _address(self, value):
+        if isinstance(value, (ctypes.Array, ctypes.Structure, ctypes.Union)):
+            return ctypes.addressof(value)
+        if isinstance(value, (int, long)):
+            return value
+        return ctypes.cast(value, ctypes.c_void_p).value
+
+    def _to_c(self, ctype):
+        """
+        Converter of a Python value for a ctypes argument type.
+        """
+        ffi = self.ffi
+        if self._is_struct(ctype):
+            pointer = self._declare(ctype) + ' *'
+            return lambda v: ffi.cast(pointer, ctypes.addressof(v))[0]
+        if not self._is_pointer(ctype):
+            return None
+        cname = self._declare(ctype)
+
+        def convert(value):
+            if value is None:
+                return ffi.NULL
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                return ffi.cast(cname, ffi.from_buffer(value))
+            return ffi.cast(cname, self._address(value))
+        return convert
+
+    def _to_py(self, ctype):
+        """
+        Converter of a C value to the Python value ctypes would give.
+        """
+        ffi = self.ffi
+        if ctype is None:
+            return None
+        if self._is_struct(ctype):
+            pointer = self._declare(ctype) + ' *'
+            return lambda v: ctype.from_buffer_copy(ffi.buffer(ffi.new(pointer, v)))
+        if ctype is ctypes.c_void_p:
+            return lambda v: int(ffi.cast('uintptr_t', v)) or None
+        if ctype is ctypes.c_char_p:
+            return lambda v: ffi.string(v) if v != ffi.NULL else None
+        if ctype is ctypes.c_wchar_p:
+            return lambda v: ffi.string(v) if v != ffi.NULL else None
+        if self._is_pointer(ctype):
+            return lambda v: ctypes.cast(int(ffi.cast('uintptr_t', v)), ctype)
+        return None
+
+    def _signature(self, restype, argtypes, pointer):
+        args = ', '.join(self._declare(ctype) for ctype in argtypes)
+        return '%s %s(%s)' % (self._declare(restype), '(*)' if pointer else '',
+                              args or 'void')
+
+    def function(self, address, restype, argtypes, functype=None):
+        func = self.ffi.cast(self._signature(restype, argtypes, True), address)
+        to_c = [self._to_c(ctype) for ctype in argtypes]
+        to_py = self._to_py(restype)
+        if not any(to_c) and not to_py:
+            # plain scalar signature, call directly
+            return func
+        to_c = [conv or (lambda v: v) for conv in to_c]
+
+        def call(*args):
+            result = func(*[conv(arg) for conv, arg in zip(to_c, args)])
+            return to_py(result) if to_py else result
+        return call
+
+    def callback(self, func, restype, argtypes):
+        to_py = [self._to_py(ctype) for ctype in argtypes]
+        to_c = self._to_c(restype) if restype is not None else None
+        if any(to_py) or to_c:
+            to_py = [conv or (lambda v: v) for conv in to_py]
+            wrapped = func
+
+            def func(*args):
+                result = wrapped(*[conv(arg) for conv, arg in zip(to_py, args)])
+                return to_c(result) if to_c else result
+        return self.ffi.callback(self._signature(restype, argtypes, False), func)
+
+    def store(self, address, value):
+        if isinstance(value, self.ffi.CData):
+            self.ffi.cast('void **', address)[0] = self.ffi.cast('void *', value)
+        else:
+            _CtypesBackend.store(self, address, value)
+
+
+# available FFI backends
+FFI_BACKENDS = {
+    'ctypes': _CtypesBackend,
+    'cffi': _CffiBackend
+}
+
+
+class _Callback(object):
+    """
+    Python function exported to C, the function pointer
+    is created lazy by the FFI backend of the state.
+    """
+    def __init__(self, func, restype, argtypes):
+        self.func = func
+        self.restype = restype
+        self.argtypes = argtypes
+        self.pointers = {}
+
+    def get(self, backend):
+        # keep a reference to avoid garbage collection of the C pointer
+        if backend not in self.pointers:
+            self.pointers[backend] = backend.callback(
+                self.func, self.restype, self.argtypes)
+        return self.pointers[backend]
+
+
+# C side of the scratch arena (struct layout shared with `Arena`)
+_ARENA_STRUCT = '''struct tcc_arena
+{
+    char *base;
+    size_t size;
+    size_t used;
+    void *blocks;
+    size_t overflow;
+    size_t high_water;
+    size_t allocations;
+    size_t resets;
+    void (*release)(void *);
+};'''
+
+_ARENA_CODE = '''#include <stddef.h>
+#include <stdlib.h>
+
+%s
+
+/* header of overflow blocks, keeps 16 byte alignment */
+#define TCC_ARENA_HEADER 16
+
+/* allocate `n` bytes from `arena`, valid until the next reset */
+static void *tcc_arena_alloc(struct tcc_arena *arena, size_t n)
+{
+    void *p;
+    size_t total;
+    n = (n + 15) & ~(size_t) 15;
+    if (arena->size - arena->used >= n) {
+        p = arena->base + arena->used;
+        arena->used += n;
+    } else {
+        /* exhausted, chain an overflow block */
+        p = malloc(TCC_ARENA_HEADER + n);
+        if (!p)
+            return NULL;
+        *(void **) p = arena->blocks;
+        arena->blocks = p;
+        arena->overflow += n;
+        arena->release = free;
+        p = (char *) p + TCC_ARENA_HEADER;
+    }
+    arena->allocations++;
+    total = arena->used + arena->overflow;
+    if (total > arena->high_water)
+        arena->high_water = total;
+    return p;
+}
+
+/* free all allocations of `arena` at once */
+static void tcc_arena_reset(struct tcc_arena *arena)
+{
+    void *next;
+    while (arena->blocks) {
+        next = *(void **) arena->blocks;
+        free(arena->blocks);
+        arena->blocks = next;
+    }
+    arena->used = 0;
+    arena->overflow = 0;
+    arena->resets++;
+}''' % _ARENA_STRUCT
+
+
+class Arena(ctypes.Structure):
+    """
+    Scratch memory arena for compiled kernels.
+
+    Pass the arena to a kernel with a `POINTER(Arena)` argument
+    (`struct tcc_arena *` in C) and allocate temporary memory in C with
+    `tcc_arena_alloc(arena, n)` instead of malloc/free. All allocations
+    are released at once by resetting the arena, the memory is reused
+    for the next call. If the arena runs out of memory further
+    allocations are served by malloc, the next reset grows the arena
+    to the high-water mark.
+
+    The arena API is declared automatically in the top section
+    of an InlineGenerator using the type.
+
+    Example:
+        >>> @gen.c_function(c_int, POINTER(Arena), c_int)
+        ... def kernel(arena, n):
+        ...     '''
+        ...     int *tmp = tcc_arena_alloc(arena, n * sizeof(int));
+        ...     ...
+        ...     '''
+        >>> arena = Arena(1 << 20)
+        >>> with arena:  # resets the arena on exit
+        ...     kernel(arena, 1000)
+
+    Use `Arena.local()` for an arena per thread.
+    """
+    _fields_ = [('base', ctypes.c_void_p),
+                ('size', ctypes.c_size_t),
+                ('used', ctypes.c_size_t),
+                ('blocks', ctypes.c_void_p),
+                ('overflow', ctypes.c_size_t),
+                ('high_water', ctypes.c_size_t),
+                ('allocations', ctypes.c_size_t),
+                ('resets', ctypes.c_size_t),
+                ('release', ctypes.c_void_p)]
+    _c_code = _ARENA_STRUCT
+    _local = threading.local()
+
+    def __init__(self, size=65536):
+        ctypes.Structure.__init__(self)
+        self._allocate(size)
+
+    def _allocate(self, size):
+        self._memory = ctypes.create_string_buffer(size)
+        self.base = ctypes.addressof(self._memory)
+        self.size = size
+
+    def _free_blocks(self):
+        if not self.blocks:
+            return
+        release = ctypes.CFUNCTYPE(None, ctypes.c_void_p)(self.release)
+        block = self.blocks
+        while block:
+            following = ctypes.c_void_p.from_address(block).value
+            release(block)
+            block = following
+        self.blocks = None
+
+    def reset(self, grow=True):
+        """
+        Release all allocations. With `grow` the arena gets resized
+        to the high-water mark if it overflowed.
+        """
+        self._free_blocks()
+        if grow and self.high_water > self.size:
+            self._allocate((self.high_water + 4095) & ~4095)
+        self.used = 0
+        self.overflow = 0
+        self.resets += 1
+
+    @property
+    def stats(self):
+        """
+        Usage statistics of the arena.
+        """
+        return {'size': self.size, 'used': self.used + self.overflow,
+                'high_water': self.high_water, 'allocations': self.allocations,
+                'resets': self.resets, 'overflow': self.overflow}
+
+    @classmethod
+    def local(cls, size=65536):
+        """
+        Returns the arena of the current thread.
+        """
+        arena = getattr(cls._local, 'arena', None)
+        if arena is None:
+            arena = cls._local.arena = cls(size)
+        return arena
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def __del__(self):
+        self._free_blocks()
+
+
+TYPE_MAPPER[Arena] = 'struct tcc_arena'
+TYPE_MAPPER[ctypes.POINTER(Arena)] = 'struct tcc_arena *'
+
+
+class LazyArray(object):
+    """
+    Lazy elementwise expression over 1-dimensional buffers.
+
+    Arithmetic (`+`, `-`, `*`, `/`, unary `-` and `abs`) on wrapped
+    buffers (bytes, array.array, numpy arrays, ctypes arrays) and numbers
+    records an expression graph instead of computing anything.
+    `evaluate` compiles the graph into a single fused C loop, the result
+    is computed in one pass over the memory without temporary arrays.
+    Compiled loops are cached by the shape of the graph and the element
+    types, numbers are passed as arguments and don't trigger recompiles.
+
+    The result type follows the operands: floating point wins over
+    integer, wider wins over narrower, `/` always gives a double for
+    integers. Numbers don't widen the type of the arrays.
+
+    Example:
+        >>> a, b, c, d = (LazyArray(x) for x in (xa, xb, xc, xd))
+        >>> result = (a * b + c * d).evaluate()
+    """
+    _kernels = {}
+    _lock = threading.Lock()
+    RANKS = [ctypes.c_bool, ctypes.c_byte, ctypes.c_ubyte, ctypes.c_short,
+             ctypes.c_ushort, ctypes.c_int, ctypes.c_uint, ctypes.c_long,
+             ctypes.c_ulong, ctypes.c_longlong, ctypes.c_ulonglong,
+             ctypes.c_float, ctypes.c_double]
+
+    def __init__(self, data, ctype=None):
+        if ctype is None:
+            ctype = _FORMAT_CTYPES.get(memoryview(data).format.lstrip('@=' + _NATIVE_ORDER))
+            if ctype not in self.RANKS:
+                raise TypeError('unsupported buffer format, give ctype explicitly')
+        self.op = 'input'
+        self.args = (data,)
+        self.ctype = ctype
+        self.weak = False
+
+    @classmethod
+    def _node(cls, op, args, ctype, weak=False):
+        node = object.__new__(cls)
+        node.op = op
+        node.args = args
+        node.ctype = ctype
+        node.weak = weak
+        return node
+
+    @classmethod
+    def _wrap(cls, value):
+        if isinstance(value, LazyArray):
+            return value
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, long)):
+            return cls._node('const', (value,), ctypes.c_longlong, True)
+        if isinstance(value, float):
+            return cls._node('const', (value,), ctypes.c_double, True)
+        return cls(value)
+
+    def _promote(self, other):
+        a, b = self.ctype, other.ctype
+        if self.weak != other.weak:
+            # numbers adapt to arrays, floating point numbers force floats
+            array, number = (b, a) if self.weak else (a, b)
+            if number is ctypes.c_double and array not in (ctypes.c_float, ctypes.c_double):
+                return ctypes.c_double
+            return array
+        floats = (ctypes.c_float, ctypes.c_double)
+        if a in floats or b in floats:
+            if ctypes.c_double in (a, b) or ctypes.sizeof(a) > 2 or ctypes.sizeof(b) > 2:
+                return ctypes.c_double
+            return ctypes.c_float
+        return max(a, b, key=self.RANKS.index)
+
+    def _binary(self, op, other, swap=False):
+        other = self._wrap(other)
+        ctype = self._promote(other)
+        if op == '/' and ctype not in (ctypes.c_float, ctypes.c_double):
+            ctype = ctypes.c_double
+        args = (other, self) if swap else (self, other)
+        return self._node(op, args, ctype, self.weak and other.weak)
+
+    def __add__(self, other):
+        return self._binary('+', other)
+
+    def __radd__(self, other):
+        return self._binary('+', other, True)
+
+    def __sub__(self, other):
+        return self._binary('-', other)
+
+    def __rsub__(self, other):
+        return self._binary('-', other, True)
+
+    def __mul__(self, other):
+        return self._binary('*', other)
+
+    def __rmul__(self, other):
+        return self._binary('*', other, True)
+
+    def __truediv__(self, other):
+        return self._binary('/', other)
+
+    def __rtruediv__(self, other):
+        return self._binary('/', other, True)
+
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __neg__(self):
+        return self._node('neg', (self,), self.ctype, self.weak)
+
+    def __abs__(self):
+        return self._node('abs', (self,), self.ctype, self.weak)
+
+    def _emit(self, inputs, consts, temps):
+        """
+        C expression of the graph for element `i`. Collects the
+        input buffers, the numbers and the types of temporary
+        variables into `inputs`, `consts` and `temps`.
+        """
+        if self.op == 'input':
+            data = self.args[0]
+            for index, (other, _) in enumerate(inputs):
+                if other is data:
+                    break
+            else:
+                index = len(inputs)
+                inputs.append((data, self.ctype))
+            return 'p%d[i]' % index
+        if self.op == 'const':
+            consts.append((self.args[0], self.ctype))
+            return 's%d' % (len(consts) - 1)
+        args = [arg._emit(inputs, consts, temps) for arg in self.args]
+        args = [arg if node.ctype is self.ctype else '((%s) %s)' % (TYPE_MAPPER[self.ctype], arg)
+                for arg, node in zip(args, self.args)]
+        if self.op == 'neg':
+            return '(-%s)' % args[0]
+        if self.op == 'abs':
+            temps.append(self.ctype)
+            temp = 't%d' % (len(temps) - 1)
+            return '((%s = %s) < 0 ? -%s : %s)' % (temp, args[0], temp, temp)
+        return '(%s %s %s)' % (args[0], self.op, args[1])
+
+    @classmethod
+    def _kernel(cls, body, intypes, consttypes, restype):
+        """
+        Compiled fused loop with the loop `body`, cached by its shape.
+        """
+        key = (body, intypes, consttypes, restype)
+        with cls._lock:
+            kernel = cls._kernels.get(key)
+            if kernel:
+                return kernel
+            params = ['size_t n']
+            params.extend('const %s *p%d' % (TYPE_MAPPER[ctype], i)
+                          for i, ctype in enumerate(intypes))
+            params.extend('%s s%d' % (TYPE_MAPPER[ctype], i)
+                          for i, ctype in enumerate(consttypes))
+            params.append('%s *out' % TYPE_MAPPER[restype])
+            gen = InlineGenerator()
+            gen.add_topdeclaration('#include <stddef.h>')
+            gen.add_definition(
+                'void fused(%s)\n{\n    size_t i;\n    for (i = 0; i < n; ++i) {\n'
+                '%s\n    }\n}' % (', '.join(params), body))
+            state = (TinyCC.instance or TinyCC()).create_state()
+            state.compile(gen.code)
+            state.relocate()
+            gen.bind_state(state)
+            argtypes = ([ctypes.c_size_t] + [ctypes.c_void_p] * len(intypes) +
+                        list(consttypes) + [ctypes.c_void_p])
+            kernel = state.get_symbol('fused', ctypes.CFUNCTYPE(None, *argtypes))
+            kernel._state = state
+            cls._kernels[key] = kernel
+            return kernel
+
+    def evaluate(self, out=None):
+        """
+        Compute the expression in a single fused loop.
+        Writes into the buffer `out` (must have the result type)
+        or returns a new ctypes array.
+        """
+        inputs, consts, temps = [], [], []
+        expression = self._emit(inputs, consts, temps)
+        body = ''.join('        %s t%d;\n' % (TYPE_MAPPER[ctype], i)
+                       for i, ctype in enumerate(temps))
+        body += '        out[i] = %s;' % expression
+        if not inputs:
+            raise TypeError('expression needs at least one array')
+        pointers, length = [], None
+        for data, ctype in inputs:
+            pointer, nbytes = _buffer_pointer(data)
+            if length is None:
+                length = nbytes // ctypes.sizeof(ctype)
+            elif nbytes // ctypes.sizeof(ctype) != length:
+                raise ValueError('arrays of different length')
+            pointers.append(pointer)
+        if out is None:
+            out = (self.ctype * length)()
+            target = out
+        else:
+            view = memoryview(out)
+            if view.readonly:
+                raise TypeError('out must be writable')
+            target, nbytes = _buffer_pointer(out)
+            if nbytes != length * ctypes.sizeof(self.ctype):
+                raise ValueError('out does not match the result size')
+        kernel = self._kernel(body, tuple(ctype for _, ctype in inputs),
+                              tuple(ctype for _, ctype in consts), self.ctype)
+        kernel(length, *(pointers + [value for value, _ in consts] + [target]))
+        return out
+
+
+_C_IDENTIFIER = re.compile(r'[A-Za-z_]\w*')
+_C_NOISE = re.compile(r'/\*.*?\*/|//[^\n]*|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.S)
+_C_KEYWORDS = frozenset([
+    'auto', 'char', 'const', 'double', 'enum', 'extern', 'float', 'inline',
+    'int', 'long', 'register', 'restrict', 'short', 'signed', 'static',
+    'struct', 'typedef', 'union', 'unsigned', 'void', 'volatile'])
+
+
+def _c_definitions(code):
+    """
+    Scan C code for the names it defines at file scope
+    (functions, variables, tags, typedefs, enum constants and macros).
+    """
+    code = _C_NOISE.sub(' ', code)
+    names = set(re.findall(r'^\s*#\s*define\s+(\w+)', code, re.M))
+    code = re.sub(r'^\s*#.*$', '', code, flags=re.M)
+    for body in re.findall(r'\benum\b[^{;]*\{([^}]*)\}', code):
+        names.update(re.findall(r'(?:^|,)\s*([A-Za-z_]\w*)', body))
+    # strip nested blocks down to file scope
+    scope, depth = [], 0
+    for char in code:
+        if char == '{':
+            depth += 1
+            if depth == 1:
+                scope.append(';')
+        elif char == '}':
+            depth -= 1
+        elif not depth:
+            scope.append(char)
+    for statement in ''.join(scope).split(';'):
+        tags = re.findall(r'\b(?:struct|union|enum)\s+(\w+)', statement)
+        statement = re.sub(r'\b(?:struct|union|enum)\s+\w+', ' ', statement)
+        names.update(tags)
+        if '(' in statement:
+            pointer = re.search(r'\(\s*\*\s*(\w+)\s*\)\s*[([]', statement)
+            found = [pointer] if pointer else [re.search(r'(\w+)\s*\(', statement)]
+        else:
+            found = [re.search(r'(\w+)\s*(?:\[[^\]]*\]\s*)*(?:=.*)?$', part.strip(), re.S)
+                     for part in statement.split(',')]
+        names.update(m.group(1) for m in found
+                     if m and m.group(1) not in _C_KEYWORDS)
+    return names
+
+
+# allocation tracking of `TccStateMemory.track_allocations`, compiled
+# as separate unit into the state, its malloc, calloc, realloc and free
+# take precedence over the C library for the compiled code
+_HEAP_SITES = 1024
+_HEAP_CODE = '''#include <stddef.h>
+#include <string.h>
+
+#define TCC_HEAP_SITES %d
+#define TCC_HEAP_HEADER 16
+
+void *(*tcc_heap_malloc)(size_t);
+void *(*tcc_heap_realloc)(void *, size_t);
+void (*tcc_heap_free)(void *);
+
+struct tcc_heap_stats
+{
+    long long live, peak, allocations, frees, blocks;
+    struct
+    {
+        void *caller;
+        long long bytes, count, live;
+    } sites[TCC_HEAP_SITES];
+} tcc_heap_stats;
+
+/* site of the caller, TCC_HEAP_SITES if the table is full */
+static unsigned tcc_heap_site(void *caller)
+{
+    unsigned i = (unsigned) (((unsigned long long) caller >> 4) * 0x9E3779B1u) %% TCC_HEAP_SITES, n;
+    for (n = 0; n < TCC_HEAP_SITES; ++n, i = (i + 1) %% TCC_HEAP_SITES) {
+        if (tcc_heap_stats.sites[i].caller == caller)
+            return i;
+        if (!tcc_heap_stats.sites[i].caller) {
+            tcc_heap_stats.sites[i].caller = caller;
+            return i;
+        }
+    }
+    return TCC_HEAP_SITES;
+}
+
+static void *tcc_heap_track(char *block, size_t n, void *caller)
+{
+    unsigned site;
+    if (!block)
+        return NULL;
+    site = tcc_heap_site(caller);
+    *(size_t *) block = n;
+    *(unsigned *) (block + sizeof(size_t)) = site;
+    tcc_heap_stats.live += n;
+    tcc_heap_stats.allocations++;
+    tcc_heap_stats.blocks++;
+    if (tcc_heap_stats.live > tcc_heap_stats.peak)
+        tcc_heap_stats.peak = tcc_heap_stats.live;
+    if (site < TCC_HEAP_SITES) {
+        tcc_heap_stats.sites[site].bytes += n;
+        tcc_heap_stats.sites[site].count++;
+        tcc_heap_stats.sites[site].live += n;
+    }
+    return block + TCC_HEAP_HEADER;
+}
+
+static void tcc_heap_untrack(char *block)
+{
+    size_t n = *(size_t *) block;
+    unsigned site = *(unsigned *) (block + sizeof(size_t));
+    tcc_heap_stats.live -= n;
+    tcc_heap_stats.frees++;
+    tcc_heap_stats.blocks--;
+    if (site < TCC_HEAP_SITES)
+        tcc_heap_stats.sites[site].live -= n;
+}
+
+void *malloc(size_t n)
+{
+    return tcc_heap_track(tcc_heap_malloc(n + TCC_HEAP_HEADER), n,
+                          __builtin_return_address(0));
+}
+
+void *calloc(size_t count, size_t n)
+{
+    char *block;
+    if (n && count > ((size_t) -1 - TCC_HEAP_HEADER) / n)
+        return NULL;
+    block = tcc_heap_malloc(count * n + TCC_HEAP_HEADER);
+    if (block)
+        memset(block + TCC_HEAP_HEADER, 0, count * n);
+    return tcc_heap_track(block, count * n, __builtin_return_address(0));
+}
+
+void *realloc(void *p, size_t n)
+{
+    char *block;
+    if (!p)
+        return tcc_heap_track(tcc_heap_malloc(n + TCC_HEAP_HEADER), n,
+                              __builtin_return_address(0));
+    block = tcc_heap_realloc((char *) p - TCC_HEAP_HEADER, n + TCC_HEAP_HEADER);
+    if (!block)
+        return NULL;
+    tcc_heap_untrack(block);
+    return tcc_heap_track(block, n, __builtin_return_address(0));
+}
+
+void free(void *p)
+{
+    if (!p)
+        return;
+    tcc_heap_untrack((char *) p - TCC_HEAP_HEADER);
+    tcc_heap_free((char *) p - TCC_HEAP_HEADER);
+}''' % _HEAP_SITES
+
+
+class _HeapSite(ctypes.Structure):
+    _fields_ = [('caller', ctypes.c_void_p),
+                ('bytes', ctypes.c_longlong),
+                ('count', ctypes.c_longlong),
+                ('live', ctypes.c_longlong)]
+
+
+class _HeapStats(ctypes.Structure):
+    _fields_ = [('live', ctypes.c_longlong),
+                ('peak', ctypes.c_longlong),
+                ('allocations', ctypes.c_longlong),
+                ('frees', ctypes.c_longlong),
+                ('blocks', ctypes.c_longlong),
+                ('sites', _HeapSite * _HEAP_SITES)]
+
+
+class _PerfMap(object):
+    """
+    Writer of the perf map `/tmp/perf-<pid>.map` listing the functions
+    of relocated states for `perf` and other sampling profilers.
+    The file is rewritten with the symbols of the living states
+    whenever a state gets added or freed. All symbols of a state
+    bound a function's size, only the known function names are
+    listed (all symbols if they are not known).
+    """
+    # size of the last symbol of a state (unknown end of code)
+    TAIL = 0x1000
+    # linker generated symbols, only used as boundaries
+    LINKER = re.compile(r'^(_etext|_edata|_end|__bss_start|_DYNAMIC|'
+                        r'_GLOBAL_OFFSET_TABLE_|__(start|stop)_\w+)$')
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _entries(symbols, functions=None):
+        entries = []
+        ordered = sorted((address, name) for name, address in symbols.items())
+        for i, (address, name) in enumerate(ordered):
+            following = ordered[i + 1][0] if i + 1 < len(ordered) else address + _PerfMap.TAIL
+            if functions is None:
+                if _PerfMap.LINKER.match(name):
+                    continue
+            elif name not in functions:
+                continue
+            entries.append((address, min(following - address, _PerfMap.TAIL * 16), name))
+        return entries
+
+    def add(self, key, symbols, functions=None):
+        with self.lock:
+            known = self.states.get(key, ({}, None))[0]
+            known.update(symbols)
+            self.states[key] = (known, functions)
+            self._write()
+
+    def remove(self, key):
+        with self.lock:
+            if self.states.pop(key, None) is not None:
+                self._write()
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+        if self.states:
+            # the child has the same code under another pid
+            self._write()
+
+    def _write(self):
+        path = '/tmp/perf-%d.map' % os.getpid()
+        lines = []
+        for symbols, functions in self.states.values():
+            lines.extend('%x %x %s\n' % entry for entry in self._entries(symbols, functions)
+                         if entry[1] > 0)
+        with open(path + '.tmp', 'w') as f:
+            f.write(''.join(lines))
+        os.rename(path + '.tmp', path)
+
+
+_PERF_MAP = _PerfMap()
+
+# objects holding per process state (locks, threads) by id, see `_after_fork`
+_FORK_HANDLERS = weakref.WeakValueDictionary()
+
+
+def _after_fork():
+    """
+    Reset the per process state in a forked child. Relocated code
+    and bindings stay valid, locks might have been held by threads
+    of the parent and threads don't exist anymore.
+    """
+    LazyArray._lock = threading.Lock()
+    _ScopedStructureBase._scan_lock = threading.Lock()
+    _PERF_MAP._after_fork()
+    for obj in list(_FORK_HANDLERS.values()):
+        obj._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
 
 
 class Declaration(object):
     def __init__(self, code, decl=''):
         self._c_decl = decl
         self._c_code = code
+        self._c_names = _c_definitions(decl + '\n' + code)
+
+
+class InlineGeneratorException(Exception):
+    pass
+
+
+class TccException(Exception):
+    pass
+
+
+class _StoreHeader(ctypes.Structure):
+    _fields_ = [('magic', ctypes.c_char * 8),
+                ('version', ctypes.c_uint32),
+                ('header_size', ctypes.c_uint32),
+                ('record_size', ctypes.c_uint64),
+                ('length', ctypes.c_uint64),
+                # c_ubyte, a c_char array would read up to the first NUL
+                ('fingerprint', ctypes.c_ubyte * 32)]
+
+
+class _RecordStore(object):
+    """
+    File backed array of ScopedStructure records, see
+    `ScopedStructure.create_store` and `ScopedStructure.open_store`.
+
+    The file starts with a header of 64 bytes (magic, version,
+    record size, number of records and the layout fingerprint)
+    followed by the records. The records are memory mapped and
+    accessed in place, the OS loads the pages on first access.
+    Stores opened read-only are mapped copy-on-write, changes
+    are not written back.
+    """
+    MAGIC = b'TCCSTORE'
+    VERSION = 1
+    HEADER_SIZE = 64
+
+    def __init__(self, cls, path, writable):
+        self.cls = cls
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        try:
+            self._map()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _map(self):
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_COPY)
+        if len(self._mmap) < self.HEADER_SIZE:
+            raise InlineGeneratorException('"%s" is not a record store' % self.path)
+        header = _StoreHeader.from_buffer(self._mmap)
+        if header.magic != self.MAGIC or header.version != self.VERSION:
+            raise InlineGeneratorException('"%s" is not a record store' % self.path)
+        if (header.record_size != ctypes.sizeof(self.cls) or
+                bytes(header.fingerprint) != self.cls._fingerprint()):
+            raise InlineGeneratorException(
+                'layout of "%s" does not match %s' % (self.path, self.cls.__name__))
+        if header.header_size + header.length * header.record_size > len(self._mmap):
+            raise InlineGeneratorException('record store "%s" is truncated' % self.path)
+        self.header = header
+        self.records = (self.cls * header.length).from_buffer(self._mmap, header.header_size)
+
+    @classmethod
+    def _header(cls, struct, length):
+        header = _StoreHeader(cls.MAGIC, cls.VERSION, cls.HEADER_SIZE,
+                              ctypes.sizeof(struct), length)
+        header.fingerprint[:] = bytearray(struct._fingerprint())
+        return bytes(header).ljust(cls.HEADER_SIZE, b'\0')
+
+    @classmethod
+    def create(cls, struct, path, length):
+        with open(path, 'wb') as f:
+            f.write(cls._header(struct, length))
+            # sparse file, the records start zeroed
+            f.truncate(cls.HEADER_SIZE + length * ctypes.sizeof(struct))
+        return cls(struct, path, True)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def __setitem__(self, index, value):
+        self.records[index] = value
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def resize(self, length):
+        """
+        Change the number of records. Records obtained before
+        must not be used anymore, the file gets remapped.
+        """
+        if not self.writable:
+            raise InlineGeneratorException('record store is read-only')
+        self.flush()
+        self._unmap()
+        self._file.truncate(self.HEADER_SIZE + length * ctypes.sizeof(self.cls))
+        self._file.seek(0)
+        self._file.write(self._header(self.cls, length))
+        self._file.flush()
+        self._map()
+
+    def flush(self):
+        """
+        Write changed records back to the file.
+        """
+        if self.writable and self._mmap is not None:
+            self._mmap.flush()
+
+    def _unmap(self):
+        self.records = self.header = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # records still referenced, the mapping goes with the last of them
+            pass
+        self._mmap = None
+
+    def close(self):
+        """
+        Flush and unmap the store.
+        """
+        if self._file.closed:
+            return
+        self.flush()
+        self._unmap()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Registry(object):
+    """
+    Address to object registry of ScopedStructure instances.
+    Resolves pointers passed from C back to the Python objects,
+    entries vanish with their objects (weak references).
+    Unknown addresses get a new view by `from_address`.
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.objects = {}
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, obj):
+        address = ctypes.addressof(obj)
+        objects = self.objects
+
+        def remove(ref):
+            if objects.get(address) is ref:
+                del objects[address]
+        objects[address] = weakref.ref(obj, remove)
+
+    def lookup(self, address):
+        if not address:
+            return None
+        ref = self.objects.get(address)
+        if ref is not None:
+            obj = ref()
+            if obj is not None:
+                self.hits += 1
+                return obj
+        self.misses += 1
+        return self.cls.from_address(address)
+
+    @property
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'size': len(self.objects), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits) / calls if calls else 0.0}
+
+
+class _ScopedStructureBase(type(ctypes.Structure)):
+    """
+    Metaclass for a ScopedStructure class.
+    It creates the C declarations for the struct and their
+    c_method and callable_method decorated methods.
+
+    Naming:
+    A Python class name `Test` translates to `struct Test`
+    in C (no typedef declaration is added).
+    A decorated instance method `Test.method(self, ...) is
+    declared as `Test_method(struct Test * self, ...)` in C.
+
+    Memory layout:
+    `_pack_` works like for ctypes structures. A `_layout_` dict controls
+    the placement of the fields for both ctypes and C:
+        'align'     - alignment of the struct, the size gets padded to it
+        'cacheline' - cache line size (default 64)
+        'order'     - 'size' sorts the fields by alignment to avoid holes,
+                      a list of field names places these fields first (hot fields)
+        'isolate'   - fields placed on a cache line of their own (against
+                      false sharing), implies 'align' of the cache line size
+    Padding members are named `_padN`. The generated C code checks the
+    offsets and the size against ctypes at compile time, also for
+    structures embedding such a structure. ctypes can align a type
+    from Python 3.13 on, before the C struct gets no alignment either
+    (embedded structs are placed at their natural alignment).
+    Use `Test.aligned_array(n)` for instances at an aligned address.
+
+    Record scans:
+    `Test.scan`, `Test.select` and `Test.project` filter arrays of records
+    in a compiled loop, the predicate is a Python expression over the
+    field names (see `_PyTranslator`), e.g. `'a > 10 and b < a'`.
+    The compiled loops are cached per class and expression.
+
+    Record stores:
+    `Test.create_store(path, length)` and `Test.open_store(path)` map
+    a file of records into memory, opening is instant regardless of
+    the size and the records are used in place (see `_RecordStore`).
+
+    Object registry:
+    Instances of classes with callable_method methods are registered
+    by address on creation, callbacks from C resolve the original
+    Python object (with its Python attributes) without allocating
+    a new wrapper. Use `Test.register(obj)` for objects created by
+    `from_buffer` and such.
+
+    Wire layout:
+    With a `_wire_` declaration compiled pack and unpack routines
+    for a binary wire format are generated (see `_WireCodec`),
+    usable with `Test.wire_pack` and `Test.wire_unpack`.
+    """
+    _state_ = None
+    _sname_ = ''
+    _fields_ = []
+    # output bytes per call of a scan kernel
+    SCAN_CHUNK = 1 << 16
+
+    def __new__(mcs, name, bases, dct):
+        layout = dct.get('_layout_')
+        if layout:
+            dct = dict(dct)
+            dct['_fields_'] = mcs._layout_fields(
+                dct.get('_fields_', []), layout, dct.get('_pack_'))
+            align = layout.get('align')
+            if align and _CTYPES_ALIGN:
+                dct['_align_'] = align
+        return super(_ScopedStructureBase, mcs).__new__(mcs, name, bases, dct)
+
+    def __init__(cls, name, bases, dct):
+        dct['_c_decl'] = _ScopedStructureBase._c_decl
+        dct['_c_code'] = _ScopedStructureBase._c_code
+        super(_ScopedStructureBase, cls).__init__(name, bases, dct)
+        if cls.__name__ not in ('CStructure', 'ScopedStructure'):
+            if not cls._sname_:
+                cls._sname_ = cls.__name__
+            TYPE_MAPPER[cls] = 'struct %s' % cls._sname_
+            TYPE_MAPPER[ctypes.POINTER(cls)] = 'struct %s *' % cls._sname_
+            cls._state_._add_part(cls)
+            for k, v in dct.items():
+                if (isinstance(v, types.FunctionType) and
+                        getattr(v, '_cmethod', False)):
+                    v._proto(ctypes.POINTER(cls), cls._sname_)
+            if dct.get('_wire_'):
+                cls._wire_codec_ = _WireCodec(cls)
+                cls._state_._add_wire_codec(cls._wire_codec_)
+
+    def __call__(cls, *args, **kwargs):
+        obj = super(_ScopedStructureBase, cls).__call__(*args, **kwargs)
+        registry = getattr(cls, '_registry_', None)
+        if registry is not None:
+            registry.register(obj)
+        return obj
+
+    def _registry(cls):
+        registry = cls.__dict__.get('_registry_')
+        if registry is None:
+            registry = cls._registry_ = _Registry(cls)
+        return registry
+
+    def register(cls, obj):
+        """
+        Register `obj` for callable_method callbacks.
+        """
+        cls._registry().register(obj)
+
+    @property
+    def registry_stats(cls):
+        """
+        Size and hit rate of the address registry used by callable_method.
+        """
+        return cls._registry().stats
+
+    def _wire(cls):
+        codec = cls.__dict__.get('_wire_codec_')
+        if not codec:
+            raise InlineGeneratorException('no wire layout declared')
+        return codec
+
+    def wire_unpack(cls, data, count=None):
+        """
+        Decode the records in the buffer `data` with the `_wire_` layout
+        in one native call. Decodes all complete records or `count` at most.
+        Returns a ctypes array of the records and the consumed bytes.
+        """
+        return cls._wire().unpack(cls._state_._bound(), data, count)
+
+    def wire_pack(cls, records):
+        """
+        Encode `records` (array or sequence of instances) with the
+        `_wire_` layout in one native call. Returns the encoded bytes.
+        """
+        return cls._wire().pack(cls._state_._bound(), records)
+
+    @property
+    def wire_stats(cls):
+        """
+        Throughput of the last `wire_unpack` or `wire_pack` call.
+        """
+        return cls._wire().stats
+
+    @property
+    def _c_decl(cls):
+        return 'struct %s;' % cls._sname_
+
+    @property
+    def _c_struct(cls):
+        """
+        Plain struct declaration, the explicit padding members
+        make up the layout (used for cffi).
+        """
+        return cls._c_body + ';'
+
+    @property
+    def _c_body(cls):
+        def members(fields):
+            for name, ctype in fields:
+                if issubclass(ctype, ctypes.Array):
+                    yield '    %s %s[%s];' % (
+                        TYPE_MAPPER[ctype._type_], name, ctype._length_)
+                else:
+                    yield '    %s %s;' % (TYPE_MAPPER[ctype], name)
+
+        return 'struct %s\n{\n%s\n}' % (cls._sname_, '\n'.join(members(cls._fields_)))
+
+    @property
+    def _c_code(cls):
+        layout = cls.__dict__.get('_layout_') or {}
+        pack = cls.__dict__.get('_pack_')
+        attribute = ''
+        if layout.get('align') and _CTYPES_ALIGN:
+            # without `_align_` ctypes relies on the explicit padding only
+            attribute = ' __attribute__((aligned(%d)))' % layout['align']
+        code = '%s%s;' % (cls._c_body, attribute)
+        if pack:
+            code = '#pragma pack(push, %d)\n%s\n#pragma pack(pop)' % (pack, code)
+        if cls._checked_layout():
+            # compile time check of the layout against ctypes
+            checks = ['sizeof(struct %s) == %d' % (cls._sname_, ctypes.sizeof(cls))]
+            checks.extend('(unsigned long) &((struct %s *) 0)->%s == %d' % (
+                cls._sname_, name, getattr(cls, name).offset) for name, _ in cls._fields_)
+            code += '\ntypedef char %s__layout[(%s) ? 1 : -1];' % (
+                cls._sname_, ' &&\n    '.join(checks))
+        return code
+
+    def _checked_layout(cls):
+        """
+        Whether the layout gets checked at compile time, true for
+        a `_layout_` or `_pack_` of the structure or of a member.
+        """
+        if cls.__dict__.get('_layout_') is not None or cls.__dict__.get('_pack_'):
+            return True
+        for field in cls._fields_:
+            ctype = field[1]
+            while issubclass(ctype, ctypes.Array):
+                ctype = ctype._type_
+            if isinstance(ctype, _ScopedStructureBase) and ctype._checked_layout():
+                return True
+        return False
+
+    @staticmethod
+    def _layout_fields(fields, layout, pack=None):
+        """
+        Apply the `_layout_` settings to `fields`, returns the
+        reordered fields with explicit padding members.
+        """
+        if any(len(field) > 2 for field in fields):
+            raise InlineGeneratorException('_layout_ does not support bitfields')
+        line = layout.get('cacheline', 64)
+        isolate = set(layout.get('isolate', ()))
+        align = layout.get('align', line if isolate else None)
+        names = [name for name, _ in fields]
+        for name in isolate:
+            if name not in names:
+                raise InlineGeneratorException('unknown field "%s" to isolate' % name)
+        order = layout.get('order')
+        if order == 'size':
+            # largest alignment first to avoid padding holes
+            fields = sorted(fields, key=lambda field: -ctypes.alignment(field[1]))
+        elif order:
+            for name in order:
+                if name not in names:
+                    raise InlineGeneratorException('unknown field "%s" in order' % name)
+            fields = ([field for name in order for field in fields if field[0] == name] +
+                      [field for field in fields if field[0] not in order])
+
+        result, offset, largest = [], 0, 1
+
+        def pad(size):
+            result.append(('_pad%d' % len(result), ctypes.c_ubyte * size))
+
+        for name, ctype in fields:
+            alignment = ctypes.alignment(ctype)
+            if pack:
+                alignment = min(alignment, pack)
+            largest = max(largest, alignment)
+            offset = (offset + alignment - 1) // alignment * alignment
+            if name in isolate and offset % line:
+                pad(line - offset % line)
+                offset += line - offset % line
+            result.append((name, ctype))
+            offset += ctypes.sizeof(ctype)
+            if name in isolate and offset % line:
+                pad(line - offset % line)
+                offset += line - offset % line
+        if align:
+            size = (offset + largest - 1) // largest * largest
+            if size % align:
+                pad(align - size % align)
+        return result
+
+    def aligned_array(cls, length):
+        """
+        Array of `length` instances placed at the alignment
+        of the `_layout_` (the cache line size by default).
+        """
+        layout = cls.__dict__.get('_layout_') or {}
+        align = layout.get('align') or layout.get('cacheline', 64)
+        array_type = cls * length
+        memory = bytearray(ctypes.sizeof(array_type) + align)
+        offset = -ctypes.addressof((ctypes.c_char * len(memory)).from_buffer(memory)) % align
+        return array_type.from_buffer(memory, offset)
+
+    def _scan_kernel(cls, kind, where, expression=None):
+        """
+        Compiled scan loop over records of `cls` for the predicate `where`,
+        cached per class. `kind` is 'scan' (indices), 'select' (records)
+        or 'project' (values of `expression`).
+        """
+        key = (kind, where, expression)
+        with _ScopedStructureBase._scan_lock:
+            kernels = cls.__dict__.get('_scan_kernels_')
+            if kernels is None:
+                kernels = cls._scan_kernels_ = {}
+            kernel = kernels.get(key)
+            if kernel:
+                return kernel
+            # fields by offset, no struct declaration needed
+            names = {}
+            for name, ctype in cls._fields_:
+                offset = getattr(cls, name).offset
+                if issubclass(ctype, ctypes.Array) and ctype._type_ in TYPE_MAPPER:
+                    names[name] = ('((const %s *) (r + %d))' % (
+                        TYPE_MAPPER[ctype._type_], offset), ctypes.POINTER(ctype._type_))
+                elif issubclass(ctype, ctypes._SimpleCData) and ctype in TYPE_MAPPER:
+                    names[name] = ('(*(const %s *) (r + %d))' % (
+                        TYPE_MAPPER[ctype], offset), ctype)
+            translator = _PyTranslator(names, {}, lambda name: getattr(ctypes, name, None))
+
+            def compile_expression(source):
+                try:
+                    node = ast.parse(source.strip(), mode='eval').body
+                except SyntaxError as e:
+                    raise InlineGeneratorException('invalid expression %r: %s' % (source, e))
+                return translator.expr(node), translator.expr_type(node)
+
+            test = compile_expression(where)[0] if where else '1'
+            restype = None
+            if kind == 'scan':
+                out, store = 'size_t *out', 'out[k++] = i;'
+            elif kind == 'select':
+                out, store = 'char *out', 'memcpy(out + k++ * %d, r, %d);' % (
+                    ctypes.sizeof(cls), ctypes.sizeof(cls))
+            else:
+                value, restype = compile_expression(expression)
+                if restype is None or _PyTranslator.is_pointer(restype):
+                    raise InlineGeneratorException('projection needs a scalar expression')
+                out, store = '%s *out' % TYPE_MAPPER[restype], 'out[k++] = %s;' % value
+            # temporaries of the translated expressions
+            temps = ''.join('        %s %s;\n' % (TYPE_MAPPER[ctype], name)
+                            for name, ctype in translator.locals.items())
+            gen = InlineGenerator()
+            gen.add_topdeclaration('#include <stddef.h>\n#include <string.h>')
+            gen.add_definition(
+                'size_t scan(const char *records, size_t start, size_t n, %s)\n{\n'
+                '    size_t i, k = 0;\n'
+                '    for (i = start; i < n; ++i) {\n'
+                '        const char *r = records + i * %d;\n'
+                '%s'
+                '        if (%s)\n'
+                '            %s\n'
+                '    }\n'
+                '    return k;\n}' % (out, ctypes.sizeof(cls), temps, test, store))
+            state = (TinyCC.instance or TinyCC()).create_state()
+            state.compile(gen.code)
+            state.relocate()
+            gen.bind_state(state)
+            kernel = state.get_symbol('scan', ctypes.CFUNCTYPE(
+                ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_size_t,
+                ctypes.c_void_p))
+            kernel._state = state
+            kernel.restype_ = restype
+            kernels[key] = kernel
+            return kernel
+
+    def _scan(cls, records, kind, where, expression, ctype):
+        data, nbytes = _buffer_pointer(records)
+        if nbytes % ctypes.sizeof(cls):
+            raise ValueError('buffer is not a multiple of the record size')
+        length = nbytes // ctypes.sizeof(cls)
+        kernel = cls._scan_kernel(kind, where, expression)
+        ctype = kernel.restype_ or ctype
+        # scan in chunks, the result only takes the memory of the matches
+        chunk = max(1, cls.SCAN_CHUNK // ctypes.sizeof(ctype))
+        buffer = (ctype * chunk)()
+        result = bytearray()
+        for start in range(0, length, chunk):
+            count = kernel(data, start, min(start + chunk, length), buffer)
+            result += ctypes.string_at(buffer, count * ctypes.sizeof(ctype))
+        return (ctype * (len(result) // ctypes.sizeof(ctype))).from_buffer(result)
+
+    def scan(cls, records, where):
+        """
+        Indices (a c_size_t array) of the records matching the predicate
+        `where`, a Python expression over the scalar and array fields,
+        e.g. `Test.scan(records, 'a > 10 and b < a')`.
+        `records` is a ctypes array or buffer of `cls` records.
+        """
+        return cls._scan(records, 'scan', where, None, ctypes.c_size_t)
+
+    def select(cls, records, where):
+        """
+        Compacted array of copies of the records matching `where`.
+        """
+        return cls._scan(records, 'select', where, None, cls)
+
+    def project(cls, records, expression, where=None):
+        """
+        Array of the values of `expression` over the fields for the
+        records matching `where` (all records without), e.g.
+        `Test.project(records, 'a * b', 'b > 0')`. The element type
+        is inferred from the expression.
+        """
+        return cls._scan(records, 'project', where, expression, None)
+
+    def _fingerprint(cls):
+        """
+        Digest of the memory layout, recorded in record stores.
+        """
+        def member(ctype, field):
+            name, ftype = field[:2]
+            descriptor = getattr(ctype, name)
+            text = '%s@%d:%s' % (name, descriptor.offset, describe(ftype))
+            if len(field) > 2:
+                # bit offset and width, older Pythons encode the offset in `size`
+                text += '.%d/%d' % (getattr(descriptor, 'bit_offset', descriptor.size & 0xffff),
+                                    field[2])
+            return text
+
+        def describe(ctype):
+            if issubclass(ctype, ctypes.Array):
+                return '%s[%d]' % (describe(ctype._type_), ctype._length_)
+            if issubclass(ctype, (ctypes.Structure, ctypes.Union)):
+                return '{%s}' % ';'.join(member(ctype, field) for field in ctype._fields_)
+            if _PyTranslator.is_pointer(ctype) or ctype._type_ in 'PzZO':
+                raise InlineGeneratorException(
+                    'pointer fields can not be stored in %s' % cls.__name__)
+            return '%s%d' % (ctype._type_, ctypes.sizeof(ctype))
+        layout = '%s %d %s' % (sys.byteorder, ctypes.sizeof(cls), describe(cls))
+        return hashlib.sha256(layout.encode('utf-8')).digest()
+
+    def create_store(cls, path, length=0):
+        """
+        Create the file `path` with `length` zeroed records and return
+        the writable store (see `_RecordStore`). Pointer fields are
+        not supported.
+        """
+        return _RecordStore.create(cls, path, length)
+
+    def open_store(cls, path, writable=False):
+        """
+        Memory map the record store `path`, the layout fingerprint
+        in its header must match `cls`. The records are accessed in
+        place, `store.records` is a ctypes array of `cls` usable as
+        argument of C functions and with `scan`, `select` and `project`.
+        """
+        return _RecordStore(cls, path, writable)
+
+
+_ScopedStructureBase._scan_lock = threading.Lock()
+
+
+class _PyTranslator(object):
+    """
+    Translator for a restricted numeric subset of Python into a C body.
+
+    Supported are scalar locals, pointer indexing, arithmetic, comparisons,
+    boolean operators, conditional expressions, `if`/`while`, `for` loops
+    over `range` with a constant step, `break`, `continue`, `return`,
+    tuple assignment and calls to other C visible functions of the
+    generator. Calling a ctype like `c_int(x)` or `float(x)` casts the value.
+
+    Types of locals are inferred from their assignments (floating point
+    wins over integer, wider wins over narrower) or taken from a ctype
+    annotation (`x: c_double = 0`).
+
+    Integer `//` and `%` round towards negative infinity like in Python.
+    A `for` loop over `range` with a negative step or a signed bound
+    counts with a signed type even if other bounds are unsigned.
+
+    NOTE: `and`/`or` yield the truth value only.
+    """
+    OPS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+           ast.FloorDiv: '/', ast.Mod: '%', ast.LShift: '<<',
+           ast.RShift: '>>', ast.BitOr: '|', ast.BitXor: '^',
+           ast.BitAnd: '&'}
+    CMPOPS = {ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=',
+              ast.Gt: '>', ast.GtE: '>='}
+    UNARYOPS = {ast.USub: '-', ast.UAdd: '+', ast.Invert: '~', ast.Not: '!'}
+    FLOATS = (ctypes.c_double, ctypes.c_float)
+    UNSIGNED = 'BHILQ?'
+
+    def __init__(self, names, functions, lookup=None):
+        # names:     name --> (C expression, ctype) of predefined names
+        # functions: name --> (restype, argtypes) of callable C functions
+        # lookup:    resolver for other names (e.g. function globals)
+        self.names = dict(names)
+        self.functions = functions
+        self.lookup = lookup or (lambda name: None)
+        self.locals = {}
+        self.fixed = {}
+        self.temps = 0
+        self.restype = None
+
+    def error(self, node, msg):
+        line = getattr(node, 'lineno', None)
+        if line is not None:
+            msg = '%s (line %d)' % (msg, line)
+        return InlineGeneratorException(msg)
+
+    # type helpers
+
+    @staticmethod
+    def is_pointer(ctype):
+        return (ctype in (ctypes.c_char_p, ctypes.c_wchar_p, ctypes.c_void_p) or
+                isinstance(ctype, type) and issubclass(ctype, ctypes._Pointer))
+
+    def unify(self, node, a, b):
+        if a is None or a is b:
+            return b
+        if b is None:
+            return a
+        if self.is_pointer(a) or self.is_pointer(b):
+            raise self.error(node, 'incompatible types %s and %s' % (
+                TYPE_MAPPER.get(a, a), TYPE_MAPPER.get(b, b)))
+        if a in self.FLOATS or b in self.FLOATS:
+            if ctypes.c_double in (a, b) or a not in self.FLOATS or b not in self.FLOATS:
+                return ctypes.c_double
+            return ctypes.c_float
+        if self.is_unsigned(a) != self.is_unsigned(b):
+            # like Python, `u - 3 < 0` must not wrap around
+            return ctypes.c_longlong
+        return b if ctypes.sizeof(b) > ctypes.sizeof(a) else a
+
+    def mixed(self, a, b):
+        """
+        Integer operand types of different signedness, these
+        are computed as long long.
+        """
+        return (a is not None and b is not None and
+                not self.is_pointer(a) and not self.is_pointer(b) and
+                a not in self.FLOATS and b not in self.FLOATS and
+                self.is_unsigned(a) != self.is_unsigned(b))
+
+    def element(self, node, ctype):
+        if ctype is ctypes.c_char_p:
+            return ctypes.c_char
+        if ctype is ctypes.c_wchar_p:
+            return ctypes.c_wchar
+        if isinstance(ctype, type) and issubclass(ctype, ctypes._Pointer):
+            return ctype._type_
+        raise self.error(node, 'cannot index non pointer type')
+
+    def resolve(self, node):
+        if isinstance(node, ast.Name):
+            return self.lookup(node.id)
+        if isinstance(node, ast.Attribute):
+            return getattr(self.resolve(node.value), node.attr, None)
+
+    @staticmethod
+    def is_ctype(value):
+        try:
+            return value is not None and value in TYPE_MAPPER
+        except TypeError:
+            return False
+
+    def ctype_of(self, node):
+        value = self.resolve(node)
+        if self.is_ctype(value):
+            return value
+        raise self.error(node, 'expected a ctype annotation')
+
+    def constant(self, node):
+        # ast.Constant for Python >= 3.8, ast.Num/NameConstant before
+        for attr in ('value', 'n'):
+            if hasattr(node, attr):
+                return getattr(node, attr)
+
+    def is_constant(self, node):
+        return type(node).__name__ in ('Constant', 'Num', 'NameConstant')
+
+    def subscript(self, node):
+        index = node.slice
+        if type(index).__name__ == 'Index':
+            index = index.value
+        return index
+
+    # type inference of locals
+
+    def infer(self, stmts):
+        """
+        Infer the types of all locals in `stmts` until nothing changes.
+        """
+        for _ in range(10):
+            before = dict(self.locals)
+            for stmt in stmts:
+                self.infer_stmt(stmt)
+            if before == self.locals:
+                return
+        raise InlineGeneratorException('cannot infer local types')
+
+    def infer_target(self, target, ctype):
+        if isinstance(target, ast.Name):
+            name = target.id
+            if name in self.names or name in self.fixed:
+                return
+            self.locals[name] = self.unify(target, self.locals.get(name), ctype)
+        elif isinstance(target, ast.Tuple):
+            raise self.error(target, 'nested tuple assignment not supported')
+
+    def infer_stmt(self, node):
+        if isinstance(node, ast.Assign):
+            value = node.value
+            for target in node.targets:
+                if isinstance(target, ast.Tuple):
+                    if (not isinstance(value, ast.Tuple) or
+                            len(value.elts) != len(target.elts)):
+                        raise self.error(node, 'tuple assignment needs a tuple of same length')
+                    for t, v in zip(target.elts, value.elts):
+                        self.infer_target(t, self.expr_type(v))
+                else:
+                    self.infer_target(target, self.expr_type(value))
+        elif type(node).__name__ == 'AnnAssign':
+            if not isinstance(node.target, ast.Name):
+                raise self.error(node, 'annotation only supported for names')
+            self.locals[node.target.id] = self.ctype_of(node.annotation)
+            self.fixed[node.target.id] = True
+        elif isinstance(node, ast.AugAssign):
+            if isinstance(node.target, ast.Name):
+                ctype = self.binop_type(node, self.expr_type(node.target),
+                                        node.op, self.expr_type(node.value))
+                self.infer_target(node.target, ctype)
+        elif isinstance(node, ast.For):
+            self.infer_target(node.target, self.range_type(node))
+            for stmt in node.body:
+                self.infer_stmt(stmt)
+        elif isinstance(node, (ast.If, ast.While)):
+            for stmt in node.body + node.orelse:
+                self.infer_stmt(stmt)
+
+    @classmethod
+    def is_unsigned(cls, ctype):
+        return getattr(ctype, '_type_', None) in tuple(cls.UNSIGNED)
+
+    def range_step(self, node):
+        args = node.iter.args
+        if len(args) < 3:
+            return 1
+        step_node = args[2]
+        negative = (isinstance(step_node, ast.UnaryOp) and
+                    isinstance(step_node.op, ast.USub))
+        if negative:
+            step_node = step_node.operand
+        if not self.is_constant(step_node) or not isinstance(self.constant(step_node), int):
+            raise self.error(node, 'range step must be an integer constant')
+        step = -self.constant(step_node) if negative else self.constant(step_node)
+        if not step:
+            raise self.error(node, 'range step must not be zero')
+        return step
+
+    def range_type(self, node):
+        it = node.iter
+        if (not isinstance(it, ast.Call) or not isinstance(it.func, ast.Name) or
+                it.func.id not in ('range', 'xrange') or not 1 <= len(it.args) <= 3):
+            raise self.error(node, 'only for loops over range are supported')
+        if not isinstance(node.target, ast.Name):
+            raise self.error(node, 'for loop target must be a name')
+        ctype, signed = None, self.range_step(node) < 0
+        for arg in it.args[:2]:
+            argtype = self.expr_type(arg)
+            if argtype in self.FLOATS or self.is_pointer(argtype):
+                raise self.error(node, 'range arguments must be integers')
+            if (argtype is not None and not self.is_unsigned(argtype) and
+                    not (self.is_constant(arg) and self.constant(arg) >= 0)):
+                signed = True
+            ctype = self.unify(node, ctype, argtype)
+        if signed and self.is_unsigned(ctype):
+            # an unsigned counter would never get below 0
+            return ctypes.c_longlong
+        return ctype
+
+    def binop_type(self, node, left, op, right):
+        if isinstance(op, ast.Div):
+            return ctypes.c_double
+        if type(op) not in self.OPS:
+            raise self.error(node, 'operator not supported')
+        if self.is_pointer(left) and isinstance(op, (ast.Add, ast.Sub)):
+            if self.is_pointer(right):
+                return ctypes.c_ssize_t
+            return left
+        if isinstance(op, (ast.FloorDiv, ast.Mod, ast.LShift, ast.RShift,
+                           ast.BitOr, ast.BitXor, ast.BitAnd)):
+            if left in self.FLOATS or right in self.FLOATS:
+                raise self.error(node, 'operator needs integer operands')
+        return self.unify(node, left, right)
+
+    def expr_type(self, node):
+        """
+        Returns the ctype of the expression `node`.
+        """
+        if self.is_constant(node):
+            value = self.constant(node)
+            if isinstance(value, bool) or value is None:
+                return ctypes.c_int
+            if isinstance(value, float):
+                return ctypes.c_double
+            if isinstance(value, int) or type(value).__name__ == 'long':
+                if -2**31 <= value < 2**31:
+                    return ctypes.c_int
+                return ctypes.c_longlong
+            raise self.error(node, 'unsupported constant')
+        if isinstance(node, ast.Name):
+            if node.id in self.names:
+                return self.names[node.id][1]
+            if node.id in self.locals:
+                return self.locals[node.id]
+            if node.id in ('True', 'False'):
+                return ctypes.c_int
+            # not inferred yet
+            return None
+        if isinstance(node, ast.BinOp):
+            left = self.expr_type(node.left)
+            right = self.expr_type(node.right)
+            if left is None or right is None:
+                return left or right
+            return self.binop_type(node, left, node.op, right)
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                return ctypes.c_int
+            return self.expr_type(node.operand)
+        if isinstance(node, (ast.Compare, ast.BoolOp)):
+            return ctypes.c_int
+        if isinstance(node, ast.IfExp):
+            return self.unify(node, self.expr_type(node.body),
+                              self.expr_type(node.orelse))
+        if isinstance(node, ast.Subscript):
+            ctype = self.expr_type(node.value)
+            return ctype and self.element(node, ctype)
+        if isinstance(node, ast.Call):
+            return self.call_type(node)
+        raise self.error(node, '%s not supported' % type(node).__name__)
+
+    def call_type(self, node):
+        if not isinstance(node.func, ast.Name):
+            raise self.error(node, 'only calls of plain names are supported')
+        name = node.func.id
+        if node.keywords:
+            raise self.error(node, 'keyword arguments not supported')
+        if name in ('int', 'long'):
+            return ctypes.c_long
+        if name == 'float':
+            return ctypes.c_double
+        if name == 'abs':
+            return self.expr_type(node.args[0])
+        if name in self.functions:
+            return self.functions[name][0]
+        ctype = self.lookup(name)
+        if self.is_ctype(ctype):
+            return ctype
+        raise self.error(node, 'unknown function "%s"' % name)
+
+    # code emitting
+
+    def expr(self, node):
+        """
+        Returns the C expression of `node`.
+        """
+        if self.is_constant(node):
+            value = self.constant(node)
+            if isinstance(value, bool) or value is None:
+                return '1' if value else '0'
+            return repr(value)
+        if isinstance(node, ast.Name):
+            if node.id in self.names:
+                return self.names[node.id][0]
+            if node.id in self.locals:
+                return node.id
+            if node.id in ('True', 'False'):
+                return '1' if node.id == 'True' else '0'
+            raise self.error(node, 'unknown name "%s"' % node.id)
+        if isinstance(node, ast.BinOp):
+            left = self.expr(node.left)
+            right = self.expr(node.right)
+            if self.mixed(self.expr_type(node.left), self.expr_type(node.right)):
+                left, right = '(long long) %s' % left, '(long long) %s' % right
+            if isinstance(node.op, ast.Div):
+                return '((double) %s / %s)' % (left, right)
+            ctype = self.expr_type(node)
+            if isinstance(node.op, (ast.FloorDiv, ast.Mod)) and not self.is_unsigned(ctype):
+                return self.floor_op(node.op, ctype, left, right)
+            return '(%s %s %s)' % (left, self.OPS[type(node.op)], right)
+        if isinstance(node, ast.UnaryOp):
+            return '(%s%s)' % (self.UNARYOPS[type(node.op)], self.expr(node.operand))
+        if isinstance(node, ast.BoolOp):
+            op = ' && ' if isinstance(node.op, ast.And) else ' || '
+            return '(%s)' % op.join(self.expr(value) for value in node.values)
+        if isinstance(node, ast.Compare):
+            parts = []
+            left, lefttype = self.expr(node.left), self.expr_type(node.left)
+            last = len(node.ops) - 1
+            for i, (op, right) in enumerate(zip(node.ops, node.comparators)):
+                if type(op) not in self.CMPOPS:
+                    raise self.error(node, 'comparison not supported')
+                value, righttype = self.expr(right), self.expr_type(right)
+                cast = '(long long) ' if self.mixed(lefttype, righttype) else ''
+                if i < last and not isinstance(right, ast.Name) and not self.is_constant(right):
+                    # evaluated once like in Python
+                    temp = self.temp(righttype)
+                    parts.append('(%s = %s, %s%s %s %s%s)' % (
+                        temp, value, cast, left, self.CMPOPS[type(op)], cast, temp))
+                    value = temp
+                else:
+                    parts.append('%s%s %s %s%s' % (cast, left, self.CMPOPS[type(op)],
+                                                   cast, value))
+                left, lefttype = value, righttype
+            return '(%s)' % ' && '.join(parts)
+        if isinstance(node, ast.IfExp):
+            return '(%s ? %s : %s)' % (self.expr(node.test), self.expr(node.body),
+                                       self.expr(node.orelse))
+        if isinstance(node, ast.Subscript):
+            self.expr_type(node)
+            return '%s[%s]' % (self.expr(node.value), self.expr(self.subscript(node)))
+        if isinstance(node, ast.Call):
+            ctype = self.call_type(node)
+            args = [self.expr(arg) for arg in node.args]
+            name = node.func.id
+            if name in self.functions:
+                if len(args) != len(self.functions[name][1]):
+                    raise self.error(node, 'wrong number of arguments for "%s"' % name)
+                return '%s(%s)' % (name, ', '.join(args))
+            if len(args) != 1:
+                raise self.error(node, '"%s" takes exactly one argument' % name)
+            if name == 'abs':
+                temp = self.temp(ctype)
+                return '(%s = %s, %s < 0 ? -%s : %s)' % (temp, args[0], temp, temp, temp)
+            return '((%s) %s)' % (TYPE_MAPPER[ctype], args[0])
+        raise self.error(node, '%s not supported' % type(node).__name__)
+
+    def floor_op(self, op, ctype, left, right):
+        """
+        Signed integer `//` or `%` rounding towards negative infinity.
+        """
+        a, b, r = self.temp(ctype), self.temp(ctype), self.temp(ctype)
+        if isinstance(op, ast.FloorDiv):
+            return ('(%s = %s, %s = %s, %s = %s / %s, '
+                    '(%s * %s != %s && (%s < 0) != (%s < 0)) ? %s - 1 : %s)' % (
+                        a, left, b, right, r, a, b, r, b, a, a, b, r, r))
+        return ('(%s = %s, %s = %s, %s = %s %% %s, '
+                '(%s != 0 && (%s < 0) != (%s < 0)) ? %s + %s : %s)' % (
+                    a, left, b, right, r, a, b, r, r, b, r, b, r))
+
+    def temp(self, ctype):
+        name = '_py%d' % self.temps
+        self.temps += 1
+        self.locals[name] = ctype
+        return name
+
+    def assign(self, target):
+        if isinstance(target, ast.Name):
+            if target.id in self.names and target.id not in self.fixed:
+                return self.names[target.id][0]
+            return target.id
+        if isinstance(target, ast.Subscript):
+            return self.expr(target)
+        raise self.error(target, 'unsupported assignment target')
+
+    def block(self, stmts, indent):
+        lines = []
+        for stmt in stmts:
+            lines.extend(self.stmt(stmt, indent))
+        return lines
+
+    def stmt(self, node, indent):
+        pad = '    ' * indent
+        if isinstance(node, ast.Expr):
+            if self.is_constant(node.value) or type(node.value).__name__ == 'Str':
+                # docstrings and other bare constants
+                return []
+            return [pad + self.expr(node.value) + ';']
+        if isinstance(node, ast.Assign):
+            if isinstance(node.targets[0], ast.Tuple):
+                temps = []
+                lines = []
+                for value in node.value.elts:
+                    name = self.temp(self.expr_type(value))
+                    temps.append(name)
+                    lines.append('%s%s = %s;' % (pad, name, self.expr(value)))
+                for target in node.targets:
+                    for t, name in zip(target.elts, temps):
+                        lines.append('%s%s = %s;' % (pad, self.assign(t), name))
+                return lines
+            targets = ' = '.join(self.assign(t) for t in node.targets)
+            return ['%s%s = %s;' % (pad, targets, self.expr(node.value))]
+        if type(node).__name__ == 'AnnAssign':
+            if node.value is None:
+                return []
+            return ['%s%s = %s;' % (pad, node.target.id, self.expr(node.value))]
+        if isinstance(node, ast.AugAssign):
+            op = type(node.op)
+            if op not in self.OPS:
+                raise self.error(node, 'operator not supported')
+            target = self.assign(node.target)
+            value = self.expr(node.value)
+            if op is ast.Div:
+                value = '(double) %s' % value
+            if op in (ast.FloorDiv, ast.Mod):
+                ctype = self.binop_type(node, self.expr_type(node.target), node.op,
+                                        self.expr_type(node.value))
+                if not self.is_unsigned(ctype):
+                    return ['%s%s = %s;' % (pad, target,
+                                            self.floor_op(node.op, ctype, target, value))]
+            return ['%s%s %s= %s;' % (pad, target, self.OPS[op], value)]
+        if isinstance(node, ast.If):
+            lines = ['%sif %s {' % (pad, self.condition(node.test))]
+            lines.extend(self.block(node.body, indent + 1))
+            orelse = node.orelse
+            while len(orelse) == 1 and isinstance(orelse[0], ast.If):
+                lines.append('%s} else if %s {' % (pad, self.condition(orelse[0].test)))
+                lines.extend(self.block(orelse[0].body, indent + 1))
+                orelse = orelse[0].orelse
+            if orelse:
+                lines.append(pad + '} else {')
+                lines.extend(self.block(orelse, indent + 1))
+            lines.append(pad + '}')
+            return lines
+        if isinstance(node, ast.While):
+            if node.orelse:
+                raise self.error(node, 'while/else not supported')
+            lines = ['%swhile %s {' % (pad, self.condition(node.test))]
+            lines.extend(self.block(node.body, indent + 1))
+            lines.append(pad + '}')
+            return lines
+        if isinstance(node, ast.For):
+            return self.for_range(node, indent)
+        if isinstance(node, ast.Return):
+            if node.value is None:
+                return [pad + 'return;']
+            if self.restype is None:
+                raise self.error(node, 'cannot return a value from a void function')
+            return ['%sreturn %s;' % (pad, self.expr(node.value))]
+        if isinstance(node, ast.Break):
+            return [pad + 'break;']
+        if isinstance(node, ast.Continue):
+            return [pad + 'continue;']
+        if isinstance(node, ast.Pass):
+            return []
+        raise self.error(node, '%s statement not supported' % type(node).__name__)
+
+    def condition(self, node):
+        cond = self.expr(node)
+        if not cond.startswith('('):
+            cond = '(%s)' % cond
+        return cond
+
+    def for_range(self, node, indent):
+        pad = '    ' * indent
+        if node.orelse:
+            raise self.error(node, 'for/else not supported')
+        args = node.iter.args
+        start, stop = '0', None
+        if len(args) == 1:
+            stop = self.expr(args[0])
+        else:
+            start, stop = self.expr(args[0]), self.expr(args[1])
+        step = self.range_step(node)
+        # range arguments are evaluated once and the loop variable
+        # is reassigned each round like in Python
+        ctype = self.range_type(node)
+        counter = self.temp(ctype)
+        end = self.temp(ctype)
+        lines = ['%sfor (%s = %s, %s = %s; %s %s %s; %s += %d) {' % (
+            pad, counter, start, end, stop, counter, '<' if step > 0 else '>',
+            end, counter, step)]
+        lines.append('%s    %s = %s;' % (pad, self.assign(node.target), counter))
+        lines.extend(self.block(node.body, indent + 1))
+        lines.append(pad + '}')
+        return lines
+
+    def translate(self, node, restype):
+        """
+        Translate the function definition `node` into a C body.
+        """
+        self.restype = restype
+        self.infer(node.body)
+        lines = self.block(node.body, 1)
+        declarations = []
+        seen = []
+        for name, ctype in self.locals.items():
+            if ctype is None:
+                raise InlineGeneratorException('cannot infer type of "%s"' % name)
+            if ctype not in seen:
+                seen.append(ctype)
+        for ctype in seen:
+            names = [name for name, t in self.locals.items() if t is ctype]
+            if self.is_pointer(ctype):
+                declarations.extend('    %s%s;' % (TYPE_MAPPER[ctype], name)
+                                    for name in names)
+            else:
+                declarations.append('    %s %s;' % (TYPE_MAPPER[ctype], ', '.join(names)))
+        return '\n' + '\n'.join(declarations + lines)
+
+
+# helper functions for the wire codecs (emitted once per generator)
+_WIRE_HELPERS = '''
+/* returns bytes read, 0 if incomplete or (size_t) -1 if malformed */
+static size_t _wire_get_varint(const unsigned char *p, const unsigned char *end,
+                               unsigned long long *value)
+{
+    size_t i;
+    unsigned long long v = 0;
+    for (i = 0; i < 10; ++i) {
+        if (p + i >= end)
+            return 0;
+        v |= (unsigned long long) (p[i] & 0x7f) << (7 * i);
+        if (!(p[i] & 0x80)) {
+            *value = v;
+            return i + 1;
+        }
+    }
+    return (size_t) -1;
+}
+
+/* writes `value` to `p` if not NULL, returns bytes needed */
+static size_t _wire_put_varint(unsigned char *p, unsigned long long value)
+{
+    size_t i = 0;
+    do {
+        if (p)
+            p[i] = (unsigned char) ((value & 0x7f) | (value > 0x7f ? 0x80 : 0));
+        value >>= 7;
+        ++i;
+    } while (value);
+    return i;
+}
+
+/* copies `count` elements of `size` bytes, optionally byte swapped */
+static void _wire_copy(unsigned char *dst, const unsigned char *src,
+                       size_t count, size_t size, int swap)
+{
+    size_t i, j;
+    for (i = 0; i < count; ++i, dst += size, src += size)
+        for (j = 0; j < size; ++j)
+            dst[j] = src[swap ? size - 1 - j : j];
+}
 
+/* reads an unsigned integer of `size` bytes */
+static unsigned long long _wire_get_uint(const unsigned char *p, size_t size, int big)
+{
+    size_t i;
+    unsigned long long v = 0;
+    for (i = 0; i < size; ++i)
+        v |= (unsigned long long) p[big ? size - 1 - i : i] << (8 * i);
+    return v;
+}
 
-class InlineGeneratorException(Exception):
-    pass
+/* writes an unsigned integer of `size` bytes */
+static void _wire_put_uint(unsigned char *p, unsigned long long v, size_t size, int big)
+{
+    size_t i;
+    for (i = 0; i < size; ++i)
+        p[big ? size - 1 - i : i] = (unsigned char) (v >> (8 * i));
+}
+'''
 
 
-class TccException(Exception):
-    pass
+class _WireCodec(object):
+    """
+    Generated pack/unpack routines for a ScopedStructure with a `_wire_` layout.
 
+    The layout is declared with the class attribute `_wire_`:
 
-class _ScopedStructureBase(type(ctypes.Structure)):
+        _wire_ = {
+            'endian': 'big',        # 'little', 'big' or 'native' (default)
+            'packed': True,         # no alignment padding on the wire (default)
+            'fields': {             # per field encoding, default is 'fixed'
+                'id': 'varint',
+                'name': 'prefixed',
+                'data': ('prefixed16', 'data_len'),
+            }
+        }
+
+    Field encodings:
+        'fixed'      - the raw field value in the wire byte order
+        'varint'     - LEB128 encoded integer, signed types are zigzag encoded
+        'prefixed'   - array elements preceded by a varint element count
+        'prefixed8', 'prefixed16', 'prefixed32'
+                     - same with a fixed size unsigned count
+
+    For prefixed fields the count is taken from an optional length
+    field given as second tuple item, otherwise elements up to the
+    first zero element are written (string semantics).
+    Unused array elements are zeroed when unpacking.
+
+    In C the routines are declared as
+
+        long long Name_wire_unpack(const void *buf, size_t len,
+                                   struct Name *out, size_t count, size_t *consumed);
+        long long Name_wire_pack(const struct Name *records, size_t count,
+                                 void *buf, size_t len);
+
+    `Name_wire_unpack` returns the number of complete records decoded
+    (only counted if `out` is NULL) or -1 for malformed input,
+    `Name_wire_pack` returns the number of bytes written (only counted
+    if `buf` is NULL) or -1 if the buffer is too small or a prefixed
+    length exceeds its field.
     """
-    Metaclass for a ScopedStructure class.
-    It creates the C declarations for the struct and their
-    c_method and callable_method decorated methods.
+    ENCODINGS = {'fixed': None, 'varint': None, 'prefixed': None,
+                 'prefixed8': 1, 'prefixed16': 2, 'prefixed32': 4}
 
-    Naming:
-    A Python class name `Test` translates to `struct Test`
-    in C (no typedef declaration is added).
-    A decorated instance method `Test.method(self, ...) is
-    declared as `Test_method(struct Test * self, ...)` in C.
+    def __init__(self, cls):
+        self.cls = cls
+        self.name = cls._sname_
+        self._c_owner = cls._sname_
+        wire = cls._wire_
+        endian = wire.get('endian', 'native')
+        if endian not in ('little', 'big', 'native'):
+            raise InlineGeneratorException('unknown endianness %r' % endian)
+        self.big = (endian == 'big' or endian == 'native' and sys.byteorder == 'big')
+        self.swap = int(endian != 'native' and endian != sys.byteorder)
+        self.packed = wire.get('packed', True)
+        self.fields = []
+        names = [name for name, _ in cls._fields_]
+        encodings = dict(wire.get('fields', {}))
+        for name in encodings:
+            if name not in names:
+                raise InlineGeneratorException('unknown wire field "%s"' % name)
+        for name, ctype in cls._fields_:
+            encoding = encodings.get(name, 'fixed')
+            length = None
+            if isinstance(encoding, tuple):
+                encoding, length = encoding
+                if length not in names:
+                    raise InlineGeneratorException('unknown length field "%s"' % length)
+            if encoding not in self.ENCODINGS:
+                raise InlineGeneratorException('unknown wire encoding %r' % encoding)
+            self.fields.append(self._check(name, ctype, encoding, length))
+        self.fixed_size = None
+        if all(field[2] == 'fixed' for field in self.fields):
+            self.fixed_size = self._fixed_size()
+        self.unpack_name = '%s_wire_unpack' % self.name
+        self.pack_name = '%s_wire_pack' % self.name
+        self.unpack_proto = (
+            'long long %s(const void *buf, size_t len, struct %s *out, '
+            'size_t count, size_t *consumed)' % (self.unpack_name, self.name))
+        self.pack_proto = (
+            'long long %s(const struct %s *records, size_t count, '
+            'void *buf, size_t len)' % (self.pack_name, self.name))
+        self._c_decl = '%s;\n%s;' % (self.unpack_proto, self.pack_proto)
+        self._c_code = self._unpack_code() + '\n\n' + self._pack_code()
+        self._c_func = None
+        self.stats = {}
+
+    @staticmethod
+    def _scalar(ctype):
+        return (issubclass(ctype, ctypes._SimpleCData) and
+                ctype._type_ in 'bBhHiIlLqQ?cfdu')
+
+    def _check(self, name, ctype, encoding, length):
+        element = ctype
+        count = None
+        if issubclass(ctype, ctypes.Array):
+            element, count = ctype._type_, ctype._length_
+        if not self._scalar(element):
+            raise InlineGeneratorException(
+                'field "%s" cannot be serialized' % name)
+        if encoding == 'varint' and (count is not None or element._type_ not in 'bBhHiIlLqQ'):
+            raise InlineGeneratorException(
+                'varint field "%s" must be an integer' % name)
+        if encoding.startswith('prefixed') and count is None:
+            raise InlineGeneratorException(
+                'prefixed field "%s" must be an array' % name)
+        return name, element, encoding, count, length
+
+    def _fixed_size(self):
+        size = 0
+        for _, element, _, count, _ in self.fields:
+            if not self.packed:
+                align = ctypes.alignment(element)
+                size = (size + align - 1) // align * align
+            size += ctypes.sizeof(element) * (count or 1)
+        if not self.packed:
+            align = ctypes.alignment(self.cls)
+            size = (size + align - 1) // align * align
+        return size
+
+    def _align(self, lines, align, pack):
+        if self.packed or align == 1:
+            return
+        if pack:
+            lines.append('        while ((pos - start) %% %d) {' % align)
+            lines.append('            if (p) { if (pos >= len) return -1; p[pos] = 0; }')
+            lines.append('            ++pos;')
+            lines.append('        }')
+        else:
+            lines.append('        while ((size_t) (p - start) %% %d) {' % align)
+            lines.append('            if (p >= end) goto done;')
+            lines.append('            ++p;')
+            lines.append('        }')
+
+    def _unpack_code(self):
+        lines = [self.unpack_proto, '{',
+                 '    const unsigned char *p = (const unsigned char *) buf;',
+                 '    const unsigned char *end = p + len;',
+                 '    const unsigned char *start;',
+                 '    unsigned long long v;',
+                 '    size_t n, records = 0;',
+                 '    struct %s tmp, *r;' % self.name,
+                 '    if (consumed) *consumed = 0;',
+                 '    while (records < count) {',
+                 '        start = p;',
+                 '        r = out ? out + records : &tmp;']
+        for name, element, encoding, count, length in self.fields:
+            size = ctypes.sizeof(element)
+            ctype_c = TYPE_MAPPER[element]
+            self._align(lines, ctypes.alignment(element), False)
+            if encoding == 'fixed':
+                total = size * (count or 1)
+                lines.append('        if ((size_t) (end - p) < %d) goto done;' % total)
+                lines.append('        _wire_copy((unsigned char *) &r->%s, p, %d, %d, %d);' % (
+                    name, count or 1, size, self.swap))
+                lines.append('        p += %d;' % total)
+            elif encoding == 'varint':
+                lines.append('        n = _wire_get_varint(p, end, &v);')
+                lines.append('        if (!n) goto done;')
+                lines.append('        if (n == (size_t) -1) goto error;')
+                if element._type_ in 'bhilq':
+                    lines.append('        r->%s = (%s) ((v >> 1) ^ (0 - (v & 1)));' % (name, ctype_c))
+                else:
+                    lines.append('        r->%s = (%s) v;' % (name, ctype_c))
+                lines.append('        p += n;')
+            else:
+                width = self.ENCODINGS[encoding]
+                if width is None:
+                    lines.append('        n = _wire_get_varint(p, end, &v);')
+                    lines.append('        if (!n) goto done;')
+                    lines.append('        if (n == (size_t) -1) goto error;')
+                    lines.append('        p += n;')
+                else:
+                    lines.append('        if ((size_t) (end - p) < %d) goto done;' % width)
+                    lines.append('        v = _wire_get_uint(p, %d, %d);' % (width, int(self.big)))
+                    lines.append('        p += %d;' % width)
+                lines.append('        if (v > %d) goto error;' % count)
+                lines.append('        if ((size_t) (end - p) < v * %d) goto done;' % size)
+                lines.append('        _wire_copy((unsigned char *) r->%s, p, v, %d, %d);' % (
+                    name, size, self.swap))
+                lines.append('        for (n = v; n < %d; ++n) r->%s[n] = 0;' % (count, name))
+                lines.append('        p += v * %d;' % size)
+                if length:
+                    lines.append('        r->%s = v;' % length)
+        self._align(lines, ctypes.alignment(self.cls), False)
+        lines.extend(['        ++records;',
+                      '        if (consumed) *consumed = p - (const unsigned char *) buf;',
+                      '        continue;',
+                      '    done:',
+                      '        break;',
+                      '    }',
+                      '    return records;',
+                      'error:',
+                      '    if (consumed) *consumed = start - (const unsigned char *) buf;',
+                      '    return -1;',
+                      '}'])
+        return '\n'.join(lines)
+
+    def _pack_code(self):
+        lines = [self.pack_proto, '{',
+                 '    unsigned char *p = (unsigned char *) buf;',
+                 '    size_t i, n, pos = 0, start;',
+                 '    unsigned long long v;',
+                 '    const struct %s *r;' % self.name,
+                 '    for (i = 0; i < count; ++i) {',
+                 '        r = records + i;',
+                 '        start = pos;']
+        for name, element, encoding, count, length in self.fields:
+            size = ctypes.sizeof(element)
+            self._align(lines, ctypes.alignment(element), True)
+            if encoding == 'fixed':
+                total = size * (count or 1)
+                lines.append('        if (p) {')
+                lines.append('            if (pos + %d > len) return -1;' % total)
+                lines.append('            _wire_copy(p + pos, (const unsigned char *) &r->%s, %d, %d, %d);' % (
+                    name, count or 1, size, self.swap))
+                lines.append('        }')
+                lines.append('        pos += %d;' % total)
+            elif encoding == 'varint':
+                if element._type_ in 'bhilq':
+                    lines.append('        v = ((unsigned long long) r->%s << 1) ^ '
+                                 '(unsigned long long) -(r->%s < 0);' % (name, name))
+                else:
+                    lines.append('        v = (unsigned long long) r->%s;' % name)
+                lines.append('        n = _wire_put_varint(0, v);')
+                lines.append('        if (p) {')
+                lines.append('            if (pos + n > len) return -1;')
+                lines.append('            _wire_put_varint(p + pos, v);')
+                lines.append('        }')
+                lines.append('        pos += n;')
+            else:
+                if length:
+                    lines.append('        v = (unsigned long long) r->%s;' % length)
+                    lines.append('        if (v > %d) return -1;' % count)
+                else:
+                    lines.append('        for (v = 0; v < %d && r->%s[v]; ++v);' % (count, name))
+                width = self.ENCODINGS[encoding]
+                if width is None:
+                    lines.append('        n = _wire_put_varint(0, v);')
+                    lines.append('        if (p) {')
+                    lines.append('            if (pos + n > len) return -1;')
+                    lines.append('            _wire_put_varint(p + pos, v);')
+                    lines.append('        }')
+                    lines.append('        pos += n;')
+                else:
+                    if count >> (8 * width):
+                        lines.append('        if (v >> %d) return -1;' % (8 * width))
+                    lines.append('        if (p) {')
+                    lines.append('            if (pos + %d > len) return -1;' % width)
+                    lines.append('            _wire_put_uint(p + pos, v, %d, %d);' % (width, int(self.big)))
+                    lines.append('        }')
+                    lines.append('        pos += %d;' % width)
+                lines.append('        if (p) {')
+                lines.append('            if (pos + v * %d > len) return -1;' % size)
+                lines.append('            _wire_copy(p + pos, (const unsigned char *) r->%s, v, %d, %d);' % (
+                    name, size, self.swap))
+                lines.append('        }')
+                lines.append('        pos += v * %d;' % size)
+        self._align(lines, ctypes.alignment(self.cls), True)
+        lines.extend(['    }', '    return pos;', '}'])
+        return '\n'.join(lines)
+
+    def _functions(self, state):
+        if state is None:
+            raise InlineGeneratorException('generator is not bound to a state')
+        if not self._c_func or self._c_func[0] is not state:
+            unpack = state.get_symbol(self.unpack_name, ctypes.CFUNCTYPE(
+                ctypes.c_longlong, ctypes.c_void_p, ctypes.c_size_t,
+                ctypes.POINTER(self.cls), ctypes.c_size_t, ctypes.POINTER(ctypes.c_size_t)))
+            pack = state.get_symbol(self.pack_name, ctypes.CFUNCTYPE(
+                ctypes.c_longlong, ctypes.POINTER(self.cls), ctypes.c_size_t,
+                ctypes.c_void_p, ctypes.c_size_t))
+            self._c_func = (state, unpack, pack)
+        return self._c_func[1:]
+
+    def _report(self, records, size, start):
+        elapsed = _clock() - start
+        self.stats = {
+            'records': records,
+            'bytes': size,
+            'seconds': elapsed,
+            'records_per_second': records / elapsed if elapsed else float('inf'),
+            'bytes_per_second': size / elapsed if elapsed else float('inf')
+        }
+
+    def unpack(self, state, data, count=None):
+        unpack, _ = self._functions(state)
+        pointer, size = _buffer_pointer(data)
+        start = _clock()
+        if count is None:
+            if self.fixed_size:
+                count = size // self.fixed_size
+            else:
+                count = unpack(pointer, size, None, size, None)
+                if count < 0:
+                    raise InlineGeneratorException('malformed wire data')
+        records = (self.cls * count)()
+        consumed = ctypes.c_size_t()
+        result = unpack(pointer, size, records, count, ctypes.byref(consumed))
+        if result < 0:
+            raise InlineGeneratorException(
+                'malformed wire data at offset %d' % consumed.value)
+        if result < count:
+            records = (self.cls * result).from_buffer(records)
+        self._report(result, consumed.value, start)
+        return records, consumed.value
+
+    def pack(self, state, records):
+        _, pack = self._functions(state)
+        if not isinstance(records, ctypes.Array):
+            records = (self.cls * len(records))(*records)
+        start = _clock()
+        count = len(records)
+        if self.fixed_size:
+            size = self.fixed_size * count
+        else:
+            size = pack(records, count, None, 0)
+            if size < 0:
+                raise InlineGeneratorException('record not serializable')
+        buf = ctypes.create_string_buffer(size)
+        if pack(records, count, buf, size) != size:
+            raise InlineGeneratorException('record not serializable')
+        self._report(count, size, start)
+        return buf.raw
+
+
+# C templates of the containers, `%(N)s` is the container name,
+# `%(T)s` the element type, `%(K)s`/`%(V)s` key and value type
+_CONTAINER_RESERVE = '''static int %(N)s__reserve(struct %(N)s *c, size_t capacity)
+{
+    %(T)s *data;
+    if (capacity <= c->capacity)
+        return 0;
+    data = (%(T)s *) realloc(c->data, capacity * sizeof(%(T)s));
+    if (!data)
+        return -1;
+    c->data = data;
+    c->capacity = capacity;
+    return 0;
+}
+
+static int %(N)s__grow(struct %(N)s *c, size_t need)
+{
+    size_t capacity = c->capacity ? c->capacity : 8;
+    while (capacity < need)
+        capacity *= 2;
+    return %(N)s__reserve(c, capacity);
+}'''
+
+_CONTAINER_LESS = '''static int %(N)s__less(%(T)s a, %(T)s b)
+{
+    return %(LESS)s;
+}'''
+
+_CONTAINER_SORT = _CONTAINER_LESS + '''
+
+static void %(N)s__sort(%(T)s *data, size_t n)
+{
+    %(T)s pivot, tmp;
+    long long i, j;
+    while (n > 16) {
+        /* quicksort, pivot is the median of three */
+        size_t mid = (n - 1) / 2;
+        if (%(N)s__less(data[mid], data[0])) {
+            tmp = data[0]; data[0] = data[mid]; data[mid] = tmp;
+        }
+        if (%(N)s__less(data[n - 1], data[0])) {
+            tmp = data[0]; data[0] = data[n - 1]; data[n - 1] = tmp;
+        }
+        if (%(N)s__less(data[n - 1], data[mid])) {
+            tmp = data[mid]; data[mid] = data[n - 1]; data[n - 1] = tmp;
+        }
+        pivot = data[mid];
+        i = -1;
+        j = n;
+        for (;;) {
+            do ++i; while (%(N)s__less(data[i], pivot));
+            do --j; while (%(N)s__less(pivot, data[j]));
+            if (i >= j)
+                break;
+            tmp = data[i]; data[i] = data[j]; data[j] = tmp;
+        }
+        /* recurse into the smaller part */
+        if ((size_t) j + 1 < n - j - 1) {
+            %(N)s__sort(data, j + 1);
+            data += j + 1;
+            n -= j + 1;
+        } else {
+            %(N)s__sort(data + j + 1, n - j - 1);
+            n = j + 1;
+        }
+    }
+    for (i = 1; i < (long long) n; ++i) {
+        tmp = data[i];
+        for (j = i; j > 0 && %(N)s__less(tmp, data[j - 1]); --j)
+            data[j] = data[j - 1];
+        data[j] = tmp;
+    }
+}'''
+
+_VECTOR_FUNCTIONS = [
+    ('reserve', 'int', [('v', 'self'), ('capacity', 'size')], '''
+    return %(N)s__reserve(v, capacity);'''),
+    ('push', 'int', [('v', 'self'), ('value', 'T')], '''
+    if (v->size == v->capacity && %(N)s__grow(v, v->size + 1))
+        return -1;
+    v->data[v->size++] = value;
+    return 0;'''),
+    ('extend', 'int', [('v', 'self'), ('values', 'T*'), ('n', 'size')], '''
+    if (v->size + n > v->capacity && %(N)s__grow(v, v->size + n))
+        return -1;
+    memcpy(v->data + v->size, values, n * sizeof(%(T)s));
+    v->size += n;
+    return 0;'''),
+    ('pop', 'T', [('v', 'self')], '''
+    return v->data[--v->size];'''),
+    ('clear', None, [('v', 'self')], '''
+    v->size = 0;'''),
+    ('free', None, [('v', 'self')], '''
+    free(v->data);
+    v->data = NULL;
+    v->size = v->capacity = 0;'''),
+]
+
+_SORT_FUNCTIONS = [
+    ('sort', None, [('data', 'T*'), ('n', 'size')], '''
+    %(N)s__sort(data, n);'''),
+    ('search', 'index', [('data', 'T*'), ('n', 'size'), ('key', 'T')], '''
+    size_t lo = 0, hi = n, mid;
+    while (lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        if (%(N)s__less(data[mid], key))
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    if (lo < n && !%(N)s__less(key, data[lo]))
+        return lo;
+    return -1;'''),
+]
+
+_QUEUE_CODE = _CONTAINER_LESS + '''
+
+static int %(N)s__push(struct %(N)s *q, %(T)s value)
+{
+    size_t i, parent;
+    if (q->size == q->capacity && %(N)s__grow(q, q->size + 1))
+        return -1;
+    for (i = q->size++; i > 0; i = parent) {
+        parent = (i - 1) / 2;
+        if (!%(N)s__less(value, q->data[parent]))
+            break;
+        q->data[i] = q->data[parent];
+    }
+    q->data[i] = value;
+    return 0;
+}'''
+
+_QUEUE_FUNCTIONS = [
+    ('push', 'int', [('q', 'self'), ('value', 'T')], '''
+    return %(N)s__push(q, value);'''),
+    ('push_many', 'size', [('q', 'self'), ('values', 'T*'), ('n', 'size')], '''
+    size_t i;
+    for (i = 0; i < n; ++i)
+        if (%(N)s__push(q, values[i]))
+            break;
+    return i;'''),
+    ('peek', 'T', [('q', 'self')], '''
+    return q->data[0];'''),
+    ('pop', 'T', [('q', 'self')], '''
+    %(T)s top = q->data[0], last = q->data[--q->size];
+    size_t i = 0, child;
+    while ((child = 2 * i + 1) < q->size) {
+        if (child + 1 < q->size && %(N)s__less(q->data[child + 1], q->data[child]))
+            ++child;
+        if (!%(N)s__less(q->data[child], last))
+            break;
+        q->data[i] = q->data[child];
+        i = child;
+    }
+    if (q->size)
+        q->data[i] = last;
+    return top;'''),
+    ('clear', None, [('q', 'self')], '''
+    q->size = 0;'''),
+    ('free', None, [('q', 'self')], '''
+    free(q->data);
+    q->data = NULL;
+    q->size = q->capacity = 0;'''),
+]
+
+_MAP_CODE = '''static int %(N)s__eq(const %(K)s *a, const %(K)s *b)
+{
+    return %(EQ)s;
+}
+
+static unsigned long long %(N)s__mix(unsigned long long h, const void *data, size_t n)
+{
+    const unsigned char *p = (const unsigned char *) data;
+    size_t i;
+    for (i = 0; i < n; ++i)
+        h = (h ^ p[i]) * 0x100000001b3ULL;
+    return h;
+}
+
+static size_t %(N)s__hash(%(K)s key)
+{
+    unsigned long long h = 0xcbf29ce484222325ULL;%(NORMALIZE)s%(HASH)s
+    return (size_t) (h ^ (h >> 32));
+}
+
+/* slot of `key` or the empty slot to insert it */
+static size_t %(N)s__find(const struct %(N)s *m, %(K)s key)
+{
+    size_t mask = m->capacity - 1, i = %(N)s__hash(key) & mask;
+    while (m->used[i] && !%(N)s__eq(&m->keys[i], &key))
+        i = (i + 1) & mask;
+    return i;
+}
+
+static int %(N)s__resize(struct %(N)s *m, size_t capacity)
+{
+    struct %(N)s grown;
+    size_t i, j;
+    grown.keys = (%(K)s *) malloc(capacity * sizeof(%(K)s));
+    grown.values = (%(V)s *) malloc(capacity * sizeof(%(V)s));
+    grown.used = (unsigned char *) calloc(capacity, 1);
+    if (!grown.keys || !grown.values || !grown.used) {
+        free(grown.keys);
+        free(grown.values);
+        free(grown.used);
+        return -1;
+    }
+    grown.size = m->size;
+    grown.capacity = capacity;
+    for (i = 0; i < m->capacity; ++i) {
+        if (m->used[i]) {
+            j = %(N)s__find(&grown, m->keys[i]);
+            grown.used[j] = 1;
+            grown.keys[j] = m->keys[i];
+            grown.values[j] = m->values[i];
+        }
+    }
+    free(m->keys);
+    free(m->values);
+    free(m->used);
+    *m = grown;
+    return 0;
+}
+
+static int %(N)s__put(struct %(N)s *m, %(K)s key, %(V)s value)
+{
+    size_t i;
+    /* keep the load factor below 0.7 */
+    if ((m->size + 1) * 10 > m->capacity * 7 &&
+            %(N)s__resize(m, m->capacity ? m->capacity * 2 : 16))
+        return -1;
+    i = %(N)s__find(m, key);
+    if (!m->used[i]) {
+        m->used[i] = 1;
+        m->keys[i] = key;
+        m->size++;
+    }
+    m->values[i] = value;
+    return 0;
+}'''
+
+_MAP_FUNCTIONS = [
+    ('put', 'int', [('m', 'self'), ('key', 'K'), ('value', 'V')], '''
+    return %(N)s__put(m, key, value);'''),
+    ('get', 'int', [('m', 'self'), ('key', 'K'), ('value', 'V*')], '''
+    size_t i;
+    if (!m->capacity)
+        return 0;
+    i = %(N)s__find(m, key);
+    if (!m->used[i])
+        return 0;
+    if (value)
+        *value = m->values[i];
+    return 1;'''),
+    ('remove', 'int', [('m', 'self'), ('key', 'K')], '''
+    size_t mask, i, j, home;
+    if (!m->capacity)
+        return 0;
+    mask = m->capacity - 1;
+    i = %(N)s__find(m, key);
+    if (!m->used[i])
+        return 0;
+    /* backward shift deletion, moves following entries into the hole */
+    for (j = (i + 1) & mask; m->used[j]; j = (j + 1) & mask) {
+        home = %(N)s__hash(m->keys[j]) & mask;
+        if (i <= j ? (home <= i || home > j) : (home <= i && home > j)) {
+            m->keys[i] = m->keys[j];
+            m->values[i] = m->values[j];
+            i = j;
+        }
+    }
+    m->used[i] = 0;
+    m->size--;
+    return 1;'''),
+    ('put_many', 'size', [('m', 'self'), ('keys', 'K*'), ('values', 'V*'), ('n', 'size')], '''
+    size_t i;
+    for (i = 0; i < n; ++i)
+        if (%(N)s__put(m, keys[i], values[i]))
+            break;
+    return i;'''),
+    ('items', 'size', [('m', 'self'), ('keys', 'K*'), ('values', 'V*')], '''
+    size_t i, n = 0;
+    for (i = 0; i < m->capacity; ++i) {
+        if (m->used[i]) {
+            if (keys)
+                keys[n] = m->keys[i];
+            if (values)
+                values[n] = m->values[i];
+            ++n;
+        }
+    }
+    return n;'''),
+    ('clear', None, [('m', 'self')], '''
+    if (m->capacity)
+        memset(m->used, 0, m->capacity);
+    m->size = 0;'''),
+    ('free', None, [('m', 'self')], '''
+    free(m->keys);
+    free(m->values);
+    free(m->used);
+    m->keys = NULL;
+    m->values = NULL;
+    m->used = NULL;
+    m->size = m->capacity = 0;'''),
+]
+
+
+def _key_fields(ctype, prefix):
     """
-    _state_ = None
-    _sname_ = ''
-    _fields_ = []
+    Members of the hash map key structure `ctype` to hash and compare,
+    `(expression, bitfield)` pairs. Recurses into structures and arrays
+    of structures, leaving out padding.
+    """
+    for field in ctype._fields_:
+        name, ftype = field[:2]
+        expr = prefix + '.' + name if prefix else name
+        if len(field) > 2:
+            yield expr, True
+            continue
+        element, indices = ftype, ['']
+        while issubclass(element, ctypes.Array):
+            indices = ['%s[%d]' % (index, i) for index in indices for i in range(element._length_)]
+            element = element._type_
+        if issubclass(element, ctypes.Structure):
+            for index in indices:
+                for leaf in _key_fields(element, expr + index):
+                    yield leaf
+        else:
+            yield expr, False
 
-    def __init__(cls, name, bases, dct):
-        dct['_c_decl'] = _ScopedStructureBase._c_decl
-        dct['_c_code'] = _ScopedStructureBase._c_code
-        super(_ScopedStructureBase, cls).__init__(name, bases, dct)
-        if cls.__name__ not in ('CStructure', 'ScopedStructure'):
-            if not cls._sname_:
-                cls._sname_ = cls.__name__
-            TYPE_MAPPER[cls] = 'struct %s' % cls._sname_
-            TYPE_MAPPER[ctypes.POINTER(cls)] = 'struct %s *' % cls._sname_
-            cls._state_.parts.append(cls)
-            for k, v in dct.items():
-                if (isinstance(v, types.FunctionType) and
-                        getattr(v, '_cmethod', False)):
-                    v._proto(ctypes.POINTER(cls), cls._sname_)
 
-    @property
-    def _c_decl(cls):
-        return 'struct %s;' % cls._sname_
+_PIPELINE_CODE = r'''
+#if defined(__i386__) || defined(__x86_64__)
+/* x86 keeps the order of stores and of loads, the ring buffers only need a compiler barrier */
+#define %(N)s__barrier() __asm__ __volatile__("" ::: "memory")
+#else
+#define %(N)s__barrier() __sync_synchronize()
+#endif
+
+struct %(N)s__queue
+{
+    char *data;
+    size_t *lengths;
+    size_t capacity;
+    volatile size_t head;
+    volatile size_t tail;
+    volatile int closed;
+    size_t high_water;
+};
+
+struct %(N)s__stage
+{
+    pthread_t thread;
+    int index;
+    size_t size;
+    struct %(N)s__queue *in;
+    struct %(N)s__queue *out;
+    unsigned long long counters[6];
+};
+
+struct %(N)s__runtime
+{
+    struct %(N)s__queue queues[%(S)d + 1];
+    struct %(N)s__stage stages[%(S)d];
+    int threads;
+};
+
+static size_t %(N)s__call(int index, char *in, size_t length, char *out, size_t size)
+{
+    switch (index) {
+%(CALLS)s
+    }
+    return 0;
+}
+
+static unsigned long long %(N)s__now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (unsigned long long) ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+static void %(N)s__wait(unsigned *spins)
+{
+    struct timespec ts = {0, 50000};
+    if (++*spins < 64)
+        %(N)s__barrier();
+    else if (*spins < 128)
+        sched_yield();
+    else
+        nanosleep(&ts, NULL);
+}
+
+/* wait for an item in `q`, returns 0 if `q` is closed and drained */
+static int %(N)s__readable(struct %(N)s__queue *q, unsigned long long *starved)
+{
+    unsigned spins = 0;
+    while (q->head == q->tail) {
+        if (q->closed) {
+            %(N)s__barrier();
+            if (q->head == q->tail)
+                return 0;
+            break;
+        }
+        if (!spins)
+            ++*starved;
+        %(N)s__wait(&spins);
+    }
+    %(N)s__barrier();
+    return 1;
+}
+
+/* wait for a free slot in `q` (backpressure) */
+static char *%(N)s__writable(struct %(N)s__queue *q, size_t size, unsigned long long *blocked)
+{
+    unsigned spins = 0;
+    while (q->tail - q->head >= q->capacity) {
+        if (!spins)
+            ++*blocked;
+        %(N)s__wait(&spins);
+    }
+    %(N)s__barrier();
+    return q->data + (q->tail %% q->capacity) * size;
+}
+
+static void %(N)s__publish(struct %(N)s__queue *q, size_t length)
+{
+    size_t used;
+    q->lengths[q->tail %% q->capacity] = length;
+    %(N)s__barrier();
+    used = ++q->tail - q->head;
+    if (used > q->high_water)
+        q->high_water = used;
+}
+
+/* counters: items, bytes in, bytes out, starved, blocked, busy ns */
+static void *%(N)s__worker(void *arg)
+{
+    struct %(N)s__stage *s = arg;
+    struct %(N)s__queue *in = s->in, *out = s->out;
+    unsigned long long *c = s->counters, start;
+    size_t head, length, n;
+    char *slot;
+    while (%(N)s__readable(in, &c[3])) {
+        head = in->head;
+        length = in->lengths[head %% in->capacity];
+        slot = %(N)s__writable(out, s->size, &c[4]);
+        start = %(N)s__now();
+        n = %(N)s__call(s->index, in->data + (head %% in->capacity) * s->size,
+                        length, slot, s->size);
+        c[5] += %(N)s__now() - start;
+        %(N)s__barrier();
+        in->head = head + 1;
+        ++c[0];
+        c[1] += length;
+        if (n) {
+            %(N)s__publish(out, n);
+            c[2] += n;
+        }
+    }
+    /* end of input, the stage may flush an aggregate */
+    slot = %(N)s__writable(out, s->size, &c[4]);
+    n = %(N)s__call(s->index, NULL, 0, slot, s->size);
+    if (n) {
+        %(N)s__publish(out, n);
+        c[2] += n;
+    }
+    %(N)s__barrier();
+    out->closed = 1;
+    return NULL;
+}
+
+/* per stage counters, then per queue occupancy and high water */
+static void %(N)s__counters(struct %(N)s__runtime *r, unsigned long long *counters)
+{
+    int i, j;
+    for (i = 0; i < %(S)d; ++i)
+        for (j = 0; j < 6; ++j)
+            counters[i * 6 + j] = r->stages[i].counters[j];
+    for (i = 0; i <= %(S)d; ++i) {
+        counters[%(S)d * 6 + i * 2] = r->queues[i].tail - r->queues[i].head;
+        counters[%(S)d * 6 + i * 2 + 1] = r->queues[i].high_water;
+    }
+}
+
+static void %(N)s__release(struct %(N)s *p)
+{
+    struct %(N)s__runtime *r = p->runtime;
+    int i;
+    /* the metrics outlive the run */
+    %(N)s__counters(r, p->counters);
+    for (i = 0; i <= %(S)d; ++i) {
+        free(r->queues[i].data);
+        free(r->queues[i].lengths);
+    }
+    free(r);
+    p->runtime = NULL;
+}
+'''
+
+_PIPELINE_FUNCTIONS = [
+    ('start', 'int', [('p', 'self')], '''
+    struct %(N)s__runtime *r;
+    int i;
+    if (p->runtime)
+        return -1;
+    r = p->runtime = calloc(1, sizeof(struct %(N)s__runtime));
+    if (!r)
+        return -1;
+    for (i = 0; i <= %(S)d; ++i) {
+        r->queues[i].capacity = p->capacity;
+        r->queues[i].data = malloc(p->capacity * p->buffer_size);
+        r->queues[i].lengths = malloc(p->capacity * sizeof(size_t));
+        if (!r->queues[i].data || !r->queues[i].lengths) {
+            %(N)s__release(p);
+            return -1;
+        }
+    }
+    for (i = 0; i < %(S)d; ++i) {
+        r->stages[i].index = i;
+        r->stages[i].size = p->buffer_size;
+        r->stages[i].in = &r->queues[i];
+        r->stages[i].out = &r->queues[i + 1];
+    }
+    for (i = 0; i < %(S)d; ++i) {
+        if (pthread_create(&r->stages[i].thread, NULL, %(N)s__worker, &r->stages[i]))
+            break;
+        r->threads = i + 1;
+    }
+    if (r->threads < %(S)d) {
+        /* let the started stages run dry, then free the runtime */
+        r->queues[0].closed = 1;
+        for (i = 0; i < r->threads; ++i)
+            pthread_join(r->stages[i].thread, NULL);
+        %(N)s__release(p);
+        return -1;
+    }
+    return 0;'''),
+    ('push', 'int', [('p', 'self'), ('data', 'bytes'), ('length', 'size')], '''
+    struct %(N)s__runtime *r = p->runtime;
+    struct %(N)s__queue *q;
+    if (!r || r->queues[0].closed || length > p->buffer_size)
+        return -1;
+    q = &r->queues[0];
+    if (q->tail - q->head >= q->capacity)
+        return 0;
+    memcpy(q->data + (q->tail %% q->capacity) * p->buffer_size, data, length);
+    %(N)s__publish(q, length);
+    return 1;'''),
+    ('close', None, [('p', 'self')], '''
+    struct %(N)s__runtime *r = p->runtime;
+    if (r) {
+        %(N)s__barrier();
+        r->queues[0].closed = 1;
+    }'''),
+    ('pop', 'index', [('p', 'self'), ('data', 'bytes'), ('size', 'size')], '''
+    struct %(N)s__runtime *r = p->runtime;
+    struct %(N)s__queue *q;
+    size_t length;
+    if (!r)
+        return -2;
+    q = &r->queues[%(S)d];
+    if (q->head == q->tail) {
+        if (!q->closed)
+            return -1;
+        %(N)s__barrier();
+        if (q->head == q->tail)
+            return -2;
+    }
+    %(N)s__barrier();
+    length = q->lengths[q->head %% q->capacity];
+    if (length > size)
+        length = size;
+    memcpy(data, q->data + (q->head %% q->capacity) * p->buffer_size, length);
+    %(N)s__barrier();
+    ++q->head;
+    return length;'''),
+    ('join', 'int', [('p', 'self')], '''
+    struct %(N)s__runtime *r = p->runtime;
+    int i;
+    if (!r)
+        return -1;
+    for (i = 0; i < r->threads; ++i)
+        pthread_join(r->stages[i].thread, NULL);
+    %(N)s__release(p);
+    return 0;'''),
+    ('stats', None, [('p', 'self'), ('counters', 'counters')], '''
+    if (p->runtime)
+        %(N)s__counters(p->runtime, counters);
+    else
+        memcpy(counters, p->counters, sizeof(p->counters));'''),
+]
+
+
+def _value(obj):
+    """
+    Python value of a ctypes scalar, structures are returned as they are.
+    """
+    return obj.value if isinstance(obj, ctypes._SimpleCData) else obj
+
+
+class _Container(object):
+    """
+    Python side of the containers of `InlineGenerator`.
+    The methods call the generated C functions on the memory
+    of the instance, C and Python work on the same data.
+    Instances created in Python free their memory on deletion.
+    """
+    _memory_ = 'data'
+
+    def __init__(self, values=None):
+        ctypes.Structure.__init__(self)
+        self._owned = True
+        if values is not None:
+            self.extend(values)
+
+    def _c(self, name):
+        return type(self)._state_._resolve('%s_%s' % (type(self)._sname_, name))
+
+    @staticmethod
+    def _array(values, ctype):
+        """
+        Memory of `values` (a buffer or sequence) as pointer
+        to `ctype` and the number of elements.
+        """
+        try:
+            memoryview(values)
+        except TypeError:
+            values = list(values)
+            return (ctype * len(values))(*values), len(values)
+        data, nbytes = _buffer_pointer(values)
+        return ctypes.cast(data, ctypes.POINTER(ctype)), nbytes // ctypes.sizeof(ctype)
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        """
+        Remove all elements.
+        """
+        self._c('clear')(self)
+
+    def free(self):
+        """
+        Free the memory of the container, it stays usable.
+        """
+        self._c('free')(self)
+
+    def __del__(self):
+        state = type(self)._state_.state
+        if (getattr(self, '_owned', False) and getattr(self, self._memory_) and
+                state is not None and state.ctx is not None):
+            self.free()
+
+
+class _Vector(_Container):
+    """
+    Dynamic array, see `InlineGenerator.vector`.
+    """
+    def _index(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('vector index out of range')
+        return index
+
+    def append(self, value):
+        if self._c('push')(self, value):
+            raise MemoryError
+
+    def extend(self, values):
+        """
+        Append all `values` (a buffer or sequence) at once.
+        """
+        data, n = self._array(values, self._element_)
+        if self._c('extend')(self, data, n):
+            raise MemoryError
+
+    def pop(self):
+        if not self.size:
+            raise IndexError('pop from empty vector')
+        return _value(self._c('pop')(self))
+
+    def __getitem__(self, index):
+        return self.data[self._index(index)]
+
+    def __setitem__(self, index, value):
+        self.data[self._index(index)] = value
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self.data[i]
+
+    def as_buffer(self):
+        """
+        The elements as memoryview without copying.
+        Invalid once the vector grows or gets freed.
+        """
+        if not self.size:
+            return memoryview((self._element_ * 0)())
+        return type(self)._state_.state.get_buffer(self.data, self._element_, self.size)
+
+    def sort(self):
+        """
+        Sort the elements in place (needs `less`).
+        """
+        self._c('sort')(self.data, self.size)
+
+    def search(self, value):
+        """
+        Index of `value` in the sorted vector, -1 if not found.
+        """
+        return self._c('search')(self.data, self.size, value)
+
+
+class _PriorityQueue(_Container):
+    """
+    Binary min heap, see `InlineGenerator.priority_queue`.
+    """
+    def push(self, value):
+        if self._c('push')(self, value):
+            raise MemoryError
+
+    def extend(self, values):
+        """
+        Push all `values` (a buffer or sequence) at once.
+        """
+        data, n = self._array(values, self._element_)
+        if self._c('push_many')(self, data, n) != n:
+            raise MemoryError
+
+    def peek(self):
+        if not self.size:
+            raise IndexError('peek into empty queue')
+        return _value(self._c('peek')(self))
+
+    def pop(self):
+        if not self.size:
+            raise IndexError('pop from empty queue')
+        return _value(self._c('pop')(self))
+
+
+class _HashMap(_Container):
+    """
+    Open addressing hash map, see `InlineGenerator.hash_map`.
+    """
+    _memory_ = 'keys'
+
+    def __setitem__(self, key, value):
+        if self._c('put')(self, key, value):
+            raise MemoryError
+
+    def __getitem__(self, key):
+        value = self._value_()
+        if not self._c('get')(self, key, ctypes.pointer(value)):
+            raise KeyError(key)
+        return _value(value)
+
+    def get(self, key, default=None):
+        value = self._value_()
+        if not self._c('get')(self, key, ctypes.pointer(value)):
+            return default
+        return _value(value)
+
+    def __contains__(self, key):
+        return bool(self._c('get')(self, key, None))
+
+    def __delitem__(self, key):
+        if not self._c('remove')(self, key):
+            raise KeyError(key)
+
+    def update(self, keys, values):
+        """
+        Insert `keys` with `values` (buffers or sequences) at once.
+        """
+        keys, n = self._array(keys, self._key_)
+        values, count = self._array(values, self._value_)
+        if n != count:
+            raise ValueError('keys and values differ in length')
+        if self._c('put_many')(self, keys, values, n) != n:
+            raise MemoryError
+
+    def items(self):
+        """
+        Returns all keys and values as two ctypes arrays.
+        """
+        keys = (self._key_ * self.size)()
+        values = (self._value_ * self.size)()
+        self._c('items')(self, keys, values)
+        return keys, values
+
+    def extend(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+
+class _Pipeline(object):
+    """
+    Threaded pipeline of C stages, see `InlineGenerator.pipeline`.
+    """
+    def __init__(self):
+        ctypes.Structure.__init__(self, len(self._stages_), self._capacity_,
+                                  self._buffer_size_)
+        self._owned = True
+        self._buffer = ctypes.create_string_buffer(self._buffer_size_)
+
+    def _c(self, name):
+        return type(self)._state_._resolve('%s_%s' % (type(self)._sname_, name))
+
+    @staticmethod
+    def _wait(tries):
+        # the stages run without the GIL, back off while polling the queues
+        time.sleep(0 if tries < 16 else 0.0001)
+
+    def start(self):
+        """
+        Start the stage threads.
+        """
+        if self._c('start')(self):
+            raise InlineGeneratorException('could not start the pipeline')
+        _FORK_HANDLERS[id(self)] = self
+
+    def _after_fork(self):
+        # the stage threads were not forked, the queues belong to the parent
+        self.runtime = None
+
+    def feed(self, data):
+        """
+        Copy `data` (a buffer up to `buffer_size` bytes) into the
+        input queue, waits while the queue is full.
+        """
+        data = bytes(data)
+        tries = 0
+        while True:
+            result = self._c('push')(self, data, len(data))
+            if result > 0:
+                return
+            if result < 0:
+                raise InlineGeneratorException('pipeline is not running or buffer too big')
+            self._wait(tries)
+            tries += 1
+
+    def close(self):
+        """
+        End of the input, the stages finish their work and exit.
+        """
+        self._c('close')(self)
+
+    def poll(self):
+        """
+        Result of the last stage as bytes, None if there is none yet.
+        Raises `StopIteration` when the pipeline is finished.
+        """
+        length = self._c('pop')(self, self._buffer, self._buffer_size_)
+        if length == -2:
+            raise StopIteration
+        if length < 0:
+            return None
+        return self._buffer.raw[:length]
+
+    def results(self):
+        """
+        Iterate over the results of the last stage until the pipeline
+        is finished (after `close`).
+        """
+        tries = 0
+        while True:
+            try:
+                result = self.poll()
+            except StopIteration:
+                return
+            if result is None:
+                self._wait(tries)
+                tries += 1
+            else:
+                tries = 0
+                yield result
+
+    def run(self, items):
+        """
+        Run the pipeline over the buffers in `items`. Returns the list
+        of the results, results are drained while feeding.
+        """
+        results = []
+        self.start()
+        try:
+            for item in items:
+                item, tries = bytes(item), 0
+                while True:
+                    pushed = self._c('push')(self, item, len(item))
+                    if pushed > 0:
+                        break
+                    if pushed < 0:
+                        raise InlineGeneratorException(
+                            'pipeline is not running or buffer too big')
+                    result = self.poll()
+                    if result is None:
+                        self._wait(tries)
+                        tries += 1
+                    else:
+                        results.append(result)
+            self.close()
+            results.extend(self.results())
+        finally:
+            self.join()
+        return results
+
+    def join(self):
+        """
+        Close the input, drop pending results and wait for the
+        stage threads. The pipeline can be started again.
+        """
+        if not self.runtime:
+            return
+        self.close()
+        for _ in self.results():
+            pass
+        self._c('join')(self)
 
     @property
-    def _c_code(cls):
-        def members(fields):
-            for name, ctype in fields:
-                if issubclass(ctype, ctypes.Array):
-                    yield '    %s %s[%s];' % (
-                        TYPE_MAPPER[ctype._type_], name, ctype._length_)
-                else:
-                    yield '    %s %s;' % (TYPE_MAPPER[ctype], name)
+    def stats(self):
+        """
+        Metrics of the running or last run: per stage the processed items,
+        bytes in and out, waits for input (starved) and for output space
+        (blocked), busy seconds and the throughput in items per busy second,
+        per queue the current occupancy and the high water mark.
+        """
+        stages = len(self._stages_)
+        counters = (ctypes.c_ulonglong * (stages * 6 + (stages + 1) * 2))()
+        self._c('stats')(self, counters)
+        result = {'stages': [], 'queues': []}
+        for i, name in enumerate(self._stages_):
+            items, bytes_in, bytes_out, starved, blocked, busy = counters[i * 6:i * 6 + 6]
+            busy /= 1e9
+            result['stages'].append({
+                'name': name, 'items': items, 'bytes_in': bytes_in,
+                'bytes_out': bytes_out, 'starved': starved, 'blocked': blocked,
+                'busy': busy, 'throughput': items / busy if busy else 0.0})
+        for i in range(stages + 1):
+            used, high_water = counters[stages * 6 + i * 2:stages * 6 + i * 2 + 2]
+            result['queues'].append({'used': used, 'high_water': high_water,
+                                     'capacity': self._capacity_})
+        return result
+
+    def __del__(self):
+        state = type(self)._state_.state
+        if (getattr(self, '_owned', False) and self.runtime and
+                state is not None and state.ctx is not None):
+            self.join()
+
+
+class _SlotBinding(object):
+    """
+    Binding of a hot swappable InlineGenerator to a state.
+    Holds the slot table of the state and tracks the calls
+    from Python that are in flight, so that a retired state
+    can be freed once drained.
+    """
+    def __init__(self, generator, state, table):
+        self.generator = generator
+        self.state = state
+        self.table = table
+        self.funcs = {}
+        # deque operations are atomic, the length is the number of calls in flight
+        self.calls = collections.deque()
+        self.retired = False
+        self.free = False
+        self.released = False
+        self.lock = threading.Lock()
+
+    def function(self, name):
+        func = self.funcs.get(name)
+        if func is None:
+            address = self.table[self.generator._slot_index[name]]
+            if not address:
+                raise InlineGeneratorException('symbol "%s" not found' % name)
+            if self.generator.native and name in self.generator._native:
+                func = self.generator._native_function(self.state, name)
+            else:
+                restype, argtypes = self.generator.signatures[name]
+                func = self.state.tcc.ffi.function(address, restype, argtypes)
+            self.funcs[name] = func
+        return func
 
-        return 'struct %s\n{\n%s\n};' % (
-            cls._sname_, '\n'.join(members(cls._fields_)))
+    def leave(self):
+        self.calls.pop()
+        if self.retired and not self.calls:
+            self.release()
+
+    def retire(self, free):
+        self.free = free
+        self.retired = True
+        if not self.calls:
+            self.release()
+
+    def release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.funcs = {}
+        if self.free:
+            self.state.delete()
 
 
 class InlineGenerator(object):
@@ -184,13 +3532,54 @@ class InlineGenerator(object):
         definitions. With `add_definition` you can add
         any code to this section.
 
+    Dead code elimination:
+    `generate(roots)` emits only the parts reachable from `roots`
+    by the names referenced in their code, e.g. a module defining
+    lots of functions compiles only those used by a consumer.
+    The generated code is cached until parts are added.
+    Bind such code with the same roots (`bind_state(state, roots)`,
+    `build(roots=roots)`), set the `roots` attribute for lazy builds.
+
     Symbols:
-    For the provided decorators `c_function`, `c_method`,
-    `callable_function` and `callable_method` symbols are
+    For the provided decorators `c_function`, `translated_function`,
+    `c_method`, `callable_function` and `callable_method` symbols are
     automatically resolved between Python and C.
     Make sure to bind the generator object to a relocated
     memory state before using those functions.
 
+    Hot swapping:
+    With `hotswap=True` all calls of `c_function` and `c_method`
+    definitions, from Python and from C, go through a slot table.
+    `bind_state` or `hot_swap` with a newly compiled state switches
+    all slots at once, running processes pick up the new code
+    without a restart. `hot_swap` frees the old state once the
+    calls from Python in flight have drained.
+    In C the functions are function like macros in this mode, use
+    `name__impl` to get a plain function pointer.
+
+    Forking:
+    Bound generators stay usable in forked processes, the relocated
+    code is shared copy-on-write. Locks are reset in the child.
+    `preload` resolves all functions upfront, see `TinyCC.prefork`.
+
+    Lazy compilation:
+    With `lazy=True` the generator compiles and binds itself on the
+    first call of a `c_function` or `c_method` (or a TinyCC/StateTemplate
+    object to create the state from). `warm_up` does it upfront,
+    optionally in a background thread. `build` compiles and binds
+    explicitly.
+
+    Native functions:
+    With `native=True` (CPython only) the generator additionally emits
+    a METH_FASTCALL wrapper against the Python C API for every
+    `c_function` and `c_method`. The Python wrappers then call real
+    builtin functions and bypass ctypes. Use `prepare_state` to add
+    the Python headers to the state before compiling.
+    Pointer arguments take None, an address or any object supporting
+    the buffer protocol (ctypes objects, bytes, bytearray, numpy arrays).
+    Signatures with unsupported types fall back to ctypes.
+    The GIL is held during the call.
+
     NOTE: Due to the awkward handling of arrays in C
     the decorators don't support C arrays as arguments or restype.
     You would have to fall back to a pointer and
@@ -223,57 +3612,668 @@ class InlineGenerator(object):
         >>> # use it
         ... add_mul(23, 42, 7)
     """
-    def __init__(self):
+    def __init__(self, hotswap=False, native=False, lazy=False):
         self.parts = []
         self.headerparts = []
         self.state = None
         self.symbols = []
+        self.signatures = {}
+        self._wire_helpers = False
+        self._arena = False
+        self._pipelines = False
+        self._data = {}
+        self._resolved = {}
+        self.lazy = lazy
+        self._lazy_lock = threading.Lock()
+        _FORK_HANDLERS[id(self)] = self
+        self._cache = {}
+        # default `roots` of `build` and `bind_state` (see `generate`)
+        self.roots = None
+        self.hotswap = hotswap
+        self._binding = None
+        if hotswap:
+            self._slot_index = {}
+            self._slot_root = ctypes.c_void_p()
+            self._slot_tables = []
+            self.add_definition('void ***_tcc_slots;', 'extern void ***_tcc_slots;')
+            self.symbols.append(('_tcc_slots', ctypes.c_void_p(ctypes.addressof(self._slot_root))))
+        self.native = native
+        if native:
+            if sys.version_info < (3, 7) or sys.implementation.name != 'cpython':
+                raise InlineGeneratorException('native functions need CPython >= 3.7')
+            self._native = {}
+            self.add_topdeclaration('#include <Python.h>')
+            self.add_definition('PyObject *_pyw_pointer_type;')
+            self.symbols.append(('_pyw_pointer_type', ctypes.c_void_p(id(ctypes._Pointer))))
+
+    def bind_state(self, state, roots=None):
+        """
+        Bind to the compiler state `state`.
+        Enables the symbol resolution between C and Python.
+        `state` must be of the memory type. Pass the `roots` the
+        code of `state` was generated with (see `generate`).
+        """
+        if not isinstance(state, TccStateMemory):
+            raise InlineGeneratorException('state must be a memory type')
+        if not state._relocated:
+            raise InlineGeneratorException('state is not relocated')
+        self._mark_eliminated(state, roots)
+        if self.hotswap:
+            return self._swap(state, False)
+        self._resolved = {}
+        self._perf_symbols(state)
+        # reset code parts (reimport symbols to Python lazy)
+        for part in self.parts:
+            part._c_func = None
+        # add callable symbols to state (export to C)
+        self._set_symbols(state)
+        # published last, `_bound` reads it without locking
+        self.state = state
+
+    def build(self, factory=None, roots=None):
+        """
+        Compile the code into a new memory state and bind to it.
+        `factory` creates the state (a TinyCC or StateTemplate object,
+        defaults to the TinyCC instance). `roots` limits the code to
+        the parts reachable from them (defaults to the `roots`
+        attribute, also used by lazy builds). Returns the state.
+        """
+        if roots is None:
+            roots = self.roots
+        factory = factory or TinyCC.instance or TinyCC()
+        state = factory.create_state()
+        self.prepare_state(state)
+        state.compile(self.generate(roots))
+        state.relocate()
+        self.bind_state(state, roots)
+        return state
+
+    def warm_up(self, background=False):
+        """
+        Compile and bind a lazy generator now, in a daemon thread
+        with `background`. Calls meanwhile wait for the compilation.
+        """
+        if not background:
+            self._bound()
+            return
+        thread = threading.Thread(target=self._bound, name='tinycc-warm-up')
+        thread.daemon = True
+        thread.start()
+        return thread
 
-    def bind_state(self, state):
+    def preload(self):
         """
-        Bind to the compiler state `state`.
-        Enables the symbol resolution between C and Python.
-        `state` must be of the memory type.
+        Build a lazy generator and resolve the Python callables of all
+        C functions now. Done before forking, the children start with
+        ready to use functions (see `TinyCC.prefork`).
         """
-        if not isinstance(state, TccStateMemory):
-            raise InlineGeneratorException('state must be a memory type')
-        if not state._relocated:
-            raise InlineGeneratorException('state is not relocated')
-        self.state = state
-        # reset code parts (reimport symbols to Python lazy)
+        state = self._bound()
+        if self.hotswap:
+            for name in self._slot_index:
+                try:
+                    self._binding.function(name)
+                except InlineGeneratorException:
+                    pass
+            return
+        for part in self.parts:
+            if getattr(part, '_c_func_proto', None) and not part._c_func:
+                try:
+                    part._c_func = part._c_func_proto()
+                except TccException:
+                    if part._c_name not in state._eliminated:
+                        raise
+        for name in self.signatures:
+            if name not in self._resolved:
+                try:
+                    self._resolved[name] = self._function(state, name)
+                except TccException:
+                    # eliminated by `generate(roots)`
+                    if name not in state._eliminated:
+                        raise
+
+    def _after_fork(self):
+        self._lazy_lock = threading.Lock()
+        binding = self._binding
+        if binding is not None:
+            # calls in flight were made by threads of the parent
+            binding.calls.clear()
+            binding.lock = threading.Lock()
+
+    def _bound(self):
+        """
+        The bound state, a lazy generator gets built on first use.
+        """
+        state = self.state
+        if state is None:
+            if not self.lazy:
+                raise InlineGeneratorException('generator is not bound to a state')
+            with self._lazy_lock:
+                if self.state is None:
+                    self.build(None if self.lazy is True else self.lazy)
+            state = self.state
+        return state
+
+    def hot_swap(self, state, roots=None):
+        """
+        Switch a hot swappable generator to the new state `state`
+        and free the old state once all calls in flight returned.
+        `roots` as for `bind_state`.
+        """
+        if not self.hotswap:
+            raise InlineGeneratorException('generator is not hot swappable')
+        if not isinstance(state, TccStateMemory) or not state._relocated:
+            raise InlineGeneratorException('state must be a relocated memory state')
+        self._mark_eliminated(state, roots)
+        self._swap(state, True)
+
+    def _mark_eliminated(self, state, roots):
+        """
+        Record the names of the parts missing in the code of `state`.
+        """
+        if roots is None:
+            roots = self.roots
+        state._eliminated = self._generate(roots)[1]
+
+    def _swap(self, state, free):
+        self._set_symbols(state)
+        table = (ctypes.c_void_p * max(len(self._slot_index), 1))()
+        for name, index in self._slot_index.items():
+            try:
+                table[index] = state._get_address(name + '__impl')
+            except TccException:
+                pass
+        # old tables might still be read by running C code
+        self._slot_tables.append(table)
+        old = self._binding
+        self._resolved = {}
+        self._perf_symbols(state)
         for part in self.parts:
             part._c_func = None
-        # add callable symbols to state (export to C)
-        for symbol in self.symbols:
-            self.state.set_symbol(*symbol)
+        # single pointer store switches all slots
+        self._slot_root.value = ctypes.addressof(table)
+        # published last, `_slot_call` and `_bound` read them without locking
+        self._binding = _SlotBinding(self, state, table)
+        self.state = state
+        if old and old.state is not state:
+            old.retire(free)
+
+    def _perf_symbols(self, state):
+        """
+        List only the C functions of the generator in the perf map,
+        not its data symbols.
+        """
+        if state.tcc.perf_map:
+            state._add_perf_symbols(self.signatures)
+
+    def _set_symbols(self, state):
+        """
+        Export the symbols to `state`, skips symbols of the parts
+        eliminated by `generate(roots)`, raises for other missing symbols.
+        """
+        for name, value in self.symbols:
+            try:
+                state.set_symbol(name, value)
+            except TccException:
+                if name not in state._eliminated:
+                    raise
+
+    def _slot_call(self, name, args):
+        """
+        Call the slot `name` of a hot swappable generator.
+        """
+        binding = self._binding
+        if binding is None:
+            self._bound()
+            binding = self._binding
+        binding.calls.append(None)
+        while binding is not self._binding:
+            # swapped meanwhile, retry with the current binding
+            binding.leave()
+            binding = self._binding
+            binding.calls.append(None)
+        try:
+            return binding.function(name)(*args)
+        finally:
+            binding.leave()
+
+    def prepare_state(self, state):
+        """
+        Apply settings needed by the generated code to `state`.
+        Call this before compiling the code.
+        """
+        if self.native:
+            import sysconfig
+            state.add_include_path(sysconfig.get_paths()['include'])
+            if WINDOWS:
+                state.add_link_path(os.path.join(sys.base_exec_prefix, 'libs'))
+                state.add_library('python%d%d' % sys.version_info[:2])
+        if self._pipelines:
+            state.add_library('pthread')
+
+    def use_arena(self):
+        """
+        Declare the scratch arena API (`tcc_arena_alloc`, `tcc_arena_reset`)
+        in the top section. Done automatically for functions with `Arena`
+        arguments.
+        """
+        if not self._arena:
+            self._arena = True
+            self.add_topdeclaration(_ARENA_CODE)
 
     def add_topdeclaration(self, declaration):
         """
         Add `declaration` to the top section.
         """
         self.headerparts.append(Declaration(declaration))
+        self._changed()
 
     def add_definition(self, code, forward=''):
         """
         Add `code` to the definition section. Optional
         write `forward` to the forward section.
         """
-        self.parts.append(Declaration(code, forward))
+        self._add_part(Declaration(code, forward))
+
+    def add_data(self, name, data, ctype=None):
+        """
+        Add the buffer `data` (bytes, bytearray, array.array, numpy array,
+        ctypes array and such) as constant C array `name` without going
+        through C source text. The memory is referenced by the compiled
+        code and pinned as long as the generator lives, read-only buffers
+        other than bytes are copied once.
+        `ctype` denotes the element type (derived from the buffer format
+        by default). In C the data is declared as `const TYPE *name`
+        with `name_length` elements, the pointer is set by `bind_state`.
+        Adding data under the same name again replaces it.
+
+        Example:
+            >>> gen.add_data('crc_table', array.array('I', table))
+            >>> @gen.c_function(c_uint, c_ubyte)
+            ... def crc_step(b):
+            ...     "return crc_table[b % crc_table_length];"
+        """
+        view = memoryview(data)
+        if ctype is None:
+            ctype = _FORMAT_CTYPES.get(view.format.lstrip('@=' + _NATIVE_ORDER))
+            if ctype is None:
+                raise InlineGeneratorException(
+                    'cannot map buffer format %r, give ctype explicitly' % view.format)
+        pointer, nbytes = _buffer_pointer(data)
+        if nbytes % ctypes.sizeof(ctype):
+            raise InlineGeneratorException(
+                'buffer size does not match the element type of "%s"' % name)
+        if isinstance(pointer, bytes):
+            address = ctypes.cast(ctypes.c_char_p(pointer), ctypes.c_void_p)
+        else:
+            address = ctypes.c_void_p(ctypes.addressof(pointer))
+        self._data[name] = pointer
+        self.symbols = [symbol for symbol in self.symbols if symbol[0] != name]
+        self.symbols.append((name, address))
+        part = Declaration(
+            'const %s *%s;' % (TYPE_MAPPER[ctype], name),
+            'extern const %s *%s;\n#define %s_length %d' % (
+                TYPE_MAPPER[ctype], name, name, nbytes // ctypes.sizeof(ctype)))
+        part._c_name = name
+        self._add_part(part)
+
+    def vector(self, ctype, name=None, less=None):
+        """
+        Instantiate a dynamic array of `ctype` elements (a TYPE_MAPPER
+        type or ScopedStructure). Returns a ScopedStructure class `name`
+        (default `Vector_<type>`) with the fields `data`, `size` and
+        `capacity`, usable in C as `struct name`.
+
+        C functions (`N` denotes `name`):
+            int N_reserve(struct N *v, size_t capacity)
+            int N_push(struct N *v, T value)
+            int N_extend(struct N *v, T *values, size_t n)
+            T N_pop(struct N *v)
+            void N_clear(struct N *v)
+            void N_free(struct N *v)
+            void N_sort(T *data, size_t n)
+            long long N_search(T *data, size_t n, T key)
+        The allocating functions return -1 if out of memory.
+        `less` is the C expression comparing two elements `a` and `b`
+        for sorting and binary search (defaults to `a < b`, structures
+        have no sort functions without it).
+
+        Python instances support `append`, `extend` (bulk copy of
+        a buffer or sequence), `pop`, indexing, `len`, `sort`, `search`
+        and `as_buffer` (memoryview of the elements without copying).
+        """
+        is_struct = issubclass(ctype, ctypes.Structure)
+        if less is None and not is_struct:
+            less = '(a) < (b)'
+        name = name or self._container_name('Vector', ctype)
+        fmt = {'N': name, 'T': TYPE_MAPPER[ctype], 'LESS': less}
+        code, functions = [_CONTAINER_RESERVE], list(_VECTOR_FUNCTIONS)
+        if less:
+            code.append(_CONTAINER_SORT)
+            functions.extend(_SORT_FUNCTIONS)
+        fields = [('data', ctypes.POINTER(ctype)), ('size', ctypes.c_size_t),
+                  ('capacity', ctypes.c_size_t)]
+        return self._add_container(_Vector, name, fields, {'T': ctype}, fmt,
+                                   '\n\n'.join(code), functions)
+
+    def priority_queue(self, ctype, name=None, less=None):
+        """
+        Instantiate a binary min heap of `ctype` elements ordered by `less`
+        (C expression comparing `a` and `b`, defaults to `a < b`, needed
+        for structures). Returns a ScopedStructure class `name` (default
+        `PriorityQueue_<type>`) with the fields `data`, `size` and `capacity`.
+
+        C functions (`N` denotes `name`):
+            int N_push(struct N *q, T value)
+            size_t N_push_many(struct N *q, T *values, size_t n)
+            T N_peek(struct N *q)
+            T N_pop(struct N *q)
+            void N_clear(struct N *q)
+            void N_free(struct N *q)
+
+        Python instances support `push`, `extend` (bulk push of a buffer
+        or sequence), `peek`, `pop` and `len`.
+        """
+        if less is None:
+            if issubclass(ctype, ctypes.Structure):
+                raise InlineGeneratorException('priority queue of structures needs less')
+            less = '(a) < (b)'
+        name = name or self._container_name('PriorityQueue', ctype)
+        fmt = {'N': name, 'T': TYPE_MAPPER[ctype], 'LESS': less}
+        fields = [('data', ctypes.POINTER(ctype)), ('size', ctypes.c_size_t),
+                  ('capacity', ctypes.c_size_t)]
+        return self._add_container(_PriorityQueue, name, fields, {'T': ctype}, fmt,
+                                   _CONTAINER_RESERVE + '\n\n' + _QUEUE_CODE,
+                                   _QUEUE_FUNCTIONS)
+
+    def hash_map(self, keytype, valuetype, name=None):
+        """
+        Instantiate an open addressing hash map (linear probing)
+        from `keytype` to `valuetype` keys. Returns a ScopedStructure class
+        `name` (default `HashMap_<key>_<value>`) with the fields `keys`,
+        `values`, `used`, `size` and `capacity`.
+        Structure keys are hashed and compared field by field, their
+        padding bytes are ignored (unions are taken bytewise).
+
+        C functions (`N` denotes `name`):
+            int N_put(struct N *m, K key, V value)
+            int N_get(struct N *m, K key, V *value)
+            int N_remove(struct N *m, K key)
+            size_t N_put_many(struct N *m, K *keys, V *values, size_t n)
+            size_t N_items(struct N *m, K *keys, V *values)
+            void N_clear(struct N *m)
+            void N_free(struct N *m)
+        `N_get` and `N_remove` return 1 if the key was found, `value`
+        of `N_get` may be NULL.
+
+        Python instances work like a dict (item access, `in`, `del`,
+        `get`, `len`) plus bulk `update(keys, values)` with buffers or
+        sequences and `items()` returning ctypes arrays of the keys and values.
+        """
+        name = name or self._container_name('HashMap', keytype, valuetype)
+        if issubclass(keytype, ctypes.Structure):
+            eq, hashing = [], []
+            for expr, bitfield in _key_fields(keytype, ''):
+                if bitfield:
+                    eq.append('a->%s == b->%s' % (expr, expr))
+                    hashing.append('h = (h ^ (unsigned long long) key.%s) * 0x100000001b3ULL;'
+                                   % expr)
+                else:
+                    eq.append('memcmp(&a->%s, &b->%s, sizeof(a->%s)) == 0' % (expr, expr, expr))
+                    hashing.append('h = %s__mix(h, &key.%s, sizeof(key.%s));' % (name, expr, expr))
+            eq = eq or ['1']
+        else:
+            eq = ['*a == *b']
+            hashing = ['h = %s__mix(h, &key, sizeof(key));' % name]
+        normalize = ''
+        if keytype in (ctypes.c_float, ctypes.c_double):
+            # -0.0 equals 0.0
+            normalize = '\n    if (key == 0)\n        key = 0;'
+        fmt = {'N': name, 'K': TYPE_MAPPER[keytype], 'V': TYPE_MAPPER[valuetype],
+               'EQ': ' &&\n        '.join(eq), 'NORMALIZE': normalize,
+               'HASH': ''.join('\n    ' + line for line in hashing)}
+        fields = [('keys', ctypes.POINTER(keytype)), ('values', ctypes.POINTER(valuetype)),
+                  ('used', ctypes.POINTER(ctypes.c_ubyte)), ('size', ctypes.c_size_t),
+                  ('capacity', ctypes.c_size_t)]
+        return self._add_container(_HashMap, name, fields, {'K': keytype, 'V': valuetype},
+                                   fmt, _MAP_CODE, _MAP_FUNCTIONS)
+
+    def pipeline(self, stages, name='Pipeline', capacity=16, buffer_size=65536):
+        """
+        Instantiate a pipeline running each of the C functions `stages`
+        (functions of this generator or their names) on its own native
+        thread. The stages are connected by bounded lock-free single
+        producer/single consumer queues of `capacity` buffers of
+        `buffer_size` bytes, a full queue blocks its producer (backpressure).
+        Returns a ScopedStructure class `name`.
+
+        A stage has the signature
+            size_t stage(char *in, size_t length, char *out, size_t size)
+        and writes its result for the buffer `in` of `length` bytes into
+        `out` (at most `size` bytes), the return value is the result length,
+        0 emits nothing. At the end of the input the stage gets called once
+        with `in` NULL to flush aggregated results.
+
+        C functions (`N` denotes `name`):
+            int N_start(struct N *p)
+            int N_push(struct N *p, char *data, size_t length)
+            void N_close(struct N *p)
+            long long N_pop(struct N *p, char *data, size_t size)
+            int N_join(struct N *p)
+            void N_stats(struct N *p, unsigned long long *counters)
+        `N_push` and `N_pop` do not block, `N_push` returns 0 if the input
+        queue is full, `N_pop` -1 if no result is ready and -2 at the end.
+
+        Python instances support `start`, `feed`, `close`, `poll`, `results`,
+        `join`, `run` (feeds a sequence of buffers and returns the results)
+        and `stats` (per stage throughput, per queue occupancy, kept
+        after the run).
+        Needs POSIX threads.
+        """
+        if WINDOWS:
+            raise InlineGeneratorException('pipelines need POSIX threads')
+        if not stages:
+            raise InlineGeneratorException('pipeline without stages')
+        names = [getattr(stage, '_c_name', stage) for stage in stages]
+        for stage in names:
+            signature = self.signatures.get(stage)
+            if signature is None or len(signature[1]) != 4:
+                raise InlineGeneratorException('"%s" is not a stage function' % stage)
+        calls = '\n'.join('    case %d: return %s(in, length, out, size);' % (index, stage)
+                          for index, stage in enumerate(names))
+        fmt = {'N': name, 'S': len(names), 'CALLS': calls}
+        fields = [('stages', ctypes.c_size_t), ('capacity', ctypes.c_size_t),
+                  ('buffer_size', ctypes.c_size_t), ('runtime', ctypes.c_void_p),
+                  ('counters', ctypes.c_ulonglong * (len(names) * 6 + (len(names) + 1) * 2))]
+        self._pipelines = True
+        cls = self._add_container(_Pipeline, name, fields, {}, fmt, _PIPELINE_CODE,
+                                  _PIPELINE_FUNCTIONS,
+                                  ['#include <pthread.h>', '#include <sched.h>',
+                                   '#include <time.h>'])
+        cls._stages_ = tuple(names)
+        cls._capacity_ = capacity
+        cls._buffer_size_ = buffer_size
+        return cls
+
+    @staticmethod
+    def _container_name(prefix, *ctypes_):
+        return '_'.join([prefix] + [re.sub(r'\W+', '_', TYPE_MAPPER[ctype].replace('struct ', ''))
+                                    for ctype in ctypes_])
+
+    def _add_container(self, mixin, name, fields, types, fmt, code, functions,
+                       includes=()):
+        """
+        Create the ScopedStructure class of a container and
+        add the C functions of the `functions` templates.
+        """
+        attrs = {'_fields_': fields}
+        for key, ctype in types.items():
+            attrs[{'T': '_element_', 'K': '_key_', 'V': '_value_'}[key]] = ctype
+        cls = _ScopedStructureBase(str(name), (mixin, self.ScopedStructure), attrs)
+        kinds = {None: None, 'self': ctypes.POINTER(cls), 'size': ctypes.c_size_t,
+                 'index': ctypes.c_longlong, 'int': ctypes.c_int,
+                 'bytes': ctypes.POINTER(ctypes.c_char),
+                 'counters': ctypes.POINTER(ctypes.c_ulonglong)}
+        for key, ctype in types.items():
+            kinds[key] = ctype
+            kinds[key + '*'] = ctypes.POINTER(ctype)
+        decls = ['#include <stdlib.h>', '#include <string.h>'] + list(includes)
+        codes = [code % fmt]
+        for suffix, restype, args, body in functions:
+            fname = '%s_%s' % (name, suffix)
+            cargs = [(arg, kinds[kind]) for arg, kind in args]
+            self.signatures[fname] = (kinds[restype], tuple(ctype for _, ctype in cargs))
+            decl, definition = self._create_func(fname, kinds[restype], cargs, body % fmt)
+            decls.append(decl)
+            codes.append(definition)
+        self.add_definition('\n\n'.join(codes), '\n'.join(decls))
+        return cls
+
+    def heap_stats(self, top=10):
+        """
+        Heap usage of the bound state with allocation tracking
+        by C function (see `TccStateMemory.heap_stats`).
+        """
+        if self.state is None:
+            raise InlineGeneratorException('generator is not bound to a state')
+        return self.state.heap_stats(top, self.signatures)
+
+    def _resolve(self, name):
+        """
+        Python callable for the C function `name` of the bound state.
+        """
+        if self.hotswap:
+            return lambda *args: self._slot_call(name, args)
+        func = self._resolved.get(name)
+        if func is None:
+            func = self._resolved[name] = self._function(self._bound(), name)
+        return func
+
+    def _add_wire_codec(self, codec):
+        """
+        Add the wire codec routines of a ScopedStructure.
+        """
+        if not self._wire_helpers:
+            self.add_definition(_WIRE_HELPERS.strip(), '#include <stddef.h>')
+            self._wire_helpers = True
+        self._add_part(codec)
 
     @property
     def code(self):
         """
         Property for the generated C code.
         """
+        return self.generate()
+
+    def generate(self, roots=None):
+        """
+        Generate the C code. With `roots` (names, decorated functions
+        or ScopedStructure classes) only the parts reachable from the
+        roots are emitted, a ScopedStructure root includes its methods.
+        The code is cached until the parts change.
+        """
+        return self._generate(roots)[0]
+
+    def _generate(self, roots):
+        """
+        The code for `roots` and the names of the eliminated parts.
+        """
+        key = (None if roots is None else frozenset(self._root_names(roots)),
+               len(self.parts), len(self.headerparts))
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        parts = self.parts if roots is None else self._reachable(key[0])
         pre = '/* inline generated code */'
         end = '/*\n * inline generated code end\n */'
         top = '/*\n * top section\n */\n\n'
         top += '\n'.join(part._c_code for part in self.headerparts)
         forward = '/*\n * forward section\n */\n\n'
-        forward += '\n'.join(part._c_decl for part in self.parts)
+        forward += '\n'.join(part._c_decl for part in parts)
         definition = '/*\n * definitions\n */\n\n'
-        definition += '\n\n'.join(part._c_code for part in self.parts)
-        return '\n\n\n'.join(filter(bool, [pre, top, forward, definition, end]))
+        definition += '\n\n'.join(part._c_code for part in parts)
+        code = '\n\n\n'.join(filter(bool, [pre, top, forward, definition, end]))
+        emitted = set(id(part) for part in parts)
+        eliminated = frozenset(name for part in self.parts if id(part) not in emitted
+                               for name in self._part_names(part))
+        self._cache[key] = (code, eliminated)
+        return self._cache[key]
+
+    def _changed(self):
+        """
+        Invalidate the cached code and dependency graph.
+        """
+        self._cache = {}
+
+    @staticmethod
+    def _part_names(part):
+        """
+        Names defined by `part`.
+        """
+        if isinstance(part, _ScopedStructureBase):
+            return (part._sname_,)
+        if isinstance(part, _WireCodec):
+            return (part.unpack_name, part.pack_name)
+        if hasattr(part, '_c_names'):
+            return part._c_names
+        name = getattr(part, '_c_name', None)
+        return (name,) if name else ()
+
+    def _graph(self):
+        """
+        Dependency graph of the parts by referenced names.
+        Returns the providing parts of a name and the
+        dependencies of each part (as indices into `parts`).
+        """
+        graph = self._cache.get('graph')
+        if graph and graph[0] == len(self.parts):
+            return graph[1:]
+        providers = {}
+        for i, part in enumerate(self.parts):
+            for name in self._part_names(part):
+                providers.setdefault(name, []).append(i)
+        dependencies = []
+        for i, part in enumerate(self.parts):
+            used = set()
+            for name in set(_C_IDENTIFIER.findall(part._c_decl + '\n' + part._c_code)):
+                used.update(providers.get(name, ()))
+            used.discard(i)
+            dependencies.append(used)
+        self._cache['graph'] = (len(self.parts), providers, dependencies)
+        return providers, dependencies
+
+    def _root_names(self, roots):
+        for root in roots:
+            if isinstance(root, _ScopedStructureBase):
+                yield root._sname_
+                for part in self.parts:
+                    if getattr(part, '_c_owner', None) == root._sname_:
+                        for name in self._part_names(part):
+                            yield name
+            elif isinstance(root, (str, unicode)):
+                yield root
+            elif getattr(root, '_c_name', None):
+                yield root._c_name
+            else:
+                raise InlineGeneratorException('unknown root %r' % (root,))
+
+    def _reachable(self, names):
+        """
+        Parts reachable from `names` in definition order. Parts
+        with unknown names (e.g. plain statements) are always kept.
+        """
+        providers, dependencies = self._graph()
+        todo = [i for i, part in enumerate(self.parts) if not self._part_names(part)]
+        for name in names:
+            if name not in providers:
+                raise InlineGeneratorException('unknown root "%s"' % name)
+            todo.extend(providers[name])
+        seen = set()
+        while todo:
+            i = todo.pop()
+            if i not in seen:
+                seen.add(i)
+                todo.extend(dependencies[i])
+        return [part for i, part in enumerate(self.parts) if i in seen]
 
     @property
     def ScopedStructure(self):
@@ -290,38 +4290,423 @@ class InlineGenerator(object):
         Construct C function source.
         """
         PROTO = '%s %s(%s)'
+        cargs = list(cargs)
+        if any(ctype in (Arena, ctypes.POINTER(Arena)) for _, ctype in cargs):
+            self.use_arena()
         restype_c = TYPE_MAPPER[restype]
         cargs_c = ', '.join('%s %s' % (TYPE_MAPPER[ctype], name)
                             for name, ctype in cargs)
-        proto = PROTO % (restype_c, fname, cargs_c or 'void')
-        return proto + ';', proto + '\n{%s\n}' % code
+        if self.hotswap:
+            # callers go through the slot table, the definition is `fname__impl`
+            index = self._slot_index.setdefault(fname, len(self._slot_index))
+            proto = PROTO % (restype_c, fname + '__impl', cargs_c or 'void')
+            types_c = ', '.join(TYPE_MAPPER[ctype] for _, ctype in cargs)
+            macro = '#define %s(...) (((%s (*)(%s)) (*_tcc_slots)[%d])(__VA_ARGS__))' % (
+                fname, restype_c, types_c or 'void', index)
+            decl, code = proto + ';\n' + macro, proto + '\n{%s\n}' % code
+        else:
+            proto = PROTO % (restype_c, fname, cargs_c or 'void')
+            decl, code = proto + ';', proto + '\n{%s\n}' % code
+        if self.native:
+            native = self._native_code(fname, restype, [ctype for _, ctype in cargs])
+            if native:
+                code += '\n\n' + native
+        return decl, code
+
+    def _native_kind(self, ctype):
+        """
+        Kind of conversion for the native wrappers, None if not supported.
+        """
+        if ctype is None:
+            return 'void'
+        if issubclass(ctype, ctypes._Pointer):
+            return 'pointer'
+        if issubclass(ctype, (ctypes.Structure, ctypes.Union)):
+            return 'struct'
+        if issubclass(ctype, ctypes._SimpleCData):
+            code = ctype._type_
+            for kind, codes in (('int', 'bhilq'), ('uint', 'BHILQ'), ('float', 'fd'),
+                                ('bool', '?'), ('char', 'c'), ('pointer', 'zP')):
+                if code in codes:
+                    return kind
+
+    def _native_code(self, fname, restype, argtypes):
+        """
+        Construct a METH_FASTCALL wrapper for the C function `fname`.
+        Returns None if the signature cannot be handled natively.
+        """
+        kinds = [self._native_kind(ctype) for ctype in argtypes]
+        reskind = self._native_kind(restype)
+        if None in kinds or reskind is None:
+            return None
+        lines = ['static PyObject *_pyw_%s(PyObject *self, PyObject *const *args, '
+                 'Py_ssize_t nargs)' % fname,
+                 '{',
+                 '    PyObject *result = NULL;',
+                 '    long long ll;',
+                 '    unsigned long long ull;',
+                 '    double d;']
+        body = ['    if (nargs != %d) {' % len(argtypes),
+                '        PyErr_Format(PyExc_TypeError, "%s() takes %d arguments '
+                '(%%zd given)", nargs);' % (fname, len(argtypes)),
+                '        return NULL;',
+                '    }']
+        views = []
+        for i, (ctype, kind) in enumerate(zip(argtypes, kinds)):
+            ctype_c = TYPE_MAPPER[ctype]
+            arg = 'args[%d]' % i
+            var = 'a%d' % i
+            lines.append('    %s %s;' % (ctype_c, var))
+            if kind == 'int':
+                body.append('    ll = PyLong_AsLongLong(%s);' % arg)
+                body.append('    if (ll == -1 && PyErr_Occurred()) goto done;')
+                body.append('    %s = (%s) ll;' % (var, ctype_c))
+            elif kind == 'uint':
+                body.append('    ull = PyLong_AsUnsignedLongLongMask(%s);' % arg)
+                body.append('    if (ull == (unsigned long long) -1 && PyErr_Occurred()) goto done;')
+                body.append('    %s = (%s) ull;' % (var, ctype_c))
+            elif kind == 'float':
+                body.append('    d = PyFloat_AsDouble(%s);' % arg)
+                body.append('    if (d == -1.0 && PyErr_Occurred()) goto done;')
+                body.append('    %s = (%s) d;' % (var, ctype_c))
+            elif kind == 'bool':
+                body.append('    ll = PyObject_IsTrue(%s);' % arg)
+                body.append('    if (ll < 0) goto done;')
+                body.append('    %s = (%s) ll;' % (var, ctype_c))
+            elif kind == 'char':
+                body.append('    if (PyBytes_Check(%s) && PyBytes_GET_SIZE(%s) == 1) {' % (arg, arg))
+                body.append('        %s = PyBytes_AS_STRING(%s)[0];' % (var, arg))
+                body.append('    } else {')
+                body.append('        ll = PyLong_AsLongLong(%s);' % arg)
+                body.append('        if (ll == -1 && PyErr_Occurred()) goto done;')
+                body.append('        %s = (%s) ll;' % (var, ctype_c))
+                body.append('    }')
+            else:
+                view = 'view%d' % i
+                views.append(view)
+                lines.append('    Py_buffer %s = {0};' % view)
+                if kind == 'pointer':
+                    body.append('    if (%s == Py_None) {' % arg)
+                    body.append('        %s = NULL;' % var)
+                    body.append('    } else if (PyLong_Check(%s)) {' % arg)
+                    body.append('        %s = (%s) PyLong_AsVoidPtr(%s);' % (var, ctype_c, arg))
+                    body.append('        if (!%s && PyErr_Occurred()) goto done;' % var)
+                    body.append('    } else {')
+                    body.append('        if (PyObject_GetBuffer(%s, &%s, PyBUF_SIMPLE) < 0) goto done;' % (arg, view))
+                    body.append('        %s = (%s) %s.buf;' % (var, ctype_c, view))
+                    body.append('        /* ctypes pointer objects hold the address */')
+                    body.append('        if (PyObject_TypeCheck(%s, (PyTypeObject *) _pyw_pointer_type))' % arg)
+                    body.append('            %s = *(%s *) %s.buf;' % (var, ctype_c, view))
+                    body.append('    }')
+                else:
+                    body.append('    if (PyObject_GetBuffer(%s, &%s, PyBUF_SIMPLE) < 0) goto done;' % (arg, view))
+                    body.append('    if (%s.len < (Py_ssize_t) sizeof(%s)) {' % (view, ctype_c))
+                    body.append('        PyErr_SetString(PyExc_TypeError, "argument %d: '
+                                'buffer too small for %s");' % (i + 1, ctype_c))
+                    body.append('        goto done;')
+                    body.append('    }')
+                    body.append('    %s = *(%s *) %s.buf;' % (var, ctype_c, view))
+        call = '%s(%s)' % (fname, ', '.join('a%d' % i for i in range(len(argtypes))))
+        if reskind == 'void':
+            body.append('    %s;' % call)
+            body.append('    Py_INCREF(Py_None);')
+            body.append('    result = Py_None;')
+        else:
+            lines.append('    %s r;' % TYPE_MAPPER[restype])
+            body.append('    r = %s;' % call)
+            box = {
+                'int': 'PyLong_FromLongLong((long long) r)',
+                'uint': 'PyLong_FromUnsignedLongLong((unsigned long long) r)',
+                'float': 'PyFloat_FromDouble((double) r)',
+                'bool': 'PyBool_FromLong((long) r)',
+                'char': 'PyBytes_FromStringAndSize((char *) &r, 1)',
+                'pointer': 'PyLong_FromVoidPtr((void *) r)',
+                'struct': 'PyBytes_FromStringAndSize((char *) &r, sizeof(r))'
+            }[reskind]
+            if restype in (ctypes.c_void_p, ctypes.c_char_p):
+                body.append('    if (!r) {')
+                body.append('        Py_INCREF(Py_None);')
+                body.append('        result = Py_None;')
+                body.append('        goto done;')
+                body.append('    }')
+                if restype is ctypes.c_char_p:
+                    box = 'PyBytes_FromString(r)'
+            body.append('    result = %s;' % box)
+        body.append('done:')
+        for view in views:
+            body.append('    if (%s.obj)' % view)
+            body.append('        PyBuffer_Release(&%s);' % view)
+        body.append('    return result;')
+        body.append('}')
+        lines.extend(body)
+        lines.extend([
+            '',
+            'PyObject *_pyw_%s_new(void)' % fname,
+            '{',
+            '    static PyMethodDef def = {"%s", (PyCFunction) (void (*)(void)) _pyw_%s,'
+            % (fname, fname),
+            '                              METH_FASTCALL, NULL};',
+            '    return PyCFunction_NewEx(&def, NULL, NULL);',
+            '}'])
+        # results of pointer and struct types get converted in Python
+        post = None
+        if reskind == 'struct':
+            post = restype.from_buffer_copy
+        elif reskind == 'pointer' and restype not in (ctypes.c_void_p, ctypes.c_char_p):
+            post = lambda address: ctypes.cast(address, restype)
+        self._native[fname] = post
+        return '\n'.join(lines)
+
+    def _native_function(self, state, name):
+        """
+        Create the builtin function object for `name` in `state`.
+        """
+        new = ctypes.PYFUNCTYPE(ctypes.py_object)(
+            state._get_address('_pyw_%s_new' % name))
+        builtin = new()
+        post = self._native[name]
+        if post is None:
+            return builtin
+        return lambda *args: post(builtin(*args))
+
+    def _function(self, state, name):
+        """
+        Resolve the Python callable for the C function `name` in `state`.
+        """
+        if self.native and name in self._native:
+            return self._native_function(state, name)
+        restype, argtypes = self.signatures[name]
+        return state.get_symbol(name, ctypes.CFUNCTYPE(restype, *argtypes))
+
+    def _memo_code(self, fname, restype, cargs, code, capacity, eviction):
+        """
+        Construct the cache of a memoized C function. Returns the
+        definitions to be placed before the function and the body
+        of the function doing the cache lookup.
+        """
+        if eviction not in ('direct', 'lru'):
+            raise InlineGeneratorException('unknown eviction %r' % (eviction,))
+        if restype not in _FORMAT_CTYPES.values():
+            raise InlineGeneratorException('memoize needs a scalar restype')
+        if any(ctype not in _FORMAT_CTYPES.values() for _, ctype in cargs):
+            raise InlineGeneratorException('memoize needs scalar arguments')
+        if isinstance(capacity, bool):
+            capacity = 1024
+        # power of 2 number of entries, lru uses sets of 2 entries
+        size = 2
+        while size < capacity:
+            size *= 2
+        restype_c = TYPE_MAPPER[restype]
+        cargs_c = ', '.join('%s %s' % (TYPE_MAPPER[ctype], name) for name, ctype in cargs)
+        names = ', '.join(name for name, _ in cargs)
+        memo = fname + '__memo'
+        definitions = [
+            'struct %s\n{' % memo,
+            '    unsigned long long size, capacity, hits, misses, evictions, clock;',
+            '    struct\n    {',
+            '        unsigned long long stamp;']
+        definitions.extend('        %s k_%s;' % (TYPE_MAPPER[ctype], name) for name, ctype in cargs)
+        definitions.extend([
+            '        %s value;' % restype_c,
+            '    } table[%d];' % size,
+            '} %s = {sizeof(struct %s), %d};' % (memo, memo, size),
+            '',
+            'static %s %s__compute(%s)\n{%s\n}' % (restype_c, fname, cargs_c or 'void', code),
+            '', ''])
+        match = ' && '.join(['e->stamp'] + ['e->k_%s == %s' % (name, name) for name, _ in cargs])
+        body = ['',
+                '    unsigned long long h = 0xcbf29ce484222325ULL;',
+                '    %s value;' % restype_c]
+        for name, ctype in cargs:
+            body.extend([
+                '    {',
+                '        union { %s v; unsigned long long k; } u;' % TYPE_MAPPER[ctype],
+                '        u.k = 0;',
+                '        u.v = %s;' % name,
+                '        h = (h ^ u.k) * 0x100000001b3ULL;',
+                '    }'])
+        body.append('    h ^= h >> 29;')
+        if eviction == 'direct':
+            body.extend([
+                '    {',
+                '        __typeof__(%s.table[0]) *e = &%s.table[h & %d];' % (memo, memo, size - 1),
+                '        if (%s) {' % match,
+                '            %s.hits++;' % memo,
+                '            return e->value;',
+                '        }',
+                '        %s.misses++;' % memo,
+                '        value = %s__compute(%s);' % (fname, names),
+                '        if (e->stamp)',
+                '            %s.evictions++;' % memo])
+        else:
+            body.extend([
+                '    {',
+                '        __typeof__(%s.table[0]) *set = &%s.table[(h & %d) * 2], *e;' % (
+                    memo, memo, size // 2 - 1),
+                '        for (e = set; e < set + 2; ++e) {',
+                '            if (%s) {' % match,
+                '                %s.hits++;' % memo,
+                '                e->stamp = ++%s.clock;' % memo,
+                '                return e->value;',
+                '            }',
+                '        }',
+                '        %s.misses++;' % memo,
+                '        value = %s__compute(%s);' % (fname, names),
+                '        /* replace an empty or the least recently used entry */',
+                '        e = (!set[0].stamp || set[1].stamp && set[0].stamp < set[1].stamp) ? set : set + 1;',
+                '        if (e->stamp)',
+                '            %s.evictions++;' % memo])
+        body.append('        e->stamp = ++%s.clock;' % memo)
+        body.extend('        e->k_%s = %s;' % (name, name) for name, _ in cargs)
+        body.extend([
+            '        e->value = value;',
+            '    }',
+            '    return value;'])
+        return '\n'.join(definitions), '\n'.join(body)
+
+    def _memo_stats(self, name):
+        """
+        Counters of the cache of the memoized C function `name`.
+        """
+        address = self._bound()._get_address(name + '__memo')
+        return (ctypes.c_ulonglong * 5).from_address(address)
+
+    def _define_func(self, f, restype, argtypes, code, memoize=None, eviction='direct'):
+        """
+        Register `f` as C function with the C body `code`.
+        Returns the Python wrapper for the C function.
+        """
+        def inner(*args, **kwargs):
+            # TODO: apply args and kwargs appropriate to Python
+            if self.hotswap:
+                return self._slot_call(name, args)
+            if not f._c_func:
+                f._c_func = f._c_func_proto()
+            return f._c_func(*args)
+        if PY3:
+            name = f.__name__
+            varnames = f.__code__.co_varnames
+        else:
+            name = f.func_name
+            varnames = f.func_code.co_varnames
+        cargs = list(zip(varnames, argtypes))
+        memo = ''
+        if memoize:
+            memo, code = self._memo_code(name, restype, cargs, code, memoize, eviction)
+        f._c_decl, f._c_code = self._create_func(name, restype, cargs, code)
+        f._c_code = memo + f._c_code
+        f._c_func_proto = lambda: self._function(self._bound(), name)
+        f._c_func = None
+        f._c_name = name
+        self.signatures[name] = (restype, argtypes)
+        self._add_part(f)
+        inner._c_name = name
+        if memoize:
+            def cache_info():
+                """
+                Hit, miss and eviction counters of the C cache.
+                """
+                size, capacity, hits, misses, evictions = self._memo_stats(name)
+                return {'hits': hits, 'misses': misses,
+                        'evictions': evictions, 'capacity': capacity}
+
+            def cache_clear():
+                """
+                Empty the C cache and reset its counters.
+                """
+                stats = self._memo_stats(name)
+                offset = ctypes.sizeof(ctypes.c_ulonglong) * 2
+                ctypes.memset(ctypes.addressof(stats) + offset, 0, stats[0] - offset)
+
+            inner.cache_info = cache_info
+            inner.cache_clear = cache_clear
+        return inner
+
+    def _add_part(self, part):
+        """
+        Add a code part, a redefinition of a named part replaces the old part.
+        """
+        self._changed()
+        name = getattr(part, '_c_name', None)
+        if name:
+            for i, old in enumerate(self.parts):
+                if getattr(old, '_c_name', None) == name:
+                    self.parts[i] = part
+                    return
+        self.parts.append(part)
 
-    def c_function(self, restype, *argtypes):
+    def c_function(self, restype, *argtypes, **kwargs):
         """
         Decorator for defining a C function.
         `restype` denotes the ctype of the return value,
         `argtypes` the ctypes of the arguments.
         Use the docstring for the actual code.
+
+        With `memoize=capacity` the results of a pure function with
+        scalar arguments are cached in a native hash table, calls from
+        C benefit as well (e.g. recursive calls). `eviction` is either
+        'direct' (direct mapped, default) or 'lru' (2-way set associative,
+        replaces the least recently used entry). The Python wrapper gets
+        `cache_info()` and `cache_clear()` like `functools.lru_cache`.
+        The cache is not thread safe.
+
+        Example:
+            >>> @gen.c_function(c_longlong, c_int, memoize=256)
+            ... def fib(n):
+            ...     "return n < 2 ? n : fib(n - 1) + fib(n - 2);"
         """
+        memoize = kwargs.pop('memoize', None)
+        eviction = kwargs.pop('eviction', 'direct')
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %s' % ', '.join(kwargs))
+
         def wrap(f):
-            def inner(*args, **kwargs):
-                # TODO: apply args and kwargs appropriate to Python
-                if not f._c_func:
-                    f._c_func = f._c_func_proto()
-                return f._c_func(*args)
+            return self._define_func(f, restype, argtypes, f.__doc__, memoize, eviction)
+        return wrap
+
+    def translated_function(self, restype, *argtypes):
+        """
+        Decorator for defining a C function written in Python.
+        Works like `c_function` but the C body is translated from
+        the Python function body, which is restricted to a numeric
+        subset of Python (see `_PyTranslator`). Other C functions
+        can be called if they were defined before.
+
+        Example:
+            >>> @gen.translated_function(c_int, c_int)
+            ... def l_fib(a):
+            ...     if a <= 2:
+            ...         return 1
+            ...     last, next_to_last = 1, 1
+            ...     for i in range(2, a):
+            ...         last, next_to_last = last + next_to_last, last
+            ...     return last
+        """
+        def wrap(f):
+            source = textwrap.dedent(inspect.getsource(f))
+            node = ast.parse(source).body[0]
+            if not isinstance(node, ast.FunctionDef):
+                raise InlineGeneratorException('expected a function definition')
             if PY3:
                 name = f.__name__
                 varnames = f.__code__.co_varnames
+                namespace = f.__globals__
             else:
                 name = f.func_name
                 varnames = f.func_code.co_varnames
-            cargs = zip(varnames, argtypes)
-            f._c_decl, f._c_code = self._create_func(name, restype, cargs, f.__doc__)
-            f._c_func_proto = lambda: self.state.get_symbol(name,
-                                          ctypes.CFUNCTYPE(restype, *argtypes))
-            f._c_func = None
-            self.parts.append(f)
-            return inner
+                namespace = f.func_globals
+            if len(node.args.args) != len(argtypes):
+                raise InlineGeneratorException(
+                    'argtypes do not match the arguments of "%s"' % name)
+            # recursive calls see the signature, registered by `_define_func`
+            # only once the translation succeeded
+            signatures = dict(self.signatures)
+            signatures[name] = (restype, argtypes)
+            translator = _PyTranslator(
+                {arg: (arg, ctype) for arg, ctype in zip(varnames, argtypes)},
+                signatures, namespace.get)
+            code = translator.translate(node, restype)
+            return self._define_func(f, restype, argtypes, code)
         return wrap
 
     def c_method(self, restype, *argtypes, **ckwargs):
@@ -333,9 +4718,13 @@ class InlineGenerator(object):
         an instance method `Test.do_something(self, ...)` in Python
         translates to `Test_do_something(struct Test *self, ...)` in C.
         """
+        gen = self
+
         def wrap(f):
             def inner(self, *args, **kwargs):
                 # TODO: apply args and kwargs appropriate to Python
+                if gen.hotswap:
+                    return gen._slot_call(f._c_name, (self,) + args)
                 if not f._c_func:
                     f._c_func = f._c_func_proto()
                 return f._c_func(self, *args)
@@ -350,12 +4739,15 @@ class InlineGenerator(object):
                 args = [pointer] + list(argtypes)
                 cargs = zip(varnames, args)
                 fname = clsname + '_' + name
+                self.signatures[fname] = (restype, tuple(args))
                 decl, code = self._create_func(fname, restype, cargs, f.__doc__)
                 f._c_decl = decl
                 f._c_code = code
-                self.parts.append(f)
-                f._c_func_proto = lambda: self.state.get_symbol(fname,
-                                              ctypes.CFUNCTYPE(restype, *args))
+                f._c_name = fname
+                f._c_owner = clsname
+                inner._c_name = fname
+                self._add_part(f)
+                f._c_func_proto = lambda: self._function(self._bound(), fname)
                 f._c_func = None
 
             inner._cmethod = True
@@ -372,8 +4764,10 @@ class InlineGenerator(object):
             name = f.__name__ if PY3 else f.func_name
             cargs_c = ', '.join('%s' % TYPE_MAPPER[ctype] for ctype in argtypes)
             f._c_decl = '%s (*%s)(%s);' % (TYPE_MAPPER[restype], name, cargs_c or 'void')
-            self.symbols.append((name, ctypes.CFUNCTYPE(restype, *argtypes)(f)))
-            self.parts.append(f)
+            self.signatures[name] = (restype, argtypes)
+            self.symbols.append((name, _Callback(f, restype, argtypes)))
+            f._c_name = name
+            self._add_part(f)
             return f
         return wrap
 
@@ -381,20 +4775,29 @@ class InlineGenerator(object):
         """
         Decorator to make a ScopedStruture method callable from C.
         Follows the naming convention of the c_method decorator in C.
+        The method gets the original Python object for instances created
+        in Python (see `_Registry`), otherwise a new view of the memory.
         """
         def wrap(f):
-            def inner(self, *args, **kwargs):
-                return f(self.contents, *args, **kwargs)
-
             def proto(pointer, clsname):
+                registry = _ScopedStructureBase._registry(pointer._type_)
+
+                def inner(address, *args):
+                    return f(registry.lookup(address), *args)
+
                 name = f.__name__ if PY3 else f.func_name
                 args = tuple([pointer] + list(argtypes))
                 fname = clsname + '_' + name
                 f._c_code = ''
                 cargs_c = ', '.join('%s' % TYPE_MAPPER[ctype] for ctype in args)
                 f._c_decl = '%s (*%s)(%s);' % (TYPE_MAPPER[restype], fname, cargs_c or 'void')
-                self.symbols.append((fname, ctypes.CFUNCTYPE(restype, *args)(inner)))
-                self.parts.append(f)
+                self.signatures[fname] = (restype, args)
+                # the object pointer arrives as plain address for the registry
+                self.symbols.append((fname, _Callback(
+                    inner, restype, (ctypes.c_void_p,) + tuple(argtypes))))
+                f._c_name = fname
+                f._c_owner = clsname
+                self._add_part(f)
 
             f._cmethod = True
             f._proto = proto
@@ -423,6 +4826,8 @@ class TccState(object):
         self.link_paths = []
         self.files = []
         self._compiled = False
+        self._exports = {}
+        self._delete_pending = False
 
     def _encode(self, value):
         if isinstance(value, unicode):
@@ -456,7 +4861,7 @@ class TccState(object):
         Define preprocessor `symbol` with optional `value`.
         """
         self.defines[symbol] = None
-        self.tcc.lib.tcc_define_symbol(self.ctx, symbol, self._encode(value))
+        self.tcc.lib.tcc_define_symbol(self.ctx, self._encode(symbol), self._encode(value))
 
     def undefine(self, symbol):
         """
@@ -496,6 +4901,23 @@ class TccState(object):
         if self.tcc.lib.tcc_add_file(self.ctx, self._encode(path)) == -1:
             raise TccException('error adding file')
 
+    def delete(self):
+        """
+        Free the compile state. Symbols of the state must not be used afterwards.
+        While buffers exported by `get_buffer` are alive the state is
+        freed after the last one got released.
+        """
+        if self.ctx is None:
+            return
+        if self._exports:
+            self._delete_pending = True
+            return
+        self.tcc.states.remove(self.ctx)
+        if self.tcc.perf_map:
+            _PERF_MAP.remove(id(self))
+        self.tcc.lib.tcc_delete(self.ctx)
+        self.ctx = None
+
     def _add_symbol(self, symbol, value):
         """
         Add a `symbol` with `value` to the compiler state.
@@ -546,6 +4968,10 @@ class TccStateMemory(TccState):
         TccState.__init__(self, tcc, libpath, encoding)
         self._set_output(OUTPUT_TYPES['memory'])
         self._relocated = False
+        self._pending_symbols = []
+        self._heap = False
+        # names of the generator parts missing in the compiled code
+        self._eliminated = frozenset()
 
     def relocate(self):
         """
@@ -560,6 +4986,98 @@ class TccStateMemory(TccState):
         if self.tcc.lib.tcc_relocate(self.ctx, 1) == -1:
             raise TccException('relocate error')
         self._relocated = True
+        if self._heap:
+            libc = ctypes.cdll.msvcrt if WINDOWS else ctypes.CDLL(None)
+            for name in ('malloc', 'realloc', 'free'):
+                self.set_symbol('tcc_heap_' + name,
+                                ctypes.cast(getattr(libc, name), ctypes.c_void_p))
+        if self.tcc.perf_map:
+            self._add_perf_symbols()
+        # symbols preset by a template, skipped if not declared by this state
+        for symbol in self._pending_symbols:
+            try:
+                self.set_symbol(*symbol)
+            except TccException:
+                pass
+
+    def _add_perf_symbols(self, names=None):
+        """
+        Add the symbols of the state to the perf map. With the function
+        `names` only those get listed (the other symbols, if libtcc can
+        list them, still bound the function sizes), otherwise all symbols.
+        """
+        symbols = {}
+        if WINDOWS:
+            return
+        lister = getattr(self.tcc.lib, 'tcc_list_symbols', None)
+        if lister:
+            def collect(_, name, address):
+                if name and address:
+                    symbols[name.decode(self.encoding, 'replace')] = address
+            lister(self.ctx, None, SYMBOL_FUNC(collect))
+        functions = set()
+        for name in names or ():
+            for symbol in (name, name + '__impl'):
+                try:
+                    symbols[symbol] = self._get_address(symbol)
+                    functions.add(symbol)
+                except TccException:
+                    pass
+        _PERF_MAP.add(id(self), symbols, None if names is None else functions)
+
+    def track_allocations(self):
+        """
+        Route `malloc`, `calloc`, `realloc` and `free` of the compiled code
+        through tracking wrappers, see `heap_stats`. Must be called before
+        relocation. States without tracking have no overhead.
+
+        NOTE: Memory allocated by other code (e.g. `strdup` of the C library)
+        must not be freed by the tracked code, nor memory allocated by the
+        tracked code elsewhere.
+        """
+        if self._relocated:
+            raise TccException('allocation tracking must be enabled before relocation')
+        if not self._heap:
+            self.compile(_HEAP_CODE)
+            self._heap = True
+
+    def heap_stats(self, top=10, functions=()):
+        """
+        Heap usage of the compiled code with allocation tracking.
+        Returns a dict with the live and peak bytes, the number of
+        allocations, frees and live blocks and the `top` allocation sites
+        by allocated bytes. Sites are attributed to the nearest preceding
+        function in `functions` (names, e.g. the signatures of an
+        InlineGenerator), otherwise reported by address.
+        """
+        if not self._heap:
+            raise TccException('allocation tracking not enabled')
+        stats = _HeapStats.from_address(self._get_address('tcc_heap_stats'))
+        starts = []
+        for name in functions:
+            for symbol in (name, name + '__impl'):
+                try:
+                    starts.append((self._get_address(symbol), name))
+                    break
+                except TccException:
+                    pass
+        starts.sort()
+        addresses = [address for address, _ in starts]
+        sites = {}
+        for site in stats.sites:
+            if not site.caller:
+                continue
+            index = bisect.bisect_right(addresses, site.caller) - 1
+            name = starts[index][1] if index >= 0 else '0x%x' % site.caller
+            entry = sites.setdefault(name, {'function': name, 'bytes': 0,
+                                            'count': 0, 'live_bytes': 0})
+            entry['bytes'] += site.bytes
+            entry['count'] += site.count
+            entry['live_bytes'] += site.live
+        return {'live_bytes': stats.live, 'peak_bytes': stats.peak,
+                'allocations': stats.allocations, 'frees': stats.frees,
+                'live_blocks': stats.blocks,
+                'sites': sorted(sites.values(), key=lambda e: -e['bytes'])[:top]}
 
     def _get_address(self, symbol):
         if not self._compiled:
@@ -576,12 +5094,65 @@ class TccStateMemory(TccState):
         Resolve a symbol at runtime and attach to type `ctype`.
         """
         if issubclass(ctype, ctypes._CFuncPtr):
-            return ctype(self._get_address(symbol))
+            return self.tcc.ffi.function(self._get_address(symbol),
+                                         ctype._restype_, ctype._argtypes_, ctype)
         if issubclass(ctype, (ctypes._SimpleCData, ctypes.Structure,
                               ctypes.Union, ctypes._Pointer, ctypes.Array)):
             return ctype.from_address(self._get_address(symbol))
         raise TccException('cannot handle type information')
 
+    def get_buffer(self, symbol, ctype=None, length=None, readonly=False):
+        """
+        Export memory of the state as buffer object without copying.
+        `symbol` is either the name of a C symbol or an address
+        (int, c_void_p or ctypes pointer, e.g. returned by a function).
+        `ctype` denotes the element type (defaults to the pointer type
+        or c_ubyte), `length` the number of elements. For a symbol
+        with an array type as `ctype` the length is taken from the type.
+
+        The returned memoryview keeps the state alive and works
+        with numpy, `socket.send`, file writes and such, e.g.
+            >>> table = state.get_buffer('table', ctypes.c_double * 1024)
+            >>> numpy.frombuffer(table, numpy.float64)
+            >>> sock.send(state.get_buffer(get_data(), ctypes.c_char, 100))
+        """
+        if isinstance(symbol, (str, unicode, bytes)):
+            address = self._get_address(symbol)
+        else:
+            if isinstance(symbol, ctypes._Pointer):
+                if ctype is None:
+                    ctype = symbol._type_
+                symbol = ctypes.cast(symbol, ctypes.c_void_p)
+            address = getattr(symbol, 'value', symbol)
+            if not address:
+                raise TccException('cannot export NULL pointer')
+            if length is None:
+                raise TccException('length needed for a pointer')
+        if ctype is None:
+            ctype = ctypes.c_ubyte
+        if not issubclass(ctype, ctypes.Array):
+            ctype = ctype * (1 if length is None else length)
+        array = ctype.from_address(address)
+        # keep the state alive as long as the buffer is in use
+        array._state = self
+        key = id(array)
+        self._exports[key] = weakref.ref(array, lambda _: self._release_export(key))
+        view = memoryview(array)
+        code = getattr(ctype._type_, '_type_', None)
+        if isinstance(code, str) and code in 'bBhHiIlLqQfd?c':
+            # ctypes exports explicit byte order formats, use native ones
+            # to make the view indexable
+            view = view.cast('B').cast(code)
+        if readonly:
+            view = view.toreadonly()
+        return view
+
+    def _release_export(self, key):
+        self._exports.pop(key, None)
+        if self._delete_pending and not self._exports:
+            self._delete_pending = False
+            self.delete()
+
     def set_symbol(self, symbol, value):
         """
         Set a symbol to `value` at runtime.
@@ -603,9 +5174,9 @@ class TccStateMemory(TccState):
             - set the function pointer
               set_function('test', cfunc)
         """
-        ctypes.pointer(
-            type(value).from_address(self._get_address(symbol))
-        )[0] = value
+        if isinstance(value, _Callback):
+            value = value.get(self.tcc.ffi)
+        self.tcc.ffi.store(self._get_address(symbol), value)
 
 
 class TccStateRun(TccState):
@@ -633,14 +5204,175 @@ class TccStateRun(TccState):
         return self.tcc.lib.tcc_run(self.ctx, argc, argv)
 
 
+class StateTemplate(object):
+    """
+    Reusable configuration for compile states.
+    The template records options, defines, include and link paths,
+    libraries and files once, `create_state` spawns new states with
+    that configuration applied.
+
+    Shared C code can be compiled once into an object file with
+    `add_prelude`, new states link the object instead of compiling the
+    source again. Symbols set with `set_symbol` are set on memory states
+    right after relocation.
+
+    The template supports the configuration methods of a state,
+    e.g. `InlineGenerator.prepare_state` works with it as well.
+
+    Example:
+        >>> template = TinyCC().create_template()
+        >>> template.add_include_path('/opt/include')
+        >>> template.define('NDEBUG')
+        >>> template.add_prelude(shared_code)
+        >>> state = template.create_state()
+        >>> state.compile(kernel_code)
+        >>> state.relocate()
+    """
+    def __init__(self, tcc, output_type='memory', encoding=None):
+        self.tcc = tcc
+        self.output_type = output_type
+        self.encoding = encoding
+        self.options = []
+        self.defines = {}
+        self.include_paths = []
+        self.libraries = []
+        self.link_paths = []
+        self.files = []
+        self.symbols = []
+        self._preludes = []
+
+    def add_option(self, option):
+        """
+        Add a commandline option to the template.
+        """
+        self.options.append(option)
+
+    def define(self, symbol, value=None):
+        """
+        Define preprocessor `symbol` with optional `value`.
+        """
+        self.defines[symbol] = value
+
+    def undefine(self, symbol):
+        """
+        Remove the preprocessor `symbol` from the template.
+        """
+        try:
+            del self.defines[symbol]
+        except KeyError:
+            raise TccException('define %s not set' % symbol)
+
+    def add_include_path(self, path):
+        """
+        Add an include path (equivalent to -Ipath).
+        """
+        self.include_paths.append(path)
+
+    def add_library(self, name):
+        """
+        Add a library. `name` is the same as the argument of the '-l' option.
+        """
+        self.libraries.append(name)
+
+    def add_link_path(self, path):
+        """
+        Add a linker path (equivalent to -Lpath).
+        """
+        self.link_paths.append(path)
+
+    def add_file(self, path):
+        """
+        Add a file ressource to the template.
+        """
+        self.files.append(path)
+
+    def set_symbol(self, symbol, value):
+        """
+        Set `symbol` to `value` for spawned memory states
+        after relocation (see `TccStateMemory.set_symbol`).
+        States that don't declare `symbol` skip it.
+        """
+        self.symbols.append((symbol, value))
+
+    def add_prelude(self, source):
+        """
+        Compile `source` with the current configuration into an
+        object file once and add it to all spawned states.
+        """
+        import tempfile
+        state = self._configure(self.tcc.create_state('obj', self.encoding))
+        try:
+            state.compile(source)
+            handle, path = tempfile.mkstemp(suffix='.o', prefix='tcc_prelude_')
+            os.close(handle)
+            self._preludes.append(path)
+            state.write_file(path)
+        finally:
+            state.delete()
+
+    def _configure(self, state):
+        for option in self.options:
+            state.add_option(option)
+        for symbol, value in self.defines.items():
+            state.define(symbol, value)
+        for path in self.include_paths:
+            state.add_include_path(path)
+        for path in self.link_paths:
+            state.add_link_path(path)
+        for name in self.libraries:
+            state.add_library(name)
+        return state
+
+    def create_state(self):
+        """
+        Create a new compile state with the configuration of the template.
+        """
+        state = self._configure(self.tcc.create_state(self.output_type, self.encoding))
+        for path in self._preludes + self.files:
+            state.add_file(path)
+        if self.symbols:
+            if not isinstance(state, TccStateMemory):
+                raise TccException('symbols need a memory state')
+            state._pending_symbols = list(self.symbols)
+        return state
+
+    def close(self):
+        """
+        Remove the compiled prelude objects.
+        """
+        while self._preludes:
+            try:
+                os.remove(self._preludes.pop())
+            except OSError:
+                pass
+
+    def __del__(self):
+        self.close()
+
+
 class TinyCC(object):
     """
     Class for the TCC environment initialization.
     With the optional arguments `shared_library` and `tccpath` the used
     tcc can be customized. By default they point to the libtcc and tcc folder
     in the tinycc package.
+    TinyCC is a singleton, the arguments of the first call configure
+    it, later calls return the instance unchanged.
+
+    Call `create_state` for a compile state to work with,
+    `create_template` for a reusable state configuration.
 
-    Call `create_state` for a compile state to work with.
+    `ffi` selects the backend for calls between Python and the
+    compiled code, either 'ctypes' (default) or 'cffi' (see `FFI_BACKENDS`).
+    The function signatures are declared with ctypes for both.
+
+    Pre-fork servers call `prefork` with their generators before
+    forking the workers.
+
+    With `perf_map=True` the functions of relocated memory states are
+    written to `/tmp/perf-<pid>.map` (removed again when a state gets
+    freed), which makes compiled code visible by name in `perf` and
+    other sampling profilers reading perf maps.
 
     example for run state:
     >>> state = TinyCC().create_state('run')
@@ -670,12 +5402,20 @@ class TinyCC(object):
             cls.instance = object.__new__(cls)
         return cls.instance
 
-    def __init__(self, shared_library=TCCLIB, tccpath=TCCPATH, encoding='UTF-8'):
+    def __init__(self, shared_library=TCCLIB, tccpath=TCCPATH, encoding='UTF-8',
+                 ffi='ctypes', perf_map=False):
+        if self.__dict__.get('lib') is not None:
+            # singleton, later calls must not reset the states and settings
+            return
         self.lib = ctypes.CDLL(shared_library)
         self.libpath = tccpath
         self.lib.tcc_get_symbol.restype = ctypes.c_int
         self.states = []
         self.encoding = encoding
+        self.perf_map = perf_map and not WINDOWS
+        if ffi not in FFI_BACKENDS:
+            raise TccException('unknown ffi backend %r' % ffi)
+        self.ffi = FFI_BACKENDS[ffi]()
 
     def create_state(self, output_type='memory', encoding=None):
         """
@@ -698,3 +5438,33 @@ class TinyCC(object):
         else:
             state = TccStateFile(self, self.libpath, output_type, encoding=encoding)
         return state
+
+    def prefork(self, *generators, **kwargs):
+        """
+        Prepare a pre-fork server: build and `preload` the `generators`
+        in the parent, forked workers share the relocated code pages
+        copy-on-write and start without compiling.
+        With `freeze=True` (default) the objects alive so far are moved
+        out of reach of the garbage collector (Python >= 3.7), its
+        collections in the workers would otherwise write to and
+        thereby copy the shared pages.
+        """
+        freeze = kwargs.pop('freeze', True)
+        if kwargs:
+            raise TypeError('unexpected arguments %s' % ', '.join(kwargs))
+        for generator in generators:
+            if generator.state is None and not generator.lazy:
+                generator.build(self)
+            generator.preload()
+        if freeze:
+            import gc
+            gc.collect()
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+
+    def create_template(self, output_type='memory', encoding=None):
+        """
+        Create a `StateTemplate` to spawn preconfigured states
+        of `output_type` from.
+        """
+        return StateTemplate(self, output_type, encoding)